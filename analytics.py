@@ -0,0 +1,160 @@
+from collections import defaultdict
+
+# Sales figures for /admin/analytics, kept in three small rollup tables:
+#
+#   sales_daily      one row per UTC day: orders, licenses and prints sold,
+#                    and revenue split into license, print and auction money
+#   sales_by_theme   licenses, prints and revenue per theme
+#   sales_by_photo   licenses, prints and revenue per photo, for top sellers
+#
+# place_order() and settle_batch() add to them in the same transaction that
+# writes the purchases and settles the auctions, so the dashboard reads a few
+# hundred rows at most however long the sales history gets. rebuild()
+# recomputes all three from purchases and limited_photos, e.g. after an
+# upgrade or a manual fix to the history.
+
+# how many days of the per-day table the dashboard shows
+DAYS_SHOWN = 30
+TOP_SELLERS = 10
+
+
+def add_daily(db, day, orders=0, licenses=0, prints=0, license_revenue=0.0, print_revenue=0.0,
+              auctions=0, auction_revenue=0.0):
+    db.execute("""INSERT INTO sales_daily (day, orders, licenses, prints, auctions, license_revenue, print_revenue, auction_revenue)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(day) DO UPDATE SET
+                   orders = orders + excluded.orders,
+                   licenses = licenses + excluded.licenses,
+                   prints = prints + excluded.prints,
+                   auctions = auctions + excluded.auctions,
+                   license_revenue = license_revenue + excluded.license_revenue,
+                   print_revenue = print_revenue + excluded.print_revenue,
+                   auction_revenue = auction_revenue + excluded.auction_revenue""",
+               (day, orders, licenses, prints, auctions, license_revenue, print_revenue, auction_revenue))
+
+
+def add_sales(db, table, key, rows):
+    # rows is [(key value, licenses, prints, license revenue, print revenue)]
+    # for sales_by_theme (keyed on theme) or sales_by_photo (on photo_id)
+    db.executemany(f"""INSERT INTO {table} ({key}, licenses, prints, license_revenue, print_revenue, revenue)
+                   VALUES (?1, ?2, ?3, ?4, ?5, ?4 + ?5)
+                   ON CONFLICT({key}) DO UPDATE SET
+                       licenses = licenses + excluded.licenses,
+                       prints = prints + excluded.prints,
+                       license_revenue = license_revenue + excluded.license_revenue,
+                       print_revenue = print_revenue + excluded.print_revenue,
+                       revenue = revenue + excluded.revenue""", rows)
+
+
+def record_order(db, day, lines):
+    # Called by place_order() before it commits. lines is
+    # [(photo row, license, print_qty, license price, print price)] for the
+    # purchases rows it wrote.
+    by_photo = []
+    by_theme = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    for photo, license, print_qty, price_license, price_print in lines:
+        licenses = 1 if license else 0
+        by_photo.append((photo["id"], licenses, print_qty, price_license, price_print))
+        totals = by_theme[photo["theme"]]
+        totals[0] += licenses
+        totals[1] += print_qty
+        totals[2] += price_license
+        totals[3] += price_print
+    if not by_photo:
+        return
+
+    add_daily(db, day, orders=1,
+              licenses=sum(row[1] for row in by_photo), prints=sum(row[2] for row in by_photo),
+              license_revenue=sum(row[3] for row in by_photo), print_revenue=sum(row[4] for row in by_photo))
+    add_sales(db, "sales_by_photo", "photo_id", by_photo)
+    add_sales(db, "sales_by_theme", "theme", [(theme, *totals) for theme, totals in by_theme.items()])
+
+
+def record_auction(db, day, amount):
+    # Called by settle_batch() for every auction that had a winner
+    add_daily(db, day, auctions=1, auction_revenue=amount)
+
+
+def rebuild(db):
+    # One pass over purchases in id order, then one over settled auctions,
+    # summing into dicts that have a row per day, theme and photo rather than
+    # per sale. Rows are streamed from the cursor, never fetched all at once.
+    # The caller owns the transaction (BEGIN IMMEDIATE, so no sale is
+    # recorded half way through). Purchases of photos deleted since count
+    # under the theme "Unknown".
+    daily = defaultdict(lambda: [0, 0, 0, 0, 0.0, 0.0, 0.0])
+    by_photo = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    by_theme = defaultdict(lambda: [0, 0, 0.0, 0.0])
+    last_order = None
+
+    purchases = db.execute("""SELECT purchases.user_id, purchases.photo_id, purchases.license, purchases.print_qty,
+                                     purchases.price_license, purchases.price_print, purchases.purchase_date,
+                                     COALESCE(photos.theme, 'Unknown') AS theme
+                              FROM purchases LEFT JOIN photos ON photos.id = purchases.photo_id
+                              ORDER BY purchases.id""")
+    for row in purchases:
+        day = str(row["purchase_date"])[:10]
+        licenses = 1 if row["license"] else 0
+        print_qty = row["print_qty"] or 0
+        price_license = row["price_license"] or 0.0
+        price_print = row["price_print"] or 0.0
+
+        totals = daily[day]
+        # an order's rows are written together, with one user and timestamp
+        order = (row["user_id"], str(row["purchase_date"]))
+        if order != last_order:
+            totals[0] += 1
+            last_order = order
+        totals[1] += licenses
+        totals[2] += print_qty
+        totals[4] += price_license
+        totals[5] += price_print
+
+        for totals in (by_photo[row["photo_id"]], by_theme[row["theme"]]):
+            totals[0] += licenses
+            totals[1] += print_qty
+            totals[2] += price_license
+            totals[3] += price_print
+
+    auctions = db.execute("""SELECT settled_at, winning_bid FROM limited_photos
+                          WHERE settled_at IS NOT NULL AND winning_bid IS NOT NULL""")
+    for row in auctions:
+        totals = daily[str(row["settled_at"])[:10]]
+        totals[3] += 1
+        totals[6] += row["winning_bid"]
+
+    db.execute("""DELETE FROM sales_daily""")
+    db.execute("""DELETE FROM sales_by_photo""")
+    db.execute("""DELETE FROM sales_by_theme""")
+    db.executemany("""INSERT INTO sales_daily (day, orders, licenses, prints, auctions, license_revenue, print_revenue, auction_revenue)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                   [(day, *totals) for day, totals in daily.items()])
+    add_sales(db, "sales_by_photo", "photo_id", [(photo_id, *totals) for photo_id, totals in by_photo.items()])
+    add_sales(db, "sales_by_theme", "theme", [(theme, *totals) for theme, totals in by_theme.items()])
+    return {"days": len(daily), "photos": len(by_photo), "themes": len(by_theme)}
+
+
+def dashboard(db, days=DAYS_SHOWN, top=TOP_SELLERS):
+    # Everything /admin/analytics shows, read from the rollups only
+    totals = db.execute("""SELECT COALESCE(SUM(orders), 0) AS orders,
+                                  COALESCE(SUM(licenses), 0) AS licenses,
+                                  COALESCE(SUM(prints), 0) AS prints,
+                                  COALESCE(SUM(auctions), 0) AS auctions,
+                                  COALESCE(SUM(license_revenue), 0) AS license_revenue,
+                                  COALESCE(SUM(print_revenue), 0) AS print_revenue,
+                                  COALESCE(SUM(auction_revenue), 0) AS auction_revenue
+                           FROM sales_daily""").fetchone()
+    daily = db.execute("""SELECT *, license_revenue + print_revenue + auction_revenue AS revenue
+                       FROM sales_daily ORDER BY day DESC LIMIT ?""", (days,)).fetchall()
+    themes = db.execute("""SELECT * FROM sales_by_theme ORDER BY revenue DESC""").fetchall()
+    # sales_by_photo is read through idx_sales_by_photo_revenue, top rows only
+    top_sellers = db.execute("""SELECT sales_by_photo.*, COALESCE(photos.title, '(deleted)') AS title, photos.theme
+                             FROM sales_by_photo LEFT JOIN photos ON photos.id = sales_by_photo.photo_id
+                             ORDER BY sales_by_photo.revenue DESC LIMIT ?""", (top,)).fetchall()
+    return {
+        "totals": totals,
+        "revenue": totals["license_revenue"] + totals["print_revenue"] + totals["auction_revenue"],
+        "daily": daily,
+        "themes": themes,
+        "top_sellers": top_sellers,
+    }
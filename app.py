@@ -1,25 +1,129 @@
-from flask import Flask, render_template, session, redirect, url_for, g, request, flash
-from database import get_db, close_db
-from flask_session import Session
-from forms import SignupForm, LoginForm, PhotoSearchForm, UploadPhotoForm, LimitedPhotoForm, BidForm, DeletePhotoForm, UpdatePhotoForm, PurchaseForm, CheckoutForm
+from flask import Flask, render_template, session, redirect, url_for, g, request, flash, Response, jsonify, stream_with_context, send_file, abort
+from database import get_db, close_db, upgrade_db
+import sessions
+import profiling
+import database
+import http_cache
+import catalogue_cache
+from catalogue_cache import cache
+import fragment_cache
+from fragment_cache import cached_fragment, fragments
+from http_cache import conditional_page
+from forms import SignupForm, LoginForm, PhotoSearchForm, UploadPhotoForm, LimitedPhotoForm, BidForm, PhotoGridForm, PhotoRowForm, PurchaseForm, CheckoutForm, BulkImportForm
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from catalogue import gallery_page, admin_photo_page, random_photo, photo_of_the_hour, search_photos, featured_auction
+from pricing import price_cart, load_photos
+from orders import place_order, has_license, OutOfStock
+import bidding
+import live
+import settlement
+import analytics
+import similar
+from similar import add_vector, photo_vector, similar_photos
+import previews
+from previews import PREVIEW_SIZES, PREVIEW_FORMATS
+from images import DERIVATIVE_SIZES, make_derivatives, save_derivatives, backfill_job
+from storage import stage_upload, remove_unused, delete_unused
+from image_metadata import read_metadata, save_metadata, near_duplicates, duplicate_groups, UnreadableImage
+from bulk_import import import_photos, read_manifest, ImportFailed
+from audit import LOG_COLUMNS, parse_day, log_page, log_rows, export_csv, export_jsonl
+from concurrent.futures import ProcessPoolExecutor
+import click
+import hmac
 import os
+import posixpath
+import sqlite3
+import tempfile
 
 app = Flask(__name__)
 app.teardown_appcontext(close_db)
 app.config["SECRET_KEY"] = "this-is-my-secret-key"
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
+# "sqlite" keeps sessions in app.db, "memory" in a per-process LRU (single
+# worker only), "filesystem" uses Flask-Session's files in flask_session/
+app.config["SESSION_BACKEND"] = "sqlite"
+app.config["SESSION_SWEEP_INTERVAL"] = 300
 app.config["UPLOAD_FOLDER"] = "static/uploads"
+app.config["DERIVATIVE_FOLDER"] = "static/uploads/derived"
 app.config["ALLOWED_EXTENSIONS"] = {"jpg", "jpeg", "png"}
-Session(app)
+app.config["GALLERY_PAGE_SIZE"] = 24
+app.config["LOG_PAGE_SIZE"] = 50
+app.config["ADMIN_PAGE_SIZE"] = 50
+# themes and photo rows kept per worker process, see catalogue_cache.py
+app.config["CATALOGUE_CACHE_SIZE"] = 5000
+# rendered gallery grids and home page blocks, see fragment_cache.py. The size
+# is in characters of HTML per worker process, the TTL in seconds.
+app.config["FRAGMENT_CACHE_SIZE"] = 8 * 1024 * 1024
+app.config["FRAGMENT_CACHE_TTL"] = 300
+# "random" picks a new home page photo on every visit, "hourly" keeps one per hour
+app.config["FEATURED_PHOTO_MODE"] = "random"
+# settle ended auctions from a background thread in every worker process; a
+# lease row lets only one of them settle at a time. Set to False to run
+# "flask run-settlement" (or "flask settle-auctions" from cron) instead.
+app.config["SETTLEMENT_SCHEDULER"] = True
+# per-endpoint timings at /admin/metrics, see profiling.py. PROFILING_SAMPLE_RATE
+# of requests also run under cProfile and the slowest are saved to PROFILING_DIR
+app.config["PROFILING"] = False
+app.config["PROFILING_SAMPLE_RATE"] = 0
+app.config["PROFILING_DIR"] = "profiles"
+# lets a Prometheus scraper read /admin/metrics/prometheus with "Authorization: Bearer <token>"
+app.config["METRICS_TOKEN"] = None
+# colour vectors for "similar photos" on the photo pages, see similar.py. The
+# file sits next to the database so a scratch database gets its own.
+app.config["SIMILAR_VECTORS"] = os.path.splitext(database.DATABASE)[0] + "-vectors.f32"
+app.config["SIMILAR_PHOTOS"] = 6
+app.config["SIMILAR_SAME_THEME"] = True
+# watermarked previews, see previews.py. The cache size is in bytes on disk.
+app.config["PREVIEW_FOLDER"] = "previews"
+app.config["PREVIEW_CACHE_SIZE"] = 256 * 1024 * 1024
+app.config["WATERMARK_TEXT"] = "Photography Marketplace"
+# only the thumb derivatives are public, bigger copies are watermarked
+# previews and originals are only sent by /download, to buyers.
+# Behind a server that sets X-Sendfile, USE_X_SENDFILE hands the file to it.
+app.config["PROTECT_UPLOADS"] = True
+sessions.init_app(app)
+http_cache.init_app(app)
+catalogue_cache.init_app(app)
+fragment_cache.init_app(app)
+similar.init_app(app)
+previews.init_app(app)
+profiling.init_app(app)
+app.jinja_env.globals["derivative_sizes"] = DERIVATIVE_SIZES
+app.jinja_env.globals["preview_sizes"] = PREVIEW_SIZES
+
+with app.app_context():
+    upgrade_db()
+    # picks up bids and settlements made before the leaderboard table existed
+    bidding.rebuild_leaderboard(get_db())
+    get_db().commit()
 
 
+@app.before_request
+def start_settlement():
+    # on the first request of each worker process rather than at import, so
+    # forked workers run one too and CLI commands don't
+    if app.config["SETTLEMENT_SCHEDULER"]:
+        settlement.start_scheduler(app.config)
+
 @app.before_request
 def load_logged_in_user():
     g.user = session.get("user_id", None)
 
+PUBLIC_SUFFIXES = tuple(f"-{name}.{extension}" for name in DERIVATIVE_SIZES for extension in ("jpg", "webp"))
+
+@app.before_request
+def protect_uploads():
+    # only the public derivatives of an upload can be fetched from /static
+    if request.endpoint != "static" or not app.config["PROTECT_UPLOADS"]:
+        return
+    path = posixpath.normpath("static/" + request.view_args.get("filename", "").lstrip("/"))
+    if not path.startswith(app.config["UPLOAD_FOLDER"].rstrip("/") + "/"):
+        return
+    if not (path.startswith(app.config["DERIVATIVE_FOLDER"].rstrip("/") + "/")
+            and path.endswith(PUBLIC_SUFFIXES)):
+        abort(404)
+
 def login_required(view):
     @wraps(view)
     def wrapped_view(*args, **kwargs):
@@ -29,30 +133,26 @@ def login_required(view):
     return wrapped_view
 
 def get_random_photo():
-    import random
     db = get_db()
-    photos = db.execute("""SELECT * FROM photos""").fetchall()
-    if not photos:
+    if app.config["FEATURED_PHOTO_MODE"] == "hourly":
+        photo = photo_of_the_hour(db)
+    else:
+        photo = random_photo(db)
+    if not photo:
         print("No photos found in the database")
-    return random.choice(photos) if photos else None
+    return photo
 
 @app.route("/", methods=["GET", "POST"])
 def home():
     db = get_db()
-    themes = db.execute("""SELECT DISTINCT name FROM themes""").fetchall()
     theme_choices = [("All", "All Themes")]
 
-    for theme in themes:
-        theme_choices.append((theme["name"], theme["name"]))
+    for theme in cache.themes(db):
+        theme_choices.append((theme, theme))
 
     form = PhotoSearchForm()
     form.theme.choices = theme_choices  
 
-    featured_photo = db.execute("""SELECT * FROM limited_photos 
-                                WHERE end_date > CURRENT_TIMESTAMP
-                                ORDER BY end_date ASC
-                                LIMIT 1""").fetchone()
-    
     if form.validate_on_submit():
         session["theme"] = form.theme.data
         session["price_min"] = form.price_min.data
@@ -61,8 +161,10 @@ def home():
 
         return redirect(url_for("gallery"))
 
+    featured = cached_fragment("featured_auction",
+                               render=lambda: render_template("featured_auction.html", featured_photo=featured_auction(db)))
     random_photo = get_random_photo()
-    return render_template("home_page.html", form=form, random_photo=random_photo, featured_photo=featured_photo, caption="Photography Marketplace")
+    return render_template("home_page.html", form=form, random_photo=random_photo, featured_auction=featured, caption="Photography Marketplace")
 
 
 #  -----------------ADMIN SECTION------------------------
@@ -94,17 +196,31 @@ def admin():
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in app.config["ALLOWED_EXTENSIONS"]
 
+def read_upload_metadata(upload):
+    # The extension only says what the file claims to be: anything Pillow
+    # can't open is thrown away here, before it gets a row
+    try:
+        return read_metadata(upload.temp_path)
+    except UnreadableImage:
+        upload.discard()
+        flash("That file is not an image we can read", "error")
+        return None
+
+def warn_near_duplicates(db, table, photo_id, metadata):
+    matches = near_duplicates(db, metadata["phash"], exclude=(table, photo_id))
+    if matches:
+        titles = ", ".join(f'"{title}"' for distance, source, match_id, title in matches[:5])
+        flash(f"This looks like a near-duplicate of {titles}, see Admin Dashboard > Duplicates", "error")
+
 @app.route("/admin/upload", methods=["GET", "POST"])
 @login_required
 @admin_required
 def upload():
     db = get_db()
-    themes = db.execute("""SELECT DISTINCT name FROM themes""").fetchall()
-
     theme_choices = []
 
-    for theme in themes:
-        theme_choices.append((theme["name"], theme["name"]))
+    for theme in cache.themes(db):
+        theme_choices.append((theme, theme))
 
     form = UploadPhotoForm()
     form.theme.choices = theme_choices
@@ -119,17 +235,30 @@ def upload():
         inventory = form.inventory.data
 
         if file and allowed_file(file.filename):
-            filename = file.filename
-            file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename).replace("\\", "/")
-
-            file.save(file_path)
-
-            db.execute("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory) 
-                       VALUES (?, ?, ?, ?, ?, ?, ?)""", (title, description, theme, file_path, price_license, price_print, inventory))
-            
-            db.commit()
-            # selects the last row that was inserted
-            photo_id = db.execute("""SELECT last_insert_rowid()""").fetchone()[0]
+            upload = stage_upload(file.stream, app.config["UPLOAD_FOLDER"], file.filename.rsplit(".", 1)[1])
+            file_path = upload.file_path
+            metadata = read_upload_metadata(upload)
+            if metadata is None:
+                return redirect(url_for("upload"))
+
+            # the file is moved into place under the write lock, see storage.py
+            db.execute("""BEGIN IMMEDIATE""")
+            try:
+                db.execute("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?)""", (title, description, theme, file_path, price_license, price_print, inventory))
+                # selects the last row that was inserted
+                photo_id = db.execute("""SELECT last_insert_rowid()""").fetchone()[0]
+                upload.commit()
+                db.commit()
+            except Exception:
+                db.rollback()
+                upload.discard()
+                raise
+
+            save_derivatives(db, "photos", photo_id, make_derivatives(file_path, app.config["DERIVATIVE_FOLDER"], reuse=True))
+            save_metadata(db, "photos", photo_id, metadata)
+            add_vector(db, photo_id, photo_vector(file_path))
+            warn_near_duplicates(db, "photos", photo_id, metadata)
 
             db.execute("""INSERT INTO admin_logs (user_id, action, photo_id, title) 
                        VALUES (?, ?, ?, ?)""", (session["user_id"], "UPLOAD", photo_id, title))
@@ -156,17 +285,29 @@ def upload_limited():
         base_price = float(form.base_price.data)
 
         if file and allowed_file(file.filename):
-            filename = file.filename
-            file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename).replace("\\", "/")
-
-            file.save(file_path)
-
-            db.execute("""INSERT INTO limited_photos (title, description, file_path, base_price, end_date) 
-                       VALUES (?, ?, ?, ?, DATETIME('now', '+7 days'))""", (title, description, file_path, base_price))
-            
-            db.commit()
-
-            photo_id = db.execute("""SELECT last_insert_rowid()""").fetchone()[0]
+            upload = stage_upload(file.stream, app.config["UPLOAD_FOLDER"], file.filename.rsplit(".", 1)[1])
+            file_path = upload.file_path
+            metadata = read_upload_metadata(upload)
+            if metadata is None:
+                return redirect(url_for("upload_limited"))
+
+            db.execute("""BEGIN IMMEDIATE""")
+            try:
+                db.execute("""INSERT INTO limited_photos (title, description, file_path, base_price, end_date) 
+                           VALUES (?, ?, ?, ?, DATETIME('now', '+7 days'))""", (title, description, file_path, base_price))
+                photo_id = db.execute("""SELECT last_insert_rowid()""").fetchone()[0]
+                upload.commit()
+                db.commit()
+            except Exception:
+                db.rollback()
+                upload.discard()
+                raise
+
+            save_derivatives(db, "limited_photos", photo_id, make_derivatives(file_path, app.config["DERIVATIVE_FOLDER"], reuse=True))
+            save_metadata(db, "limited_photos", photo_id, metadata)
+            warn_near_duplicates(db, "limited_photos", photo_id, metadata)
+            end_date = db.execute("""SELECT end_date FROM limited_photos WHERE id = ?""", (photo_id,)).fetchone()[0]
+            settlement.schedule(photo_id, end_date)
 
             if "user_id" in session:
                 db.execute("""INSERT INTO admin_logs (user_id, action, photo_id, title) 
@@ -180,111 +321,265 @@ def upload_limited():
     return render_template("admin_limited_upload.html", form=form)
 
 
+@app.route("/admin/import", methods=["GET", "POST"])
+@admin_required
+@login_required
+def bulk_import():
+    form = BulkImportForm()
+    report = None
+
+    if form.validate_on_submit():
+        # the ZIP is saved to a temporary file so the workers can read it
+        handle, archive_path = tempfile.mkstemp(suffix=".zip")
+        os.close(handle)
+        try:
+            form.archive.data.save(archive_path)
+            manifest = None
+            if form.manifest.data and form.manifest.data.filename:
+                manifest = read_manifest(form.manifest.data.filename, form.manifest.data.stream)
+            report = import_photos(get_db(), archive_path, manifest, session["user_id"], app.config)
+        except (ImportFailed, ValueError, OSError) as e:
+            flash(f"Import failed: {e}", "error")
+        finally:
+            os.remove(archive_path)
+
+        if report:
+            flash(f"Imported {report['imported']} photos in {report['seconds']:.1f}s", "success")
+
+    return render_template("admin_import.html", form=form, report=report)
+
+
+# the columns an admin can change from the photo grid
+PHOTO_GRID_FIELDS = ("title", "description", "theme", "price_license", "price_print", "inventory")
+
+def photo_row_form(photo, theme_choices):
+    # Filled from the row on a GET, from the submitted p<id>-* fields on a POST
+    form = PhotoRowForm(prefix=f"p{photo['id']}", data=dict(photo))
+    form.theme.choices = theme_choices
+    return form
+
+def save_photo_grid(db, grid, theme_choices):
+    # Validates the rows of a submitted grid and writes every changed or
+    # deleted photo in one transaction, with one admin_logs row each. Only
+    # the photos named in photo_ids are looked at, and rows nobody touched
+    # are skipped. Returns (number of changes, {photo id: row form}); the
+    # number is None if a row didn't validate or the write failed.
+    photo_ids = [int(photo_id) for photo_id in (grid.photo_ids.data or "").split(",") if photo_id.isdigit()]
+    photos = load_photos(db, photo_ids[:app.config["ADMIN_PAGE_SIZE"]])
+
+    forms = {}
+    updates = []
+    deletes = []
+    for photo_id, photo in photos.items():
+        if f"p{photo_id}-title" not in request.form:
+            continue
+        form = forms[photo_id] = photo_row_form(photo, theme_choices)
+        if not form.validate():
+            continue
+        # an emptied price is stored as 0.00, as the old edit page did, since
+        # carts and checkout multiply prices. Left empty on a photo uploaded
+        # without one it isn't a change.
+        values = [0.0 if form[field].data is None else form[field].data for field in PHOTO_GRID_FIELDS]
+        if form.delete.data:
+            deletes.append((photo_id, photo["title"]))
+        elif any(form[field].data != photo[field] and value != photo[field] for field, value in zip(PHOTO_GRID_FIELDS, values)):
+            updates.append((photo_id, values))
+
+    if any(form.errors for form in forms.values()):
+        flash("Nothing was saved, please correct the highlighted rows", "error")
+        return None, forms
+
+    # deleted files (and their derivatives) only go once no other photo uses
+    # them, and only after the rows are gone for good
+    unused = []
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        db.executemany("""UPDATE photos
+                       SET title = ?, description = ?, theme = ?, price_license = ?, price_print = ?, inventory = ?
+                       WHERE id = ?""",
+                       [(*values, photo_id) for photo_id, values in updates])
+        db.executemany("""DELETE FROM photos WHERE id = ?""", [(photo_id,) for photo_id, title in deletes])
+        if deletes:
+            unused = remove_unused(db)
+        db.executemany("""INSERT INTO admin_logs (user_id, action, photo_id, title)
+                       VALUES (?, ?, ?, ?)""",
+                       [(session["user_id"], "UPDATE", photo_id, values[0]) for photo_id, values in updates] +
+                       [(session["user_id"], "DELETE", photo_id, title) for photo_id, title in deletes])
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        flash("Nothing was saved, every photo needs a different title", "error")
+        return None, forms
+    except Exception:
+        db.rollback()
+        raise
+    if unused:
+        delete_unused(db, unused, app.config["DERIVATIVE_FOLDER"])
+
+    return len(updates) + len(deletes), forms
+
+
 @app.route("/admin/photos", methods=["GET", "POST"])
 @admin_required
 @login_required
 def manage_photos():
     db = get_db()
-    message = None
-    
-    # Delete a photo by title
+    theme_choices = [(theme, theme) for theme in cache.themes(db)]
+    query = request.args.get("q", "").strip()
+    theme = request.args.get("theme", "").strip()
+
+    grid = PhotoGridForm()
+    forms = {}
+    if grid.validate_on_submit():
+        saved, forms = save_photo_grid(db, grid, theme_choices)
+        if saved is not None:
+            flash(f"Saved {saved} change{'' if saved == 1 else 's'}", "success")
+            return redirect(request.url)
+
+    photos, prev_cursor, next_cursor = admin_photo_page(db, query, theme, app.config["ADMIN_PAGE_SIZE"],
+                                                        after=request.args.get("after", type=int),
+                                                        before=request.args.get("before", type=int))
+    grid.photo_ids.data = ",".join(str(photo["id"]) for photo in photos)
+    # row forms are made one at a time as the template reaches them
+    rows = ((photo, forms.get(photo["id"]) or photo_row_form(photo, theme_choices)) for photo in photos)
+
+    return render_template("admin_photos.html", grid=grid, rows=rows, prev_cursor=prev_cursor, next_cursor=next_cursor,
+                           themes=theme_choices, filters={"q": query, "theme": theme})
+
+
+def log_view_filters(with_action):
+    # the user / action / date range filters from the query string
+    filters = {
+        "user_id": request.args.get("user", "").strip() or None,
+        "date_from": parse_day(request.args.get("from")),
+        "date_to": parse_day(request.args.get("to")),
+    }
+    if with_action:
+        filters["action"] = request.args.get("action", "").strip().upper() or None
+    return filters
+
+def log_view_args(filters):
+    # the filters again as query string arguments, for page and export links
+    names = {"user_id": "user", "action": "action", "date_from": "from", "date_to": "to"}
+    return {names[key]: value for key, value in filters.items() if value}
+
+def export_logs(table, filters):
+    # Streams the whole filtered log, newest first, as CSV or JSON lines.
+    # Rows are read in batches while the response is being sent.
+    columns = LOG_COLUMNS[table]
+    rows = log_rows(get_db(), table, filters)
+    if request.args.get("format") == "jsonl":
+        body, mimetype, extension = export_jsonl(rows, columns), "application/x-ndjson", "jsonl"
+    else:
+        body, mimetype, extension = export_csv(rows, columns), "text/csv", "csv"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={table}.{extension}"})
 
-    delete_form = DeletePhotoForm() 
-    
-    if delete_form.validate_on_submit():
-        title = delete_form.delete_title.data.strip()
 
-        photo = db.execute("""SELECT id, file_path FROM photos 
-                           WHERE title = ?""", (title,)).fetchone()
-        
-        if photo:
-            file_path = photo["file_path"]
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
+@app.route("/admin/logs", methods=["GET", "POST"])
+@admin_required
+@login_required
+def view_logs():
+    db = get_db()
+    filters = log_view_filters(with_action=True)
 
-            db.execute("""DELETE FROM photos 
-                       WHERE title = ?""", (title,))
-            
-            db.commit()
+    logs, prev_cursor, next_cursor = log_page(db, "admin_logs", filters, app.config["LOG_PAGE_SIZE"],
+                                              after=request.args.get("after"), before=request.args.get("before"))
+    
+    return render_template("admin_logs.html", logs=logs, prev_cursor=prev_cursor, next_cursor=next_cursor,
+                           filters=log_view_args(filters))
 
-            db.execute("""INSERT INTO admin_logs (user_id, action, photo_id, title) 
-                       VALUES 
-                       (?, ?, ?, ?)""",
-                       (session["user_id"], "DELETE", photo["id"], title))
-            db.commit()
-            return redirect(url_for("manage_photos"))
-        else:
-            message = "There is no photo"
 
+@app.route("/admin/logs/export")
+@admin_required
+@login_required
+def export_admin_logs():
+    return export_logs("admin_logs", log_view_filters(with_action=True))
 
-    # Updating form section 
-    photos = [dict(photo) for photo in db.execute("""SELECT * FROM photos""").fetchall()]
 
-    update_forms = {}
+@app.route("/admin/payment-logs", methods=["GET", "POST"])
+@admin_required
+@login_required
+def view_payment_logs():
+    db = get_db()
+    filters = log_view_filters(with_action=False)
 
-    # Pre-fill the form with existing values 
-    for photo in photos:
-        form = UpdatePhotoForm()
-        form.photo_id.data = photo["id"]
-        form.title.data = photo["title"]
-        form.description.data = photo["description"]
-        form.price_license.data = photo["price_license"]
-        form.price_print.data = photo["price_print"]
-        form.inventory.data = photo["inventory"]
+    logs, prev_cursor, next_cursor = log_page(db, "admin_payment_logs", filters, app.config["LOG_PAGE_SIZE"],
+                                              after=request.args.get("after"), before=request.args.get("before"))
+    
+    return render_template("admin_payment_logs.html", logs=logs, prev_cursor=prev_cursor, next_cursor=next_cursor,
+                           filters=log_view_args(filters))
 
-        
-        update_forms[photo["id"]] = form
 
-    if request.method == "POST":
-        photo_id = int(request.form["photo_id"])
-        form = dict(request.form)
-        
-        if form:
-            new_title = form['title']
-            new_description = form['description']
-            new_price_license = float(form['price_license'] or 0.00)
-            new_price_print = float(form['price_print'] or 0.00)
-            new_inventory = form['inventory']
-
-            db = get_db()
-            db.execute("""UPDATE photos 
-                           SET title = ?, description = ?, price_license = ?, price_print = ?, inventory = ? 
-                           WHERE id = ?""",
-                           (new_title, new_description, new_price_license, new_price_print, new_inventory, photo_id),)
-            db.commit()
+@app.route("/admin/payment-logs/export")
+@admin_required
+@login_required
+def export_payment_logs():
+    return export_logs("admin_payment_logs", log_view_filters(with_action=False))
 
-            db.execute("""INSERT INTO admin_logs (user_id, action, photo_id, title) 
-                           VALUES 
-                           (?, ?, ?, ?)""",(session["user_id"], "UPDATE", photo_id, new_title),)   
-            db.commit()
 
-            return redirect(url_for("manage_photos"))
+# the stats that are a level right now rather than a running total
+GAUGE_STATS = ("entries", "size", "vectors")
 
-    return render_template("admin_photos.html", photos=photos, delete_form=delete_form, update_forms=update_forms, message=message)
+def process_counters(gauges=False):
+    # the database, session and cache counters, or with gauges=True their
+    # levels, as (name, description, value)
+    sources = [("", "Database", database.get_stats()),
+               ("session_", "Session", sessions.get_stats()),
+               ("catalogue_cache_", "Catalogue cache", cache.stats()),
+               ("fragment_cache_", "Fragment cache", fragments.stats()),
+               ("similar_", "Similar photos", similar.index.stats()),
+               ("preview_", "Previews", previews.previews.stats())]
+    return [(f"{prefix}{name}", f"{description} {name.replace('_', ' ')}", value)
+            for prefix, description, stats in sources
+            for name, value in stats.items() if (name in GAUGE_STATS) == gauges]
 
 
-@app.route("/admin/logs", methods=["GET", "POST"])
+@app.route("/admin/duplicates")
 @admin_required
 @login_required
-def view_logs():
+def view_duplicates():
     db = get_db()
-
-    logs = db.execute("""SELECT * FROM admin_logs
-                      ORDER BY timestamp""").fetchall()
-    
-    return render_template("admin_logs.html", logs=logs)
+    page = max(request.args.get("page", 1, type=int), 1)
+    page_size = app.config["ADMIN_PAGE_SIZE"]
+    all_groups = duplicate_groups(db)
+    groups = []
+    # only the rows of the groups on this page are loaded
+    for group in all_groups[(page - 1) * page_size:page * page_size]:
+        groups.append([(table, db.execute(f"""SELECT * FROM {table} WHERE id = ?""", (photo_id,)).fetchone())
+                       for table, photo_id in group])
+    missing = sum(db.execute(f"""SELECT COUNT(*) FROM {table} WHERE phash IS NULL""").fetchone()[0]
+                  for table in ("photos", "limited_photos"))
+    return render_template("admin_duplicates.html", groups=groups, missing=missing, page=page,
+                           has_next=len(all_groups) > page * page_size)
+
+
+@app.route("/admin/metrics")
+@admin_required
+@login_required
+def view_metrics():
+    return render_template("admin_metrics.html", enabled=app.config["PROFILING"],
+                           endpoints=profiling.metrics.snapshot(),
+                           counters=process_counters() + process_counters(gauges=True))
 
 
-@app.route("/admin/payment-logs", methods=["GET", "POST"])
+@app.route("/admin/analytics")
 @admin_required
 @login_required
-def view_payment_logs():
-    db = get_db()
+def view_analytics():
+    return render_template("admin_analytics.html", **analytics.dashboard(get_db()))
 
-    logs = db.execute("""SELECT * FROM admin_payment_logs
-                      ORDER BY timestamp""").fetchall()
-    
-    return render_template("admin_payment_logs.html", logs=logs)
+
+def prometheus_metrics():
+    return Response(profiling.prometheus_text(process_counters(), process_counters(gauges=True)), mimetype="text/plain; version=0.0.4")
+
+@app.route("/admin/metrics/prometheus")
+def view_prometheus_metrics():
+    # a scraper can't log in, so it can send METRICS_TOKEN instead
+    token = app.config["METRICS_TOKEN"]
+    if token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return prometheus_metrics()
+    return admin_required(login_required(prometheus_metrics))()
 
 
 
@@ -360,13 +655,12 @@ def profile():
 
 
 @app.route("/gallery", methods=["GET", "POST"])
+@conditional_page
 def gallery():
     db = get_db()
-    themes = db.execute("""SELECT DISTINCT theme FROM photos""").fetchall()
-    
     theme_choices = [("All", "All Themes")]
-    for t in themes:
-        theme_choices.append((t["theme"], t["theme"]))
+    for theme in cache.photo_themes(db):
+        theme_choices.append((theme, theme))
 
     form = PhotoSearchForm()
     form.theme.choices = theme_choices  
@@ -392,43 +686,48 @@ def gallery():
     price_max = float(session.get("price_max", 10000) or 10000)
     filter_type = session.get("filter_type", "both")
 
-    query = "SELECT * FROM photos WHERE 1=1"
-    placeholders = []
-
-    if theme != "All":
-        query += " AND theme = ?"
-        placeholders.append(theme)
-
-    if filter_type == "license":
-        query += " AND price_license BETWEEN ? AND ?"
-        placeholders.append(price_min)
-        placeholders.append(price_max)
-    elif filter_type == "print":
-        query += " AND price_print BETWEEN ? AND ?"
-        placeholders.append(price_min)
-        placeholders.append(price_max)
-    else:
-        query += """ AND ( (price_license BETWEEN ? AND ?) AND (price_print BETWEEN ? AND ?) )"""
-        placeholders.append(price_min)
-        placeholders.append(price_max)
-        placeholders.append(price_min)
-        placeholders.append(price_max)
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+
+    def render_grid():
+        photos, prev_cursor, next_cursor = gallery_page(db, theme, price_min, price_max, filter_type,
+                                                        app.config["GALLERY_PAGE_SIZE"], after=after, before=before)
+        return render_template("gallery_grid.html", photos=photos, prev_cursor=prev_cursor, next_cursor=next_cursor)
 
-    photos = db.execute(query, placeholders).fetchall()
+    # repeat views of the same page with the same filters skip the query and the render
+    grid = cached_fragment("gallery", theme, price_min, price_max, filter_type, after, before, render=render_grid)
 
-    return render_template("gallery.html", form=form, photos=photos, selected_theme=form.theme.data)
+    return render_template("gallery.html", form=form, grid=grid, selected_theme=form.theme.data)
+
+
+@app.route("/search")
+def search():
+    query = request.args.get("q", "").strip()
+    photos = search_photos(get_db(), query, app.config["GALLERY_PAGE_SIZE"]) if query else []
+    return render_template("search.html", query=query, photos=photos)
+
+
+@app.route("/search/suggest")
+def search_suggest():
+    # type-ahead for the search box
+    photos = search_photos(get_db(), request.args.get("q", ""), limit=8)
+    return jsonify([{"id": photo["id"], "title": photo["title"]} for photo in photos])
 
 
 @app.route("/photo/<int:photo_id>", methods=["GET", "POST"])
 @login_required
+@conditional_page
 def photo_detail(photo_id):
     form = PurchaseForm()
     db = get_db()
     
-    photo = db.execute("""SELECT * FROM photos WHERE id = ?""", (photo_id,)).fetchone()
+    photo = cache.photo(db, photo_id)
+    # checkouts don't update the cached row's stock, see catalogue_cache.py
+    stock = db.execute("""SELECT inventory FROM photos WHERE id = ?""", (photo_id,)).fetchone()
     
-    if not photo:
+    if not photo or not stock:
         return redirect( url_for("gallery" ) )
+    inventory = stock["inventory"]
 
     if form.validate_on_submit(): 
         buy_license = form.buy_license.data
@@ -441,12 +740,12 @@ def photo_detail(photo_id):
             return redirect( url_for("photo_detail", photo_id=photo_id) )
 
         if buy_print:
-            if photo["inventory"] <= 0:
+            if inventory <= 0:
                 flash("Sorry, this print is out of stock", "error")
                 return redirect( url_for("photo_detail", photo_id=photo_id ))
             
-            if quantity > photo["inventory"]:
-                flash(f"Only {photo["inventory"]} prints available!", 'error')
+            if quantity > inventory:
+                flash(f"Only {inventory} prints available!", 'error')
                 return redirect( url_for("photo_detail", photo_id=photo_id ))
 
 
@@ -465,7 +764,60 @@ def photo_detail(photo_id):
         flash("Item added to cart!", "success")
         return redirect(url_for("cart"))
 
-    return render_template("photo_detail.html", photo=photo, form=form)
+    similar_strip = cached_fragment("similar", photo_id, render=lambda: render_template(
+        "similar_photos.html", photos=similar_photos(db, photo, app.config["SIMILAR_PHOTOS"], app.config["SIMILAR_SAME_THEME"])))
+    return render_template("photo_detail.html", photo=photo, inventory=inventory, form=form, similar=similar_strip)
+
+
+def send_preview(photo, size):
+    # size is a PREVIEW_SIZES name, with ".webp" on the end for a WebP
+    size, _, extension = size.partition(".")
+    extension = extension or "jpg"
+    if size not in PREVIEW_SIZES or extension not in PREVIEW_FORMATS or not photo:
+        abort(404)
+    # the URL always shows the same image, a photo's file never changes
+    return send_file(os.path.abspath(previews.previews.get(photo["file_path"], size, extension)),
+                     mimetype=PREVIEW_FORMATS[extension][1], conditional=True, max_age=24 * 3600)
+
+
+@app.route("/preview/<int:photo_id>/<size>")
+def preview(photo_id, size):
+    return send_preview(cache.photo(get_db(), photo_id), size)
+
+
+@app.route("/preview/limited/<int:photo_id>/<size>")
+def limited_preview(photo_id, size):
+    photo = get_db().execute("""SELECT file_path FROM limited_photos WHERE id = ?""", (photo_id,)).fetchone()
+    return send_preview(photo, size)
+
+
+@app.route("/download/<int:photo_id>")
+@login_required
+def download(photo_id):
+    db = get_db()
+    photo = cache.photo(db, photo_id)
+    if not photo:
+        return redirect(url_for("gallery"))
+    if not has_license(db, g.user, photo_id):
+        flash("Buy a license to download this photo", "error")
+        return redirect(url_for("photo_detail", photo_id=photo_id))
+
+    extension = photo["file_path"].rsplit(".", 1)[1]
+    # send_file streams from disk and answers Range requests, so a broken
+    # download can be resumed
+    response = send_file(os.path.abspath(photo["file_path"]), as_attachment=True, download_name=f"{photo['title']}.{extension}",
+                         conditional=True)
+    response.cache_control.private = True
+    return response
+
+
+def drop_missing_from_cart(photo_ids):
+    # photos deleted by an admin since they were added to the cart
+    for photo_id in photo_ids:
+        del session["cart"][photo_id]
+        session.modified = True
+    if photo_ids:
+        flash("Some photos in your cart are no longer available and were removed", "error")
 
 
 @app.route("/cart", methods=["GET", "POST"])
@@ -475,27 +827,11 @@ def cart():
         session["cart"] = {}
         session.modified = True
 
-    price = {}
-    names = {}
     db = get_db()
-    for photo_id in session["cart"]:
-        photo = db.execute("""SELECT * FROM photos WHERE id = ?;""", (photo_id,)).fetchone()
-
-        license = session["cart"][photo_id]["license"] 
-        print_qty = session["cart"][photo_id]["print_qty"]
-
-        total_price = 0.00
-        if license:
-            total_price += photo["price_license"]
-        if print_qty >= 1:
-            total_price += photo["price_print"] * print_qty
-        price[photo_id] = round(total_price, 2)
+    pricing = price_cart(db, session["cart"], load=cache.photos)
+    drop_missing_from_cart(pricing["missing"])
 
-        name = photo["title"]
-        names[photo_id] = name
-
-    total_price = sum(price.values())
-    return render_template("cart.html", cart=session["cart"], names=names, price=price, total_price=total_price)
+    return render_template("cart.html", cart=session["cart"], names=pricing["names"], price=pricing["price"], total_price=pricing["total_price"])
 
 
 @app.route("/remove_from_cart/<int:photo_id>", methods=["GET", "POST"])
@@ -512,60 +848,33 @@ def remove_from_cart(photo_id):
 @app.route("/checkout", methods=["GET", "POST"])
 @login_required
 def checkout():
-    if "cart" not in session:
+    if not session.get("cart"):
         return redirect(url_for("cart"))
 
     cart = session["cart"]
     db = get_db()
 
-    price = {}  # Store calculated prices per item
-    names = {}  # Store item titles
-    total_price = 0.00
+    pricing = price_cart(db, cart, load=cache.photos)
+    drop_missing_from_cart(pricing["missing"])
+    price = pricing["price"]
+    names = pricing["names"]
+    total_price = pricing["total_price"]
 
+    # early warning only, stock is reserved when the order is placed
     for photo_id in cart:
-        photo = db.execute("""SELECT * FROM photos 
-                           WHERE id = ?;""", (photo_id,)).fetchone()
-
-        license = cart[photo_id]["license"]
-        print_qty = cart[photo_id]["print_qty"]
-
-
-        item_price = 0.00
-        if license:
-            item_price += photo["price_license"]
-        if print_qty >= 1:
-            item_price += photo["price_print"] * print_qty
-        
-        price[photo_id] = round(item_price, 2)
-        names[photo_id] = photo["title"]
-        total_price += item_price  
-        total_price = round(total_price, 2)
-
-        if print_qty > 0:
-            if photo["inventory"] < print_qty:
-                flash(f"Not enough stock for {photo["title"]}!", 'error')
-                return redirect( url_for("cart" ))
-            
-            db.execute("""UPDATE photos SET inventory = inventory - ?
-                       WHERE id = ?""",(print_qty, photo_id) )
-            
-            db.commit()
-
-    db = get_db()
+        photo = pricing["photos"][photo_id]
+        if photo["inventory"] < cart[photo_id]["print_qty"]:
+            flash(f"Not enough stock for {photo["title"]}!", 'error')
+            return redirect( url_for("cart" ))
 
     form = CheckoutForm()
     
     if form.validate_on_submit():
-        user_id = session["user_id"]
-
-        db.execute("""INSERT INTO purchases (user_id, photo_id, license, print_qty, price_license, price_print, purchase_date)
-                   VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)""", (user_id, photo_id, license, print_qty, photo["price_license"] if license else 0, photo["price_print"] * print_qty))
-
-        db.execute(
-            """INSERT INTO admin_payment_logs (user_id, print_qty, total) 
-            VALUES (?,?, ?)""",(user_id, print_qty, total_price))
-        
-        db.commit()
+        try:
+            place_order(db, session["user_id"], cart)
+        except OutOfStock as e:
+            flash(str(e), 'error')
+            return redirect( url_for("cart" ))
 
         session["cart"] = {}  
         return redirect(url_for("order_confirmation"))
@@ -589,14 +898,11 @@ def limited_edition():
     photos = db.execute("""SELECT * FROM limited_photos 
                         WHERE end_date > DATETIME('now')""").fetchall()
     
-    bids = db.execute("""SELECT bids.user_id, bids.bid_amount, limited_photos.title 
-                      FROM bids 
-                      JOIN users ON bids.user_id = users.user_id 
-                      JOIN limited_photos ON bids.photo_id = limited_photos.id
-                      ORDER BY bids.bid_amount DESC 
-                      LIMIT 10""").fetchall()
+    highest_bids = {photo["id"]: bidding.highest_bid(db, photo["id"]) for photo in photos}
+
+    bids = bidding.leaderboard(db)
     
-    return render_template("limited_gallery.html", photos=photos, bids=bids)
+    return render_template("limited_gallery.html", photos=photos, bids=bids, highest_bids=highest_bids)
 
 
 @app.route('/bid/<int:photo_id>', methods=['GET', 'POST'])
@@ -612,52 +918,184 @@ def bid_on_photo(photo_id):
         flash("Photo not found!", "error")
         return redirect(url_for("limited_edition"))
 
-    highest_bid = db.execute("""SELECT MAX(bid_amount) FROM bids 
-                             WHERE photo_id = ?""", (photo_id,)).fetchone()[0] or photo["base_price"]
+    highest_bid = bidding.highest_bid(db, photo_id) or photo["base_price"]
 
     if form.validate_on_submit():
-        bid_amount = float(form.bid_amount.data)
-        if highest_bid is not None:
-            highest_bid = float(highest_bid)
+        result = bidding.place_bid(db, photo_id, session["user_id"], float(form.bid_amount.data))
+
+        if result == "accepted":
+            flash("Bid placed successfully!", "success")
+        elif result == "closed":
+            flash("This auction has ended!", "error")
         else:
-            float(photo["base_price"])
-        
-        if bid_amount <= highest_bid or bid_amount <= photo["base_price"]:
             flash("Your bid must be higher than the current highest bid!", "error")
-        else:
-            db.execute("""INSERT INTO bids (photo_id, user_id, bid_amount) 
-                       VALUES (?, ?, ?)""",(photo_id, session["user_id"], bid_amount))
-            
-            db.commit()
-            
-            flash("Bid placed successfully!", "success")
 
         return redirect( url_for("bid_on_photo", photo_id=photo_id) )
 
     return render_template("bid.html", form=form, photo=photo, highest_bid=highest_bid)
 
 
-@app.route("/process_bid", methods=["GET", "POST"])
-def process_bid():
+@app.route("/bids/stream")
+@login_required
+def bid_stream():
+    # Server-Sent Events: new bids (only for ?photo_id= if given) and
+    # leaderboard changes, pushed as they are accepted in this process
+    photo_id = request.args.get("photo_id", type=int)
+    last_id = request.headers.get("Last-Event-ID", type=int)
+
+    def stream():
+        yield "retry: 3000\n\n"
+        for events in live.bids.listen(last_id):
+            if not events:
+                yield ": keepalive\n\n"
+            for event_id, event, event_photo_id, payload in events:
+                if photo_id is None or event_photo_id in (None, photo_id):
+                    yield live.format_event(event_id, event, payload)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# # ----------------------- CLI COMMANDS -------------------------
+
+
+def run_backfill(db, rows, work, save, workers):
+    # work(*args) for every (table, photo_id, *args) in rows, in worker
+    # processes (see images.backfill_job), then save(db, table, photo_id,
+    # result) for each one that worked, committing every 500. Returns how
+    # many were saved.
+    jobs = [(table, photo_id, work, tuple(args)) for table, photo_id, *args in rows]
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for table, photo_id, result, error in pool.map(backfill_job, jobs, chunksize=8):
+            if error:
+                click.echo(f"{table} {photo_id}: {error}", err=True)
+                continue
+            save(db, table, photo_id, result)
+            done += 1
+            if done % 500 == 0:
+                db.commit()
+
+    db.commit()
+    return done
+
+
+@app.cli.command("backfill-derivatives")
+@click.option("--workers", default=None, type=int, help="Worker processes (default: one per CPU)")
+@click.option("--all", "redo_all", is_flag=True, help="Regenerate rows that already have derivatives")
+def backfill_derivatives(workers, redo_all):
+    """Generate thumbnail JPEG and WebP images for existing photos."""
     db = get_db()
+    folder = app.config["DERIVATIVE_FOLDER"]
 
-    ended_bids = db.execute("""SELECT limited_photos.id AS photo_id, limited_photos.title, limited_photos.file_path, 
-                            bids.user_id, MAX(bids.bid_amount) AS highest_bid
-                            FROM limited_photos
-                            JOIN bids ON limited_photos.id = bids.photo_id
-                            WHERE limited_photos.end_date < DATETIME('now')
-                            GROUP BY limited_photos.id;""").fetchall()
+    rows = []
+    for table in ("photos", "limited_photos"):
+        query = f"""SELECT id, file_path FROM {table}"""
+        if not redo_all:
+            query += " WHERE thumb_path IS NULL"
+        for row in db.execute(query).fetchall():
+            rows.append((table, row["id"], row["file_path"], folder))
 
-    for bid in ended_bids:
-        db.execute("""INSERT INTO admin_payment_logs (user_id, print_qty, amount_paid)
-                   VALUES (?, ?, ?)""", (bid["user_id"], 1, bid["highest_bid"]))
+    done = run_backfill(db, rows, make_derivatives, save_derivatives, workers)
+    click.echo(f"Generated derivatives for {done} of {len(rows)} photos")
 
-        db.commit()
 
-        db.execute("""DELETE FROM limited_photos 
-                   WHERE id = ?""", (bid["photo_id"],))
-        
-        db.commit() 
+@app.cli.command("backfill-metadata")
+@click.option("--workers", default=None, type=int, help="Worker processes (default: one per CPU)")
+@click.option("--all", "redo_all", is_flag=True, help="Read again the rows that already have metadata")
+def backfill_metadata(workers, redo_all):
+    """Read the size, EXIF details and perceptual hash of existing photos."""
+    db = get_db()
 
-    return "Bids processed!"
+    rows = []
+    for table in ("photos", "limited_photos"):
+        query = f"""SELECT id, file_path FROM {table}"""
+        if not redo_all:
+            query += " WHERE phash IS NULL"
+        for row in db.execute(query).fetchall():
+            rows.append((table, row["id"], row["file_path"]))
 
+    done = run_backfill(db, rows, read_metadata, save_metadata, workers)
+    click.echo(f"Read metadata for {done} of {len(rows)} photos")
+
+
+@app.cli.command("backfill-similar")
+@click.option("--workers", default=None, type=int, help="Worker processes (default: one per CPU)")
+def backfill_similar(workers):
+    """Add the colour vectors of existing photos for "similar photos"."""
+    db = get_db()
+    rows = [("photos", row["id"], row["file_path"]) for row in db.execute("""SELECT id, file_path FROM photos
+                                                                            WHERE id NOT IN (SELECT photo_id FROM photo_vectors)""").fetchall()]
+
+    def save_vector(db, table, photo_id, vector):
+        # the vector file is appended to under the write lock, see similar.py
+        if not db.in_transaction:
+            db.execute("""BEGIN IMMEDIATE""")
+        add_vector(db, photo_id, vector)
+
+    done = run_backfill(db, rows, photo_vector, save_vector, workers)
+    click.echo(f"Added vectors for {done} of {len(rows)} photos")
+
+
+@app.cli.command("import-photos")
+@click.argument("source", type=click.Path(exists=True))
+@click.option("--manifest", type=click.Path(exists=True, dir_okay=False), help="CSV or JSON manifest (default: manifest.csv/.json in SOURCE)")
+@click.option("--workers", default=None, type=int, help="Worker processes (default: one per CPU)")
+@click.option("--batch-size", default=200, help="Photos inserted per transaction")
+@click.option("--user", "user_id", default="cli", help="User recorded in the admin logs")
+def import_photos_command(source, manifest, workers, batch_size, user_id):
+    """Import photos from a ZIP file or folder with a manifest."""
+    if manifest:
+        with open(manifest, "rb") as stream:
+            manifest = read_manifest(manifest, stream)
+    try:
+        report = import_photos(get_db(), source, manifest or None, user_id, app.config,
+                               workers=workers, batch_size=batch_size, progress=click.echo)
+    except ImportFailed as e:
+        raise click.ClickException(str(e))
+
+    for name, error in report["errors"]:
+        click.echo(f"{name}: {error}", err=True)
+    click.echo(f"Imported {report['imported']} photos in {report['seconds']:.1f}s "
+               f"({report['photos_per_second']:.1f} photos/s), {len(report['errors'])} errors")
+
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics():
+    """Recompute the sales rollups behind /admin/analytics from the purchase history."""
+    db = get_db()
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        counts = analytics.rebuild(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    click.echo(f"Rebuilt sales for {counts['days']} days, {counts['themes']} themes and {counts['photos']} photos")
+
+
+@app.cli.command("settle-auctions")
+def settle_auctions():
+    """Settle every auction that has ended, then exit."""
+    db = get_db()
+    owner = f"cli:{os.getpid()}"
+    if not settlement.acquire_lease(db, owner, app.config.get("SETTLEMENT_LEASE_TTL", 60)):
+        click.echo("Another worker is settling auctions, try again later")
+        return
+    try:
+        settled = settlement.settle_due(db, app.config.get("SETTLEMENT_BATCH_SIZE", 100))
+    finally:
+        settlement.release_lease(db, owner)
+    click.echo(f"Settled {len(settled)} auctions")
+
+
+@app.cli.command("run-settlement")
+def run_settlement():
+    """Run the auction settlement scheduler in the foreground."""
+    scheduler = settlement.start_scheduler(app.config)
+    click.echo("Settling auctions as they end, Ctrl+C to stop")
+    try:
+        while scheduler.is_alive():
+            scheduler.join(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -0,0 +1,122 @@
+from datetime import datetime
+import csv
+import io
+import json
+
+# Columns shown and exported for each log table
+LOG_COLUMNS = {
+    "admin_logs": ["id", "user_id", "action", "photo_id", "title", "timestamp"],
+    "admin_payment_logs": ["id", "user_id", "print_qty", "total", "timestamp"],
+}
+
+
+def parse_day(text):
+    # "YYYY-MM-DD" from a date input, None if empty or not a date
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+def log_filters(user_id=None, action=None, date_from=None, date_to=None):
+    # Builds the WHERE clause for the log views and exports. The dates are
+    # whole days and both ends are included.
+    query = ""
+    placeholders = []
+
+    if user_id:
+        query += " AND user_id = ?"
+        placeholders.append(user_id)
+    if action:
+        query += " AND action = ?"
+        placeholders.append(action)
+    if date_from:
+        query += " AND timestamp >= ?"
+        placeholders.append(date_from)
+    if date_to:
+        query += " AND timestamp < DATE(?, '+1 day')"
+        placeholders.append(date_to)
+
+    return query, placeholders
+
+
+def make_cursor(row):
+    return f"{row['timestamp']}|{row['id']}"
+
+
+def parse_cursor(cursor):
+    # (timestamp, id) or None for a missing or mangled cursor
+    try:
+        timestamp, row_id = cursor.rsplit("|", 1)
+        return timestamp, int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def log_page(db, table, filters, page_size, after=None, before=None):
+    # Newest first, keyset paginated on (timestamp, id) like gallery_page():
+    # the (timestamp), (user_id, timestamp) and (action, timestamp) indexes
+    # hand rows over already in order, so a page reads page_size + 1 rows
+    # however long the log is. after and before are cursors from a previous
+    # page. Returns (rows, previous cursor, next cursor).
+    # table is always one of LOG_COLUMNS, never user input.
+    query, placeholders = log_filters(**filters)
+    columns = ", ".join(LOG_COLUMNS[table])
+    after, before = parse_cursor(after), parse_cursor(before)
+
+    if before is not None:
+        # rows newer than the first one on the page we came from
+        query += " AND (timestamp, id) > (?, ?) ORDER BY timestamp, id LIMIT ?"
+        placeholders += list(before)
+    else:
+        if after is not None:
+            query += " AND (timestamp, id) < (?, ?)"
+            placeholders += list(after)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+
+    # one extra row tells us whether there is another page
+    placeholders.append(page_size + 1)
+    rows = db.execute(f"""SELECT {columns} FROM {table} WHERE 1=1""" + query, placeholders).fetchall()
+
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if before is not None:
+        rows.reverse()
+        prev_cursor = make_cursor(rows[0]) if more else None
+        next_cursor = make_cursor(rows[-1]) if rows else None
+    else:
+        prev_cursor = make_cursor(rows[0]) if rows and after is not None else None
+        next_cursor = make_cursor(rows[-1]) if more else None
+
+    return rows, prev_cursor, next_cursor
+
+
+def log_rows(db, table, filters, batch_size=1000):
+    # Every matching row, newest first, fetched batch_size at a time with the
+    # same keyset as log_page(), so memory stays flat and no read transaction
+    # stays open for the whole export
+    cursor = None
+    while True:
+        rows, _, cursor = log_page(db, table, filters, batch_size, after=cursor)
+        yield from rows
+        if cursor is None:
+            return
+
+
+def export_csv(rows, columns):
+    # a header line, then one chunk of text per row
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(rows, columns):
+    for row in rows:
+        yield json.dumps({column: row[column] for column in columns}) + "\n"
@@ -0,0 +1,41 @@
+# Cart pricing with one query per line against the batched price_cart().
+#
+#   python -m benchmarks.bench_cart
+import os
+
+from benchmarks.common import make_db, seed_photos, measure
+from pricing import line_price, price_cart
+
+CART_SIZES = [1, 50, 500]
+
+
+def per_line(db, cart):
+    # what cart() and checkout() used to do
+    price = {}
+    for photo_id, item in cart.items():
+        photo = db.execute("""SELECT * FROM photos WHERE id = ?;""", (photo_id,)).fetchone()
+        price[photo_id] = line_price(photo, item["license"], item["print_qty"])
+    return round(sum(price.values()), 2)
+
+
+def main():
+    db, path = make_db()
+    try:
+        seed_photos(db, 10_000)
+        print(f"{'lines':>6} {'per line':>10} {'batched':>10}   (p50 ms)")
+        for size in CART_SIZES:
+            # spread the lines over the table like a real cart would be
+            cart = {photo_id: {"license": True, "print_qty": 2}
+                    for photo_id in range(1, 10_000, 10_000 // size)[:size]}
+            assert per_line(db, cart) == price_cart(db, cart)["total_price"]
+
+            old, _ = measure(lambda: per_line(db, cart))
+            new, _ = measure(lambda: price_cart(db, cart))
+            print(f"{size:>6} {old:>10.3f} {new:>10.3f}")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Near-duplicate lookups as the catalogue grows.
+#
+#   python -m benchmarks.bench_duplicates
+#
+# Gives every photo a random hash, with one in 50 a copy of an earlier one a
+# few bits off, then times near_duplicates() for one upload, the
+# rebuild_duplicates() backfill and duplicate_groups() behind
+# /admin/duplicates. "scan" is the same lookup done by reading every hash,
+# for comparison.
+import os
+import random
+
+from benchmarks.common import make_db, seed_photos, measure
+import image_metadata
+
+SIZES = [5_000, 20_000, 100_000]
+COPY_EVERY = 50
+
+
+def random_hashes(rng, start, count):
+    hashes = []
+    for i in range(start, start + count):
+        if i % COPY_EVERY == COPY_EVERY - 1 and hashes:
+            phash = hashes[rng.randrange(len(hashes))][0]
+            for bit in rng.sample(range(64), rng.randint(1, image_metadata.MAX_DISTANCE)):
+                phash ^= 1 << bit
+        else:
+            phash = rng.getrandbits(64)
+        hashes.append((image_metadata.to_signed(phash & ((1 << 64) - 1)), i + 1))
+    return hashes
+
+
+def scan(db, phash):
+    return [row["id"] for row in db.execute("""SELECT id, phash FROM photos WHERE phash IS NOT NULL""")
+            if image_metadata.distance(phash, row["phash"]) <= image_metadata.MAX_DISTANCE]
+
+
+def main():
+    db, path = make_db()
+    rng = random.Random(1)
+    seeded = 0
+    print(f"{'photos':>8} {'lookup':>9} {'scan':>9} {'rebuild':>9} {'groups':>9} {'pairs':>7}   (p50 ms)")
+    try:
+        for size in SIZES:
+            seed_photos(db, size - seeded, start=seeded)
+            db.executemany("""UPDATE photos SET phash = ? WHERE id = ?""", random_hashes(rng, seeded, size - seeded))
+            db.commit()
+            seeded = size
+
+            queries = [image_metadata.to_signed(rng.getrandbits(64)) for _ in range(50)]
+            lookup, _ = measure(lambda: image_metadata.near_duplicates(db, queries[rng.randrange(50)]))
+            scanned, _ = measure(lambda: scan(db, queries[0]), repeat=5)
+            rebuild, _ = measure(lambda: image_metadata.rebuild_duplicates(db), repeat=1)
+            db.commit()
+            groups, _ = measure(lambda: image_metadata.duplicate_groups(db), repeat=10)
+            pairs = db.execute("""SELECT COUNT(*) FROM duplicate_pairs""").fetchone()[0]
+            print(f"{size:>8} {lookup:>9.3f} {scanned:>9.3f} {rebuild:>9.1f} {groups:>9.3f} {pairs:>7}")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Gallery page latency as the catalogue grows.
+#
+#   python -m benchmarks.bench_gallery
+#
+# Keyset pages should stay flat from 1k to 200k photos, for wide and narrow
+# price ranges alike. The old unpaginated query is shown for comparison.
+import os
+
+from benchmarks.common import make_db, seed_photos, measure
+from catalogue import gallery_filters, gallery_page
+
+SIZES = [1_000, 10_000, 100_000, 200_000]
+PAGE_SIZE = 24
+
+FILTERS = [
+    ("All, both prices", ("All", 0, 10000, "both")),
+    ("Theme, license range", ("Seascapes", 20, 150, "license")),
+    ("Theme, print range", ("Urban Life", 0, 100, "print")),
+    # seed_photos() prices licenses 0-199 and prints 0-299
+    ("All, empty license", ("All", 500, 600, "license")),
+    ("All, narrow print", ("All", 42, 42, "print")),
+    ("Theme, narrow license", ("Seascapes", 42, 43, "license")),
+    ("All, narrow both", ("All", 42, 42, "both")),
+    ("All, mid license", ("All", 40, 45, "license")),
+]
+
+
+def unpaginated(db, theme, price_min, price_max, filter_type):
+    query, placeholders = gallery_filters(theme, price_min, price_max, filter_type)
+    return db.execute("SELECT * FROM photos WHERE 1=1" + query, placeholders).fetchall()
+
+
+def main():
+    db, path = make_db()
+    seeded = 0
+    print(f"{'photos':>8}  {'filter':<22} {'first page':>11} {'deep page':>11} {'unpaginated':>12}   (p50 ms)")
+    try:
+        for size in SIZES:
+            seed_photos(db, size - seeded, start=seeded)
+            seeded = size
+            db.execute("ANALYZE")
+
+            for label, args in FILTERS:
+                deep_cursor = int(size * 0.9)
+                first, _ = measure(lambda: gallery_page(db, *args, PAGE_SIZE))
+                deep, _ = measure(lambda: gallery_page(db, *args, PAGE_SIZE, after=deep_cursor))
+                full, _ = measure(lambda: unpaginated(db, *args), repeat=5)
+                print(f"{size:>8}  {label:<22} {first:>11.3f} {deep:>11.3f} {full:>12.3f}")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Leaderboard reads with a long bid history.
+#
+#   python -m benchmarks.bench_leaderboard [bids]
+#
+# Seeds 1M bids spread over 2000 auctions, all but 10 of them settled, then
+# compares the old sort over every bid with reading bid_leaderboard.
+import os
+import random
+import sys
+
+import bidding
+from benchmarks.common import make_db, measure
+
+AUCTIONS = 2000
+OPEN_AUCTIONS = 10
+USERS = 500
+
+
+def full_sort(db):
+    # what limited_edition() used to run on every view
+    return db.execute("""SELECT bids.user_id, bids.bid_amount, limited_photos.title 
+                      FROM bids 
+                      JOIN users ON bids.user_id = users.user_id 
+                      JOIN limited_photos ON bids.photo_id = limited_photos.id
+                      ORDER BY bids.bid_amount DESC 
+                      LIMIT 10""").fetchall()
+
+
+def main(bid_count=1_000_000):
+    db, path = make_db()
+    rng = random.Random(1)
+    try:
+        db.executemany("""INSERT INTO users (user_id, password) VALUES (?, 'x')""",
+                       [(f"user{i}",) for i in range(USERS)])
+        db.executemany("""INSERT INTO limited_photos (title, description, file_path, base_price, end_date, settled_at)
+                       VALUES (?, 'd', 'static/uploads/x.jpg', 10, DATETIME('now', ?), ?)""",
+                       [(f"Auction {i}", "+1 day" if i < OPEN_AUCTIONS else "-1 day",
+                         None if i < OPEN_AUCTIONS else "2025-01-01 00:00:00") for i in range(AUCTIONS)])
+        db.executemany("""INSERT INTO bids (photo_id, user_id, bid_amount) VALUES (?, ?, ?)""",
+                       ((rng.randint(1, AUCTIONS), f"user{rng.randrange(USERS)}", round(rng.uniform(10, 5000), 2))
+                        for _ in range(bid_count)))
+        db.commit()
+
+        rebuild, _ = measure(lambda: bidding.rebuild_leaderboard(db), repeat=5)
+        db.commit()
+        old, _ = measure(lambda: full_sort(db), repeat=5)
+        new, _ = measure(lambda: bidding.leaderboard(db))
+
+        def bid():
+            current = bidding.highest_bid(db, 1) or 10
+            assert bidding.place_bid(db, 1, "user1", current + 1) == "accepted"
+        place, _ = measure(bid, repeat=200)
+
+        print(f"{bid_count} bids over {AUCTIONS} auctions ({OPEN_AUCTIONS} open), p50 ms")
+        print(f"  old full sort per view      {old:10.3f}")
+        print(f"  bid_leaderboard read        {new:10.3f}")
+        print(f"  place_bid incl. leaderboard {place:10.3f}")
+        print(f"  rebuild (on settlement)     {rebuild:10.3f}")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+# Full-text search against the old LIKE scan.
+#
+#   python -m benchmarks.bench_search [photos]
+#
+# Seeds 100k photos whose titles and descriptions are drawn from a random
+# vocabulary, then times a few queries both ways.
+import os
+import random
+import sys
+
+from benchmarks.common import make_db, measure, THEMES
+from catalogue import search_photos
+
+VOCABULARY = 5000
+QUERIES = ["sunset", "old harbour", "mou", "portrait window light"]
+
+
+def like_scan(db, text):
+    # what a naive search box would run: every word in any column
+    where, params = [], []
+    for word in text.split():
+        where.append("(title LIKE ? OR description LIKE ? OR theme LIKE ?)")
+        params += [f"%{word}%"] * 3
+    return db.execute(f"""SELECT * FROM photos WHERE {" AND ".join(where)} LIMIT 24""", params).fetchall()
+
+
+def main(count=100_000):
+    db, path = make_db()
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(VOCABULARY)]
+    # make sure the sample queries hit something
+    words += ["sunset", "old", "harbour", "mountain", "portrait", "window", "light"]
+    try:
+        db.executemany("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory)
+                       VALUES (?, ?, ?, 'static/uploads/x.jpg', 10, 20, 30)""",
+                       ((" ".join(rng.choices(words, k=3)), " ".join(rng.choices(words, k=20)), THEMES[i % len(THEMES)])
+                        for i in range(count)))
+        db.commit()
+
+        print(f"{count} photos")
+        for query in QUERIES:
+            fts = measure(lambda: search_photos(db, query), repeat=20)
+            like = measure(lambda: like_scan(db, query), repeat=5)
+            print(f"{query!r:26} fts p50 {fts[0]:7.2f} ms p95 {fts[1]:7.2f} ms | "
+                  f"like p50 {like[0]:7.2f} ms p95 {like[1]:7.2f} ms")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,66 @@
+# Requests/sec with each session backend.
+#
+#   python -m benchmarks.bench_sessions [requests]
+#
+# Runs against a scratch copy of app.db. "read" requests only look at the
+# session (a logged-in page), "write" requests change it (adding to the cart).
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+scratch = tempfile.mkdtemp()
+shutil.copy(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.db"), scratch)
+os.environ["PHOTO_CENTRE_DB"] = os.path.join(scratch, "app.db")
+
+from werkzeug.security import generate_password_hash
+
+import sessions
+from app import app
+from database import get_db
+
+
+def rate(client, count, method, url, data=None):
+    started = time.perf_counter()
+    for _ in range(count):
+        response = getattr(client, method)(url, data=data)
+        assert response.status_code in (200, 302), response.status_code
+    return count / (time.perf_counter() - started)
+
+
+def main(count=2000):
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        db = get_db()
+        db.execute("""INSERT OR REPLACE INTO users (user_id, password) VALUES ('bench', ?)""",
+                   (generate_password_hash("bench"),))
+        db.commit()
+
+    backends = {
+        "filesystem": None,
+        "sqlite": sessions.SqliteSessionInterface(),
+        "memory": sessions.MemorySessionInterface(),
+    }
+    print(f"{'backend':<12} {'read req/s':>11} {'write req/s':>12}")
+    try:
+        for name, interface in backends.items():
+            if interface is None:
+                app.config["SESSION_BACKEND"] = "filesystem"
+                app.config["SESSION_FILE_DIR"] = os.path.join(scratch, "flask_session")
+                sessions.init_app(app)
+            else:
+                app.session_interface = interface
+
+            client = app.test_client()
+            client.post("/login", data={"user_id": "bench", "password": "bench"})
+            reads = rate(client, count, "get", "/order_confirmation")
+            writes = rate(client, count // 4, "post", "/photo/1",
+                          {"buy_license": "y", "buy_print": "y", "quantity": "1"})
+            print(f"{name:<12} {reads:>11.0f} {writes:>12.0f}")
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
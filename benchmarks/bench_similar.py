@@ -0,0 +1,68 @@
+# "Similar photos" query latency as the catalogue grows.
+#
+#   python -m benchmarks.bench_similar
+#
+# Appends random colour vectors for 10k, then 100k photos through
+# similar.add_vector() (the same path an upload takes), then times one
+# lookup, one limited to a theme and a batch of 32 scored in one matrix
+# product. "refresh" is the first query after the append, which maps the
+# longer file and reads only the new photo_vectors rows. Needs numpy.
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import make_db, seed_photos, measure, THEMES
+import similar
+
+SIZES = [10_000, 100_000]
+SHOWN = similar.SIMILAR_SHOWN
+BATCH = 32
+
+
+def random_vector(rng):
+    # a few dominant colours, like a real photo's histogram
+    counts = np.zeros(similar.DIMENSIONS, dtype=np.float32)
+    counts[rng.integers(0, similar.DIMENSIONS, 6)] = rng.random(6) * 100
+    counts += rng.random(similar.DIMENSIONS) * 2
+    vector = np.sqrt(counts)
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tobytes()
+
+
+def main():
+    db, path = make_db()
+    handle, similar.index.path = tempfile.mkstemp(suffix=".f32")
+    os.close(handle)
+    rng = np.random.default_rng(1)
+    seeded = 0
+    print(f"{'photos':>8} {'append/s':>9} {'refresh':>9} {'one':>9} {'theme':>9} {'batch 32':>9}   (p50 ms)")
+    try:
+        for size in SIZES:
+            seed_photos(db, size - seeded, start=seeded)
+            start = time.perf_counter()
+            db.execute("""BEGIN IMMEDIATE""")
+            for photo_id in range(seeded + 1, size + 1):
+                similar.add_vector(db, photo_id, random_vector(rng))
+            db.commit()
+            appended = (size - seeded) / (time.perf_counter() - start)
+            seeded = size
+
+            start = time.perf_counter()
+            similar.index.nearest(db, [1], SHOWN)
+            refresh = (time.perf_counter() - start) * 1000
+
+            ids = random.Random(size).sample(range(1, size + 1), BATCH)
+            one, _ = measure(lambda: similar.index.nearest(db, ids[:1], SHOWN))
+            theme, _ = measure(lambda: similar.index.nearest(db, ids[:1], SHOWN, THEMES[0]))
+            batch, _ = measure(lambda: similar.index.nearest(db, ids, SHOWN), repeat=20)
+            print(f"{size:>8} {appended:>9.0f} {refresh:>9.3f} {one:>9.3f} {theme:>9.3f} {batch:>9.3f}")
+    finally:
+        db.close()
+        os.remove(path)
+        os.remove(similar.index.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from database import apply_upgrades
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "schema.sql")
+
+THEMES = ["Black & White", "Landscapes", "Seascapes", "Urban Life", "People & Portraits", "Adventure & Action"]
+
+
+def make_db(path=None):
+    # A fresh database from schema.sql plus every upgrade, so benchmarks never
+    # touch app.db
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
+    db.executescript(open(SCHEMA).read())
+    apply_upgrades(db)
+    return db, path
+
+
+def seed_photos(db, count, start=0):
+    rows = []
+    for i in range(start, start + count):
+        rows.append((f"Photo {i}", f"Description of photo {i}", THEMES[i % len(THEMES)],
+                     f"static/uploads/photo-{i}.jpg", float(i % 200), float((i * 7) % 300), 30))
+    db.executemany("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    db.commit()
+
+
+def measure(fn, repeat=50):
+    # Runs fn repeat times and returns (p50, p95) in milliseconds
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def percentile(sorted_timings, fraction):
+    # nearest-rank percentile of an already sorted list
+    if not sorted_timings:
+        return 0.0
+    return sorted_timings[min(len(sorted_timings) - 1, int(len(sorted_timings) * fraction))]
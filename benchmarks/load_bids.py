@@ -0,0 +1,77 @@
+# Thousands of concurrent bids on one auction.
+#
+#   python -m benchmarks.load_bids [processes] [threads per process] [bids per thread]
+#
+# Each process stands in for a worker with its own bid cache, each thread
+# for a request with its own connection. Afterwards the accepted bids, in
+# the order they were inserted, must be strictly increasing.
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+import bidding
+from benchmarks.common import make_db
+from database import connect
+
+
+def worker(path, threads, bids):
+    counts = {"accepted": 0, "too_low": 0, "closed": 0}
+    counts_lock = threading.Lock()
+
+    def bidder(n):
+        db = connect(database=path)
+        rng = random.Random(os.getpid() * 1000 + n)
+        try:
+            for _ in range(bids):
+                current = bidding.highest_bid(db, 1) or 10.0
+                amount = round(current + rng.uniform(0.01, 2.0), 2)
+                result = bidding.place_bid(db, 1, f"bidder{os.getpid()}-{n}", amount)
+                with counts_lock:
+                    counts[result] += 1
+        finally:
+            db.close()
+
+    pool = [threading.Thread(target=bidder, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return counts
+
+
+def main(processes=4, threads=16, bids=50):
+    setup, path = make_db()
+    setup.execute("""INSERT INTO limited_photos (title, description, file_path, base_price, end_date)
+                  VALUES ('Auction', 'Load test', 'static/uploads/auction.jpg', 10.0, DATETIME('now', '+1 day'))""")
+    setup.commit()
+    setup.close()
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(worker, [(path, threads, bids)] * processes)
+    elapsed = time.perf_counter() - started
+
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    db = connect(database=path)
+    amounts = [row[0] for row in db.execute("""SELECT bid_amount FROM bids WHERE photo_id = 1 ORDER BY id""")]
+    db.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    attempted = processes * threads * bids
+    monotonic = all(earlier < later for earlier, later in zip(amounts, amounts[1:]))
+    print(f"{attempted} bids from {processes}x{threads} bidders in {elapsed:.2f}s ({attempted / elapsed:.0f} bids/s)")
+    print(f"accepted {totals['accepted']}, too low {totals['too_low']}, closed {totals['closed']}")
+    print(f"rows in bids {len(amounts)}, strictly increasing: {monotonic}")
+
+    ok = monotonic and len(amounts) == totals["accepted"]
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*[int(arg) for arg in sys.argv[1:]]) else 1)
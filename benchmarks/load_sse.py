@@ -0,0 +1,62 @@
+# Push latency of the live bid stream with thousands of subscribers.
+#
+#   python -m benchmarks.load_sse [subscribers] [events] [ms between events]
+#
+# Each subscriber is a thread running the same loop as /bids/stream, minus the
+# socket. The publisher sends events at a fixed interval, each stamped with the
+# time it was published, and every subscriber records how long it took to
+# format it.
+import statistics
+import sys
+import threading
+import time
+
+import live
+
+
+def main(subscribers=2000, events=50, interval=50):
+    broadcaster = live.Broadcaster()
+    latencies = []
+    latencies_lock = threading.Lock()
+    ready = threading.Barrier(subscribers + 1)
+
+    def subscriber():
+        seen = []
+        listener = broadcaster.listen(keepalive=1)
+        ready.wait()
+        received = 0
+        for pending in listener:
+            for event_id, event, photo_id, payload in pending:
+                live.format_event(event_id, event, payload)
+                seen.append(time.perf_counter() - float(payload))
+                received += 1
+            if received >= events:
+                break
+        with latencies_lock:
+            latencies.extend(seen)
+
+    threads = [threading.Thread(target=subscriber, daemon=True) for _ in range(subscribers)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    # listen() only registers its starting id when first iterated
+    time.sleep(0.5)
+
+    started = time.perf_counter()
+    for _ in range(events):
+        broadcaster.publish("bid", time.perf_counter(), photo_id=1)
+        time.sleep(interval / 1000)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = [latency * 1000 for latency in latencies]
+    print(f"{subscribers} subscribers x {events} events = {len(ms)} deliveries in {elapsed:.2f}s")
+    print(f"push latency p50 {statistics.median(ms):.2f} ms, p95 {ms[int(len(ms) * 0.95)]:.2f} ms, "
+          f"p99 {ms[int(len(ms) * 0.99)]:.2f} ms, max {ms[-1]:.2f} ms")
+    return len(ms) == subscribers * events
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*[int(arg) for arg in sys.argv[1:]]) else 1)
@@ -0,0 +1,300 @@
+# Latency and throughput per route, through Flask's test client or over HTTP.
+#
+#   python -m benchmarks.run [--mode client|http] [--url URL] [--threads N]
+#                            [--requests N] [--routes gallery,cart,...]
+#                            [--db PATH] [--out FILE] [--compare FILE]
+#
+# Seeds a temporary database (see benchmarks/seed.py, or pass --db to use an
+# existing one) and starts the app on it. In client mode every thread drives
+# the app through its own test client; in http mode the app is served by
+# werkzeug's threaded server on a local port (or --url points at a server
+# that is already running on the same database) and every thread is a
+# keep-alive HTTP connection. Each thread logs in as its own bench user.
+#
+# Prints p50/p95/p99 latency and requests per second per route and writes
+# the numbers to benchmarks/results/<time>-<mode>.json. --compare reads an
+# earlier result file and marks routes whose p95 got more than 10% worse.
+import argparse
+import http.client
+import http.cookies
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+from benchmarks.common import percentile
+from benchmarks.seed import PASSWORD, open_db, seed
+import database
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+ROUTES = ["gallery", "photo_detail", "cart", "checkout", "bid"]
+REGRESSION = 1.10
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class ClientDriver:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        response = self.client.open(path, method=method, data=form)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpDriver:
+    # one keep-alive connection with its own cookies, like one browser tab
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+        self.cookies = http.cookies.SimpleCookie()
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={morsel.value}" for name, morsel in self.cookies.items())
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                data = response.read().decode("utf-8", "replace")
+                break
+            except (http.client.HTTPException, OSError):
+                # the server closed the keep-alive connection, retry once on a new one
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all("Set-Cookie") or []:
+            self.cookies.load(header)
+        return response.status, data
+
+
+class VirtualUser:
+    def __init__(self, driver, user_id, data, rng):
+        self.driver = driver
+        self.user_id = user_id
+        self.data = data
+        self.rng = rng
+        self.bid_amount = 1000.0 + rng.random()
+
+    def csrf(self, path):
+        status, body = self.driver.request("GET", path)
+        match = CSRF_TOKEN.search(body)
+        return match.group(1) if match else ""
+
+    def login(self):
+        token = self.csrf("/login")
+        status, body = self.driver.request("POST", "/login",
+                                           {"csrf_token": token, "user_id": self.user_id, "password": PASSWORD})
+        if status != 302:
+            raise RuntimeError(f"could not log in as {self.user_id}")
+
+    def add_to_cart(self):
+        photo_id = self.rng.choice(self.data["photos"])
+        token = self.csrf(f"/photo/{photo_id}")
+        self.driver.request("POST", f"/photo/{photo_id}",
+                            {"csrf_token": token, "buy_license": "y", "quantity": "1"})
+
+    # Each route returns (method, path, form) for the request that is timed,
+    # after doing any untimed setup it needs.
+
+    def gallery(self):
+        return "GET", "/gallery", None
+
+    def photo_detail(self):
+        return "GET", f"/photo/{self.rng.choice(self.data['photos'])}", None
+
+    def cart(self):
+        return "GET", "/cart", None
+
+    def checkout(self):
+        self.add_to_cart()
+        token = self.csrf("/checkout")
+        return "POST", "/checkout", {"csrf_token": token, "name": "Bench", "shipping": "1 Bench Street", "payment": "card"}
+
+    def bid(self):
+        auction_id = self.rng.choice(self.data["auctions"])
+        token = self.csrf(f"/bid/{auction_id}")
+        # keeps going up, so most bids are accepted
+        self.bid_amount += self.rng.uniform(1, 50)
+        return "POST", f"/bid/{auction_id}", {"csrf_token": token, "bid_amount": f"{self.bid_amount:.2f}"}
+
+
+def run_route(route, make_driver, data, threads, requests):
+    timings = []
+    errors = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(threads + 1)
+
+    def user(n):
+        rng = random.Random(n)
+        visitor = VirtualUser(make_driver(), data["users"][n % len(data["users"])], data, rng)
+        try:
+            visitor.login()
+            # cart and checkout need something in the cart
+            if route in ("cart", "checkout"):
+                for _ in range(3):
+                    visitor.add_to_cart()
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+        start_line.wait()
+
+        mine = []
+        for _ in range(requests // threads):
+            try:
+                method, path, form = getattr(visitor, route)()
+                start = time.perf_counter()
+                status, body = visitor.driver.request(method, path, form)
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            if status >= 400:
+                with lock:
+                    errors.append(f"HTTP {status} for {method} {path}")
+                continue
+            mine.append(elapsed * 1000)
+        with lock:
+            timings.extend(mine)
+
+    pool = [threading.Thread(target=user, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    start_line.wait()
+    started = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "errors": len(errors),
+        "first_errors": errors[:5],
+        "p50_ms": percentile(timings, 0.50),
+        "p95_ms": percentile(timings, 0.95),
+        "p99_ms": percentile(timings, 0.99),
+        "requests_per_second": len(timings) / wall if wall else 0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, previous):
+    print(f"\ncompared with {previous['meta']['time']} ({previous['meta'].get('commit')})")
+    regressed = False
+    for route, now in results["routes"].items():
+        before = previous["routes"].get(route)
+        if not before or not before["p95_ms"]:
+            continue
+        ratio = now["p95_ms"] / before["p95_ms"]
+        flag = "REGRESSION" if ratio > REGRESSION else ""
+        regressed = regressed or bool(flag)
+        print(f"{route:14} p95 {before['p95_ms']:8.2f} -> {now['p95_ms']:8.2f} ms ({ratio - 1:+.0%}) {flag}")
+    return not regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-route latency and throughput")
+    parser.add_argument("--mode", choices=["client", "http"], default="client")
+    parser.add_argument("--url", help="an app that is already running, for --mode http")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400, help="timed requests per route")
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--db", help="database to use instead of a freshly seeded one")
+    parser.add_argument("--photos", type=int, default=5000)
+    parser.add_argument("--out", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    db, path = open_db(args.db)
+    if args.db is None:
+        seed(db, users=max(args.threads, 50), photos=args.photos)
+    data = {
+        "users": [row[0] for row in db.execute("""SELECT user_id FROM users WHERE user_id LIKE 'bench%'""")],
+        "photos": [row[0] for row in db.execute("""SELECT id FROM photos WHERE inventory > 1000 LIMIT 1000""")],
+        "auctions": [row[0] for row in db.execute("""SELECT id FROM limited_photos
+                                                      WHERE settled_at IS NULL AND end_date > DATETIME('now')""")],
+    }
+    db.close()
+    if not data["users"] or not data["photos"] or not data["auctions"]:
+        sys.exit("The database needs bench users, photos and open auctions, see benchmarks/seed.py")
+
+    # the app and any worker processes it starts use this file
+    os.environ["PHOTO_CENTRE_DB"] = database.DATABASE = path
+    server = None
+    if args.url:
+        make_driver = lambda: HttpDriver(args.url)
+    else:
+        from app import app
+        if args.mode == "client":
+            make_driver = lambda: ClientDriver(app)
+        else:
+            from werkzeug.serving import make_server
+            # one log line per request would swamp the results
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            server = make_server("127.0.0.1", 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}"
+            make_driver = lambda: HttpDriver(url)
+
+    results = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "mode": args.mode,
+                 "url": args.url, "threads": args.threads, "requests": args.requests, "db": args.db,
+                 "photos": len(data["photos"])},
+        "routes": {},
+    }
+    try:
+        print(f"{args.mode} mode, {args.threads} threads, {args.requests} requests per route")
+        for route in args.routes.split(","):
+            stats = run_route(route, make_driver, data, args.threads, args.requests)
+            results["routes"][route] = stats
+            print(f"{route:14} p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  "
+                  f"p99 {stats['p99_ms']:8.2f} ms  {stats['requests_per_second']:8.1f} req/s  errors {stats['errors']}")
+            for error in stats["first_errors"]:
+                print("   ", error)
+    finally:
+        if server:
+            server.shutdown()
+        if args.db is None:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    out = args.out or os.path.join(RESULTS, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.mode}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            return compare(results, json.load(file))
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,112 @@
+# Fills a database with synthetic users, themes, photos, purchases and bids.
+#
+#   python -m benchmarks.seed [--db PATH] [--users N] [--themes N] [--photos N]
+#                             [--purchases N] [--auctions N] [--bids N]
+#
+# Without --db a new temporary database is made from schema.sql, and so is a
+# --db that doesn't exist yet. An existing --db (say a copy of app.db) is
+# upgraded and the rows are added to what is already there. Every seeded user is called bench<n> with the password
+# "bench", so load tests can log in as them. The same --seed gives the same
+# data.
+import argparse
+import os
+import random
+
+from benchmarks.common import make_db, THEMES
+from database import apply_upgrades, connect
+import analytics
+from werkzeug.security import generate_password_hash
+
+PASSWORD = "bench"
+
+DEFAULTS = {"users": 200, "themes": 0, "photos": 5000, "purchases": 20000, "auctions": 50, "bids": 20000}
+
+WORDS = ["harbour", "sunset", "mountain", "street", "portrait", "forest", "river", "city", "winter", "summer",
+         "light", "shadow", "morning", "night", "storm", "coast", "bridge", "market", "window", "field"]
+
+
+def seed(db, users=200, themes=0, photos=5000, purchases=20000, auctions=50, bids=20000, seed=1):
+    rng = random.Random(seed)
+
+    # one hash for everybody, the password hash is slow on purpose
+    password = generate_password_hash(PASSWORD)
+    first_user = db.execute("""SELECT COUNT(*) FROM users WHERE user_id LIKE 'bench%'""").fetchone()[0]
+    user_ids = [f"bench{n}" for n in range(first_user, first_user + users)]
+    db.executemany("""INSERT INTO users (user_id, password, is_admin) VALUES (?, ?, 0)""",
+                   [(user_id, password) for user_id in user_ids])
+    user_ids = [row[0] for row in db.execute("""SELECT user_id FROM users WHERE user_id LIKE 'bench%'""")]
+
+    first_theme = db.execute("""SELECT COUNT(*) FROM themes""").fetchone()[0]
+    db.executemany("""INSERT INTO themes (name) VALUES (?)""",
+                   [(f"Theme {n}",) for n in range(first_theme, first_theme + themes)])
+    theme_names = [row[0] for row in db.execute("""SELECT name FROM themes""")] or THEMES
+
+    # titles are unique, so they carry the row number
+    first_photo = db.execute("""SELECT COALESCE(MAX(id), 0) FROM photos""").fetchone()[0] + 1
+    db.executemany("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                   ((f"{' '.join(rng.choices(WORDS, k=2)).title()} {n}", " ".join(rng.choices(WORDS, k=12)),
+                     rng.choice(theme_names), f"static/uploads/bench-{n}.jpg",
+                     round(rng.uniform(5, 200), 2), round(rng.uniform(10, 300), 2), rng.randint(0, 1000000))
+                    for n in range(first_photo, first_photo + photos)))
+    photo_ids = [row[0] for row in db.execute("""SELECT id FROM photos""")]
+
+    if photo_ids and user_ids:
+        db.executemany("""INSERT INTO purchases (user_id, photo_id, license, print_qty, price_license, price_print, purchase_date)
+                       VALUES (?, ?, ?, ?, ?, ?, DATETIME('now', ?))""",
+                       ((rng.choice(user_ids), rng.choice(photo_ids), rng.random() < 0.5, rng.randint(0, 3),
+                         round(rng.uniform(5, 200), 2), round(rng.uniform(10, 300), 2), f"-{rng.randint(0, 365 * 24)} hours")
+                        for _ in range(purchases)))
+
+    db.executemany("""INSERT INTO limited_photos (title, description, file_path, base_price, end_date)
+                   VALUES (?, ?, ?, ?, DATETIME('now', '+7 days'))""",
+                   ((f"Auction {n}", " ".join(rng.choices(WORDS, k=12)), f"static/uploads/bench-auction-{n}.jpg",
+                     round(rng.uniform(10, 100), 2)) for n in range(auctions)))
+    auction_ids = [row[0] for row in db.execute("""SELECT id FROM limited_photos WHERE settled_at IS NULL""")]
+
+    if auction_ids and user_ids:
+        # increasing amounts per auction, as the bidding engine would accept them
+        highest = {auction_id: 10.0 for auction_id in auction_ids}
+        rows = []
+        for _ in range(bids):
+            auction_id = rng.choice(auction_ids)
+            highest[auction_id] = round(highest[auction_id] + rng.uniform(0.5, 5), 2)
+            rows.append((auction_id, rng.choice(user_ids), highest[auction_id]))
+        db.executemany("""INSERT INTO bids (photo_id, user_id, bid_amount) VALUES (?, ?, ?)""", rows)
+
+    # the purchases above bypassed place_order(), so the sales rollups are
+    # recomputed from scratch
+    analytics.rebuild(db)
+    db.commit()
+    return {"users": user_ids, "photos": photo_ids, "auctions": auction_ids}
+
+
+def open_db(path=None):
+    if path is None or not os.path.exists(path):
+        return make_db(path)
+    db = connect(database=path)
+    apply_upgrades(db)
+    return db, path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fill a database with synthetic data")
+    parser.add_argument("--db", help="database to add to (default: a new temporary one)")
+    for name, default in DEFAULTS.items():
+        parser.add_argument(f"--{name}", type=int, default=default)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    db, path = open_db(args.db)
+    try:
+        seed(db, **{name: getattr(args, name) for name in DEFAULTS}, seed=args.seed)
+        counts = {table: db.execute(f"""SELECT COUNT(*) FROM {table}""").fetchone()[0]
+                  for table in ("users", "themes", "photos", "purchases", "limited_photos", "bids")}
+    finally:
+        db.close()
+    print(path)
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Many buyers checking out the same low-stock print at once.
+#
+#   python -m benchmarks.stress_checkout [buyers] [stock]
+#
+# Every buyer has its own connection, as it would in a separate request. The
+# run fails if more prints are sold than were in stock or if the purchases,
+# payment logs and inventory disagree.
+import os
+import sys
+import threading
+import time
+
+from benchmarks.common import make_db, seed_photos
+from database import connect
+from orders import OutOfStock, place_order
+
+
+def main(buyers=200, stock=5):
+    setup, path = make_db()
+    seed_photos(setup, 1)
+    setup.execute("""UPDATE photos SET inventory = ? WHERE id = 1""", (stock,))
+    setup.commit()
+    setup.close()
+
+    results = {"sold": 0, "out_of_stock": 0, "errors": []}
+    results_lock = threading.Lock()
+    start_line = threading.Barrier(buyers)
+
+    def buyer(n):
+        db = connect(database=path)
+        cart = {1: {"license": False, "print_qty": 1}}
+        start_line.wait()
+        try:
+            place_order(db, f"buyer{n}", cart)
+            outcome = "sold"
+        except OutOfStock:
+            outcome = "out_of_stock"
+        except Exception as e:
+            outcome = None
+            with results_lock:
+                results["errors"].append(repr(e))
+        finally:
+            db.close()
+        if outcome:
+            with results_lock:
+                results[outcome] += 1
+
+    threads = [threading.Thread(target=buyer, args=(n,)) for n in range(buyers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    db = connect(database=path)
+    inventory = db.execute("""SELECT inventory FROM photos WHERE id = 1""").fetchone()[0]
+    purchases = db.execute("""SELECT COALESCE(SUM(print_qty), 0) FROM purchases WHERE photo_id = 1""").fetchone()[0]
+    payments = db.execute("""SELECT COUNT(*) FROM admin_payment_logs""").fetchone()[0]
+    db.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    print(f"{buyers} buyers, {stock} in stock, {elapsed:.2f}s")
+    print(f"sold {results['sold']}, turned away {results['out_of_stock']}, errors {len(results['errors'])}")
+    print(f"inventory left {inventory}, prints in purchases {purchases}, payment logs {payments}")
+    for error in results["errors"][:5]:
+        print("  ", error)
+
+    ok = (results["sold"] == stock == purchases == payments and inventory == 0
+          and results["sold"] + results["out_of_stock"] == buyers)
+    print("OK" if ok else "FAILED")
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(*[int(arg) for arg in sys.argv[1:]]) else 1)
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import live
+
+# Seconds a cached highest bid is shown before it is re-read. Other worker
+# processes take bids too, so the cache can fall behind them.
+CACHE_TTL = 1.0
+
+# photo_id -> (highest bid or None, time it was read)
+_highest = {}
+
+# one lock per auction, so bids on the same photo in this process queue up
+# here instead of fighting over SQLite's write lock
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock_for(photo_id):
+    with _locks_lock:
+        if photo_id not in _locks:
+            _locks[photo_id] = threading.Lock()
+        return _locks[photo_id]
+
+
+def _refresh(db, photo_id):
+    # cold start: one seek on the (photo_id, bid_amount DESC) index
+    row = db.execute("""SELECT bid_amount FROM bids WHERE photo_id = ?
+                     ORDER BY bid_amount DESC LIMIT 1""", (photo_id,)).fetchone()
+    amount = row["bid_amount"] if row else None
+    _highest[photo_id] = (amount, time.monotonic())
+    return amount
+
+
+def highest_bid(db, photo_id):
+    cached = _highest.get(photo_id)
+    if cached and time.monotonic() - cached[1] < CACHE_TTL:
+        return cached[0]
+    return _refresh(db, photo_id)
+
+
+def place_bid(db, photo_id, user_id, amount):
+    # Returns "accepted", "too_low" or "closed".
+    #
+    # The check and the insert are the same statement, so two bidders can't
+    # both beat the same highest bid: SQLite runs one write at a time and the
+    # second INSERT sees the first one's row.
+    with _lock_for(photo_id):
+        # bids only ever go up, so even an old cached value is safe to reject against
+        cached = _highest.get(photo_id)
+        if cached and cached[0] is not None and amount <= cached[0]:
+            return "too_low"
+
+        inserted = db.execute("""INSERT INTO bids (photo_id, user_id, bid_amount)
+                              SELECT id, ?, ? FROM limited_photos
+                              WHERE id = ? AND end_date > DATETIME('now')
+                              AND ? > MAX(base_price, COALESCE((SELECT MAX(bid_amount) FROM bids WHERE photo_id = ?), 0))""",
+                              (user_id, amount, photo_id, amount, photo_id))
+        ranked = inserted.rowcount and add_to_leaderboard(db, inserted.lastrowid)
+        db.commit()
+
+        if inserted.rowcount:
+            _highest[photo_id] = (amount, time.monotonic())
+            live.bids.publish("bid", {"photo_id": photo_id, "user_id": user_id, "amount": amount}, photo_id)
+            if ranked:
+                live.bids.publish("leaderboard", [dict(row) for row in leaderboard(db)])
+            return "accepted"
+
+        _refresh(db, photo_id)
+
+    ended = db.execute("""SELECT 1 FROM limited_photos
+                       WHERE id = ? AND end_date > DATETIME('now')""", (photo_id,)).fetchone() is None
+    return "closed" if ended else "too_low"
+
+
+# The top LEADERBOARD_SIZE bids on auctions that are still open are kept in
+# bid_leaderboard, so the limited edition page reads a handful of rows
+# instead of sorting the whole bid history. Accepted bids are added in the
+# same transaction that stores them, settled auctions are taken out by
+# rebuild_leaderboard().
+LEADERBOARD_SIZE = 10
+
+def leaderboard(db):
+    return db.execute("""SELECT user_id, title, bid_amount FROM bid_leaderboard
+                      ORDER BY bid_amount DESC, bid_id""").fetchall()
+
+
+def add_to_leaderboard(db, bid_id):
+    # Returns True if the bid made it onto the leaderboard
+    db.execute("""INSERT INTO bid_leaderboard (bid_id, photo_id, user_id, title, bid_amount)
+               SELECT bids.id, bids.photo_id, bids.user_id, limited_photos.title, bids.bid_amount
+               FROM bids JOIN limited_photos ON bids.photo_id = limited_photos.id
+               WHERE bids.id = ?""", (bid_id,))
+    # the table never holds more than LEADERBOARD_SIZE + 1 rows, so this is cheap
+    db.execute("""DELETE FROM bid_leaderboard WHERE bid_id NOT IN
+               (SELECT bid_id FROM bid_leaderboard ORDER BY bid_amount DESC, bid_id LIMIT ?)""",
+               (LEADERBOARD_SIZE,))
+    return db.execute("""SELECT 1 FROM bid_leaderboard WHERE bid_id = ?""", (bid_id,)).fetchone() is not None
+
+
+def rebuild_leaderboard(db):
+    # Top bids of each open auction come straight off the (photo_id,
+    # bid_amount DESC) index, so this costs open auctions x LEADERBOARD_SIZE
+    # rows however long the bid history is. Runs in the caller's transaction
+    # if there is one.
+    rows = []
+    for auction in db.execute("""SELECT id, title FROM limited_photos WHERE settled_at IS NULL""").fetchall():
+        for bid in db.execute("""SELECT id, user_id, bid_amount FROM bids WHERE photo_id = ?
+                              ORDER BY bid_amount DESC LIMIT ?""", (auction["id"], LEADERBOARD_SIZE)):
+            rows.append((bid["id"], auction["id"], bid["user_id"], auction["title"], bid["bid_amount"]))
+
+    rows.sort(key=lambda row: (-row[4], row[0]))
+    db.execute("""DELETE FROM bid_leaderboard""")
+    db.executemany("""INSERT INTO bid_leaderboard (bid_id, photo_id, user_id, title, bid_amount)
+                   VALUES (?, ?, ?, ?, ?)""", rows[:LEADERBOARD_SIZE])
+
+
+def forget(photo_id):
+    # for auctions that have been settled and removed
+    _highest.pop(photo_id, None)
+    with _locks_lock:
+        _locks.pop(photo_id, None)
@@ -0,0 +1,213 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import json
+import os
+import sqlite3
+import time
+import zipfile
+
+
+from images import make_derivatives, save_derivatives, backfill_job
+from image_metadata import METADATA_COLUMNS, read_metadata, record_duplicates, UnreadableImage
+from similar import add_vector, photo_vector
+from storage import stage_upload
+
+MANIFEST_NAMES = ("manifest.csv", "manifest.json")
+FIELDS = ("file", "title", "description", "theme", "price_license", "price_print", "inventory")
+
+
+# Imports a whole catalogue from a ZIP file or a folder of images plus a
+# manifest with one entry per photo (file, title, description, theme,
+# price_license, price_print, inventory), as CSV or a JSON list.
+#
+# Worker processes copy each image into the content store (see storage.py)
+# and check that Pillow can read it, the photos and admin_logs rows are then
+# inserted batch_size at a time in one transaction each, and finally the
+# workers make the derivatives. Images are streamed from the archive to disk
+# one chunk at a time, so 10k photos never need to fit in memory.
+
+
+class ImportFailed(Exception):
+    pass
+
+
+def read_manifest(name, stream):
+    # stream is a binary file object, name tells CSV and JSON apart
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    if name.lower().endswith(".json"):
+        return json.load(text)
+    return list(csv.DictReader(text))
+
+
+def find_manifest(source):
+    # a manifest.csv or manifest.json at the top of the ZIP or folder
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = set(archive.namelist())
+            for name in MANIFEST_NAMES:
+                if name in names:
+                    with archive.open(name) as stream:
+                        return read_manifest(name, stream)
+    else:
+        for name in MANIFEST_NAMES:
+            path = os.path.join(source, name)
+            if os.path.exists(path):
+                with open(path, "rb") as stream:
+                    return read_manifest(name, stream)
+    raise ImportFailed("No manifest given and none found in the source")
+
+
+def check_entry(entry, themes, extensions):
+    # Returns the row values for the photos table, or raises ValueError
+    missing = [field for field in FIELDS if field not in entry or entry[field] in (None, "")]
+    for field in missing:
+        # prices are optional, like on the upload form
+        if field not in ("price_license", "price_print"):
+            raise ValueError(f"missing {field}")
+
+    name = str(entry["file"])
+    if "." not in name or name.rsplit(".", 1)[1].lower() not in extensions:
+        raise ValueError("not a jpg or png")
+    if entry["theme"] not in themes:
+        raise ValueError(f"unknown theme {entry['theme']!r}")
+
+    price_license = float(entry.get("price_license") or 0)
+    price_print = float(entry.get("price_print") or 0)
+    inventory = int(entry["inventory"])
+    if price_license < 0 or price_print < 0 or inventory < 0:
+        raise ValueError("prices and inventory can't be negative")
+
+    return (str(entry["title"]), str(entry["description"]), entry["theme"], price_license, price_print, inventory)
+
+
+# one open ZipFile per worker process, reading the central directory of a
+# big archive for every image would make the import quadratic
+_archives = {}
+
+def open_image(source, name):
+    if os.path.isdir(source):
+        path = os.path.realpath(os.path.join(source, name))
+        if not path.startswith(os.path.realpath(source) + os.sep):
+            raise ValueError("file is outside the import folder")
+        return open(path, "rb")
+    if source not in _archives:
+        _archives[source] = zipfile.ZipFile(source)
+    return _archives[source].open(name)
+
+
+def stage_one(job):
+    # Runs in a worker process like images.backfill_job(): plain values and
+    # StagedUpload (which pickles fine) in and out. Returns ((StagedUpload, metadata,
+    # colour vector), None) or (None, error message).
+    source, name, folder = job
+    try:
+        with open_image(source, name) as stream:
+            upload = stage_upload(stream, folder, name.rsplit(".", 1)[1])
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        return None, str(e)
+
+    # reading the metadata decodes the image, so it also checks it is one
+    try:
+        metadata = read_metadata(upload.temp_path)
+        vector = photo_vector(upload.temp_path)
+    except UnreadableImage:
+        upload.discard()
+        return None, "not a readable image"
+    return (upload, metadata, vector), None
+
+
+def insert_batch(db, batch, user_id, errors):
+    # batch is a list of (file name, row values followed by the
+    # METADATA_COLUMNS values, StagedUpload, colour vector). Like upload(),
+    # files are moved into place while the write lock is held. A row that
+    # breaks a constraint (titles are unique) only fails that statement, so it
+    # is reported in errors and the rest of the batch goes ahead.
+    inserted = []
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        for name, values, upload, vector in batch:
+            title, description, theme, price_license, price_print, inventory, *metadata = values
+            try:
+                photo_id = db.execute("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, inventory,
+                                                             width, height, camera, lens, taken_at, phash)
+                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                      (title, description, theme, upload.file_path, price_license, price_print, inventory, *metadata)).lastrowid
+            except sqlite3.IntegrityError as e:
+                errors.append((name, str(e)))
+                upload.discard()
+                continue
+            upload.commit()
+            record_duplicates(db, "photos", photo_id, dict(zip(METADATA_COLUMNS, metadata))["phash"])
+            add_vector(db, photo_id, vector)
+            inserted.append((photo_id, title, upload.file_path))
+        db.executemany("""INSERT INTO admin_logs (user_id, action, photo_id, title) VALUES (?, 'IMPORT', ?, ?)""",
+                       [(user_id, photo_id, title) for photo_id, title, file_path in inserted])
+        db.commit()
+    except Exception:
+        db.rollback()
+        for name, values, upload, vector in batch:
+            upload.discard()
+        raise
+    return inserted
+
+
+def import_photos(db, source, manifest, user_id, config, workers=None, batch_size=200, progress=None):
+    # source is a ZIP file or folder, manifest a list of entries (None to look
+    # for one in the source). Returns a report dict: imported, errors as
+    # [(file, message)], seconds and photos_per_second.
+    # progress, if given, is called with a line of text after each batch.
+    start = time.perf_counter()
+    if manifest is None:
+        manifest = find_manifest(source)
+    if not isinstance(manifest, list):
+        raise ImportFailed("The manifest must be a list of photos")
+
+    themes = {row["name"] for row in db.execute("""SELECT name FROM themes""")}
+    errors = []
+    entries = []
+    for entry in manifest:
+        try:
+            entries.append((str(entry["file"]), check_entry(entry, themes, config["ALLOWED_EXTENSIONS"])))
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            errors.append((entry.get("file", "?") if isinstance(entry, dict) else "?", str(e)))
+
+    folder = config["UPLOAD_FOLDER"]
+    derivative_folder = config["DERIVATIVE_FOLDER"]
+    imported = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        jobs = [(source, name, folder) for name, values in entries]
+        for (name, values), (staged, error) in zip(entries, pool.map(stage_one, jobs, chunksize=8)):
+            if error:
+                errors.append((name, error))
+                continue
+            upload, metadata, vector = staged
+            batch.append((name, values + tuple(metadata[column] for column in METADATA_COLUMNS), upload, vector))
+            if len(batch) == batch_size:
+                imported += insert_batch(db, batch, user_id, errors)
+                batch = []
+                if progress:
+                    progress(f"{len(imported)} photos imported")
+        if batch:
+            imported += insert_batch(db, batch, user_id, errors)
+
+        jobs = [("photos", photo_id, make_derivatives, (file_path, derivative_folder)) for photo_id, title, file_path in imported]
+        for done, (table, photo_id, paths, error) in enumerate(pool.map(backfill_job, jobs, chunksize=8), 1):
+            if error:
+                errors.append((f"photo {photo_id}", f"derivatives: {error}"))
+            else:
+                save_derivatives(db, table, photo_id, paths)
+            if done % batch_size == 0:
+                db.commit()
+                if progress:
+                    progress(f"{done} of {len(jobs)} derivatives made")
+        db.commit()
+
+    seconds = time.perf_counter() - start
+    return {
+        "imported": len(imported),
+        "errors": errors,
+        "seconds": seconds,
+        "photos_per_second": len(imported) / seconds if seconds else 0,
+    }
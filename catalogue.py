@@ -0,0 +1,204 @@
+from datetime import datetime
+import random
+import re
+
+
+def gallery_filters(theme, price_min, price_max, filter_type):
+    # Builds the WHERE clause shared by every gallery query from the
+    # PhotoSearchForm values stored in the session
+    query = ""
+    placeholders = []
+
+    if theme != "All":
+        query += " AND theme = ?"
+        placeholders.append(theme)
+
+    if filter_type == "license":
+        query += " AND price_license BETWEEN ? AND ?"
+        placeholders.append(price_min)
+        placeholders.append(price_max)
+    elif filter_type == "print":
+        query += " AND price_print BETWEEN ? AND ?"
+        placeholders.append(price_min)
+        placeholders.append(price_max)
+    else:
+        query += """ AND ( (price_license BETWEEN ? AND ?) AND (price_print BETWEEN ? AND ?) )"""
+        placeholders.append(price_min)
+        placeholders.append(price_max)
+        placeholders.append(price_min)
+        placeholders.append(price_max)
+
+    return query, placeholders
+
+
+# A price range with fewer photos than this is read through its price index
+# and sorted by id. A wider one is cheaper found by walking ids in order and
+# checking prices, as a page fills up before long.
+PRICE_INDEX_LIMIT = 2000
+PRICE_INDEXES = {"price_license": "idx_photos_price_license", "price_print": "idx_photos_price_print"}
+
+
+def gallery_index(db, theme, price_min, price_max, filter_type):
+    # The INDEXED BY clause for a gallery query. Counting at most
+    # PRICE_INDEX_LIMIT entries of each price range decides which plan
+    # stays cheap, SQLite can't tell a narrow range from a wide one itself.
+    if filter_type == "license":
+        columns = ["price_license"]
+    elif filter_type == "print":
+        columns = ["price_print"]
+    else:
+        columns = ["price_license", "price_print"]
+
+    narrowest = None
+    for column in columns:
+        count = db.execute(f"""SELECT COUNT(*) FROM
+                           (SELECT 1 FROM photos INDEXED BY {PRICE_INDEXES[column]}
+                            WHERE {column} BETWEEN ? AND ? LIMIT ?)""",
+                           (price_min, price_max, PRICE_INDEX_LIMIT)).fetchone()[0]
+        if count < PRICE_INDEX_LIMIT and (narrowest is None or count < narrowest[0]):
+            narrowest = (count, PRICE_INDEXES[column])
+
+    if narrowest:
+        return f"INDEXED BY {narrowest[1]}"
+    if theme != "All":
+        return "INDEXED BY idx_photos_theme_id_prices"
+    # rowid order, never a price index sorted whole
+    return "NOT INDEXED"
+
+
+def gallery_page(db, theme, price_min, price_max, filter_type, page_size, after=None, before=None):
+    query, placeholders = gallery_filters(theme, price_min, price_max, filter_type)
+    return photo_page(db, query, placeholders, page_size, after, before,
+                      index=gallery_index(db, theme, price_min, price_max, filter_type))
+
+
+def admin_photo_page(db, text, theme, page_size, after=None, before=None):
+    # The admin photo grid: every photo, or those in a theme and/or matching
+    # the search text (through photos_fts, like search_photos()), in id order
+    query = ""
+    placeholders = []
+    if theme:
+        query += " AND theme = ?"
+        placeholders.append(theme)
+    match = fts_query(text or "")
+    if match:
+        query += " AND id IN (SELECT rowid FROM photos_fts WHERE photos_fts MATCH ?)"
+        placeholders.append(match)
+    return photo_page(db, query, placeholders, page_size, after, before)
+
+
+def photo_page(db, query, placeholders, page_size, after=None, before=None, index=""):
+    # Keyset pagination on photos.id: instead of OFFSET, each page starts from
+    # the last id of the previous one, so a page costs the same wherever it is
+    # in the catalogue. query is " AND ..." conditions for placeholders, index
+    # an optional INDEXED BY / NOT INDEXED clause.
+    # Returns (photos, previous cursor, next cursor); a cursor is None when
+    # there is no page in that direction.
+    placeholders = list(placeholders)
+
+    if before is not None:
+        query += " AND id < ? ORDER BY id DESC LIMIT ?"
+        placeholders.append(before)
+    else:
+        if after is not None:
+            query += " AND id > ?"
+            placeholders.append(after)
+        query += " ORDER BY id LIMIT ?"
+
+    # one extra row tells us whether there is another page
+    placeholders.append(page_size + 1)
+    photos = db.execute(f"SELECT * FROM photos {index} WHERE 1=1" + query, placeholders).fetchall()
+
+    more = len(photos) > page_size
+    photos = photos[:page_size]
+
+    if before is not None:
+        photos.reverse()
+        prev_cursor = photos[0]["id"] if more else None
+        next_cursor = photos[-1]["id"] if photos else None
+    else:
+        prev_cursor = photos[0]["id"] if photos and after is not None else None
+        next_cursor = photos[-1]["id"] if more else None
+
+    return photos, prev_cursor, next_cursor
+
+
+def random_photo(db, rng=random, attempts=5):
+    # MIN/MAX on the rowid and a lookup by id are both index seeks, so this
+    # costs the same whatever the size of the catalogue. Deleted photos leave
+    # gaps in the ids: a miss is retried a few times to keep the pick uniform,
+    # then we settle for the next id after the last guess.
+    # separate subqueries: SQLite only turns MIN/MAX into a single seek when
+    # there is one of them per SELECT
+    low, high = db.execute("""SELECT (SELECT MIN(id) FROM photos), (SELECT MAX(id) FROM photos)""").fetchone()
+    if low is None:
+        return None
+
+    for _ in range(attempts):
+        guess = rng.randint(low, high)
+        photo = db.execute("""SELECT * FROM photos WHERE id = ?""", (guess,)).fetchone()
+        if photo:
+            return photo
+
+    return db.execute("""SELECT * FROM photos WHERE id >= ? ORDER BY id LIMIT 1""", (guess,)).fetchone()
+
+
+# hour -> photo id, so every request in the same hour skips the random pick
+_photo_of_the_hour = {}
+
+def photo_of_the_hour(db, now=None):
+    hour = (now or datetime.now()).strftime("%Y-%m-%d %H")
+
+    photo_id = _photo_of_the_hour.get(hour)
+    if photo_id is not None:
+        photo = db.execute("""SELECT * FROM photos WHERE id = ?""", (photo_id,)).fetchone()
+        if photo:
+            return photo
+
+    # seeding with the hour means every worker process picks the same photo
+    photo = random_photo(db, rng=random.Random(hour))
+    _photo_of_the_hour.clear()
+    if photo:
+        _photo_of_the_hour[hour] = photo["id"]
+    return photo
+
+
+def featured_auction(db):
+    # the open auction that ends first, for the home page
+    return db.execute("""SELECT * FROM limited_photos
+                      WHERE end_date > CURRENT_TIMESTAMP
+                      ORDER BY end_date ASC
+                      LIMIT 1""").fetchone()
+
+
+def fts_query(text):
+    # Turns whatever was typed into a list of quoted terms that must all
+    # match, so quotes, brackets or words like NOT/OR can't break the FTS5
+    # query syntax. The last term matches as a prefix, for type-ahead.
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def search_photos(db, text, limit=24):
+    # Best matches first (bm25, see the rank setting on photos_fts). Ranking
+    # happens in the subquery so FTS5 only hands over the top rows.
+    query = fts_query(text)
+    if query is None:
+        return []
+    return db.execute("""SELECT photos.* FROM
+                      (SELECT rowid, rank FROM photos_fts WHERE photos_fts MATCH ? ORDER BY rank LIMIT ?) AS hits
+                      JOIN photos ON photos.id = hits.rowid
+                      ORDER BY hits.rank""", (query, limit)).fetchall()
+
+
+def catalogue_version(db):
+    # (version, changed_at as a unix timestamp), see the catalogue_version table
+    row = db.execute("""SELECT version, changed_at FROM catalogue_version WHERE id = 1""").fetchone()
+    return row["version"], row["changed_at"]
+
+
+def photos_version(db):
+    # see the photos_version table
+    return db.execute("""SELECT version FROM photos_version WHERE id = 1""").fetchone()["version"]
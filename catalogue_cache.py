@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from flask import g
+import threading
+
+from catalogue import photos_version
+from pricing import load_photos
+
+# A read-through cache of the themes and photo rows that the home page,
+# gallery, photo pages and cart read on almost every request.
+#
+# Every worker process keeps its own copy. The first lookup of each request
+# reads the photos_version row (one primary key lookup); if any worker has
+# changed photos, themes or auctions since, the triggers will have bumped it
+# and this process drops everything it holds. No message between workers is
+# needed. A row loaded by a request that started before the version moved is
+# not kept, as it may be older than the change.
+#
+# Bids and checkouts taking prints out of stock don't bump it, so a busy
+# auction or shop doesn't empty the cache every few requests. The inventory
+# in a cached row can be higher than the real one: the photo page reads it
+# afresh, and place_order() checks the stock for real.
+#
+# Cached rows are sqlite3.Row objects, which can't be changed, so they are
+# safe to hand to several threads at once. Code that has to see the row as
+# it is right now (place_order() inside its write transaction) reads the
+# database directly instead.
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_MISSING = object()
+
+
+class CatalogueCache:
+    def __init__(self, max_entries=5000):
+        self.entries = LRUCache(max_entries)
+        self.version = None
+        self.lock = threading.Lock()
+        self.invalidations = 0
+
+    def sync(self, db):
+        # At most once per request, see the comment at the top
+        if "photos_version" in g:
+            return
+        version = photos_version(db)
+        with self.lock:
+            # versions only go up, a request that read an older one won't add entries
+            if self.version is None or version > self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+        g.photos_version = version
+
+    def put(self, key, value):
+        with self.lock:
+            if g.photos_version == self.version:
+                self.entries.put(key, value)
+
+    def get(self, db, key, load):
+        self.sync(db)
+        value = self.entries.get(key, _MISSING)
+        if value is _MISSING:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def themes(self, db):
+        # every theme, for the upload forms and the home page search
+        return self.get(db, "themes", lambda: [row["name"] for row in db.execute("""SELECT name FROM themes""")])
+
+    def photo_themes(self, db):
+        # only the themes some photo is in, for the gallery filter
+        return self.get(db, "photo_themes",
+                        lambda: [row["theme"] for row in db.execute("""SELECT DISTINCT theme FROM photos""")])
+
+    def photo(self, db, photo_id):
+        # the photos row, or None if there is no such photo
+        return self.get(db, ("photo", photo_id),
+                        lambda: db.execute("""SELECT * FROM photos WHERE id = ?""", (photo_id,)).fetchone())
+
+    def photos(self, db, photo_ids):
+        # {id: row} like pricing.load_photos(), loading all the misses in one go
+        self.sync(db)
+        photos = {}
+        missing = []
+        for photo_id in photo_ids:
+            photo = self.entries.get(("photo", photo_id), _MISSING)
+            if photo is _MISSING:
+                missing.append(photo_id)
+            elif photo is not None:
+                photos[photo_id] = photo
+        if missing:
+            loaded = load_photos(db, missing)
+            for photo_id in missing:
+                self.put(("photo", photo_id), loaded.get(photo_id))
+            photos.update(loaded)
+        return photos
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.entries.hits,
+            "misses": self.entries.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+cache = CatalogueCache()
+
+
+def init_app(app):
+    cache.entries.max_entries = app.config.get("CATALOGUE_CACHE_SIZE", 5000)
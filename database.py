@@ -1,18 +1,554 @@
-from flask import g
+from flask import g, current_app
 import os
 import sqlite3
+import threading
+import time
 
-DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), "app.db")
+import analytics
+import image_metadata
+
+# PHOTO_CENTRE_DB points the app at another database file, e.g. a scratch
+# copy for benchmarks
+DATABASE = os.environ.get("PHOTO_CENTRE_DB", os.path.join(os.path.abspath(os.path.dirname(__file__)), "app.db"))
+
+# Used when the app doesn't set its own SQLITE_* config values
+DEFAULT_CONFIG = {
+    "SQLITE_JOURNAL_MODE": "WAL",
+    "SQLITE_SYNCHRONOUS": "NORMAL",
+    "SQLITE_CACHE_SIZE": -16000,        # negative means KiB, so ~16 MB of page cache
+    "SQLITE_MMAP_SIZE": 64 * 1024 * 1024,
+    "SQLITE_BUSY_TIMEOUT": 5000,        # milliseconds
+    "SQLITE_STATEMENT_CACHE": 256,      # prepared statements kept per connection
+    "SQLITE_POOL_SIZE": 8,              # idle connections kept per worker process
+}
+
+# Columns added to tables after schema.sql was first run. upgrade_db() adds any
+# that an existing app.db is missing so it doesn't have to be recreated.
+UPGRADE_COLUMNS = {
+    "photos": [
+        ("thumb_path", "TEXT"),
+        ("thumb_webp_path", "TEXT"),
+        ("detail_path", "TEXT"),
+        ("detail_webp_path", "TEXT"),
+        ("full_path", "TEXT"),
+        ("full_webp_path", "TEXT"),
+        ("width", "INTEGER"),
+        ("height", "INTEGER"),
+        ("camera", "TEXT"),
+        ("lens", "TEXT"),
+        ("taken_at", "DATETIME"),
+        ("phash", "INTEGER"),
+    ],
+    "limited_photos": [
+        ("thumb_path", "TEXT"),
+        ("thumb_webp_path", "TEXT"),
+        ("detail_path", "TEXT"),
+        ("detail_webp_path", "TEXT"),
+        ("full_path", "TEXT"),
+        ("full_webp_path", "TEXT"),
+        ("width", "INTEGER"),
+        ("height", "INTEGER"),
+        ("camera", "TEXT"),
+        ("lens", "TEXT"),
+        ("taken_at", "DATETIME"),
+        ("phash", "INTEGER"),
+        ("settled_at", "DATETIME"),
+        ("winner_id", "TEXT"),
+        ("winning_bid", "REAL"),
+    ],
+}
+
+# Tables and indexes added after schema.sql was first run, all safe to re-run.
+UPGRADE_STATEMENTS = [
+    # the log views page through these newest first, see audit.py
+    """CREATE INDEX IF NOT EXISTS idx_admin_logs_timestamp ON admin_logs (timestamp)""",
+    """CREATE INDEX IF NOT EXISTS idx_admin_logs_user_timestamp ON admin_logs (user_id, timestamp)""",
+    """CREATE INDEX IF NOT EXISTS idx_admin_logs_action_timestamp ON admin_logs (action, timestamp)""",
+    """CREATE INDEX IF NOT EXISTS idx_admin_payment_logs_timestamp ON admin_payment_logs (timestamp)""",
+    """CREATE INDEX IF NOT EXISTS idx_admin_payment_logs_user_timestamp ON admin_payment_logs (user_id, timestamp)""",
+    # gallery pages walk photos in id order within a theme, the prices are
+    # included so the price filters are checked without reading the row
+    """CREATE INDEX IF NOT EXISTS idx_photos_theme_id_prices
+       ON photos (theme, id, price_license, price_print)""",
+    # a narrow price range is read from these instead, see catalogue.gallery_index().
+    # The other columns (and the id, as in every index) cover the filters.
+    """CREATE INDEX IF NOT EXISTS idx_photos_price_license
+       ON photos (price_license, price_print, theme)""",
+    """CREATE INDEX IF NOT EXISTS idx_photos_price_print
+       ON photos (price_print, price_license, theme)""",
+    # highest bid of an auction is the first entry for its photo_id
+    """CREATE INDEX IF NOT EXISTS idx_bids_photo_amount
+       ON bids (photo_id, bid_amount DESC)""",
+    # the settlement scheduler only ever looks at auctions not yet settled
+    """CREATE INDEX IF NOT EXISTS idx_limited_photos_unsettled
+       ON limited_photos (end_date) WHERE settled_at IS NULL""",
+    """CREATE TABLE IF NOT EXISTS bid_leaderboard
+       (
+           bid_id INTEGER PRIMARY KEY,
+           photo_id INTEGER NOT NULL,
+           user_id TEXT NOT NULL,
+           title TEXT NOT NULL,
+           bid_amount REAL NOT NULL
+       )""",
+    # full-text index over the photo text, kept in sync by the triggers below
+    """CREATE VIRTUAL TABLE IF NOT EXISTS photos_fts USING fts5
+       (
+           title, description, theme,
+           content='photos', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2',
+           prefix='2 3'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS photos_fts_insert AFTER INSERT ON photos BEGIN
+           INSERT INTO photos_fts (rowid, title, description, theme)
+           VALUES (new.id, new.title, new.description, new.theme);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_fts_delete AFTER DELETE ON photos BEGIN
+           INSERT INTO photos_fts (photos_fts, rowid, title, description, theme)
+           VALUES ('delete', old.id, old.title, old.description, old.theme);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_fts_update AFTER UPDATE OF title, description, theme ON photos BEGIN
+           INSERT INTO photos_fts (photos_fts, rowid, title, description, theme)
+           VALUES ('delete', old.id, old.title, old.description, old.theme);
+           INSERT INTO photos_fts (rowid, title, description, theme)
+           VALUES (new.id, new.title, new.description, new.theme);
+       END""",
+    """CREATE TABLE IF NOT EXISTS sessions
+       (
+           id TEXT PRIMARY KEY,
+           data BLOB NOT NULL,
+           expires_at REAL NOT NULL
+       )""",
+    """CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)""",
+    """CREATE TABLE IF NOT EXISTS scheduler_leases
+       (
+           name TEXT PRIMARY KEY,
+           owner TEXT NOT NULL,
+           expires_at REAL NOT NULL
+       )""",
+    # how many photos and limited_photos rows use each stored file, see storage.py
+    """CREATE TABLE IF NOT EXISTS blobs
+       (
+           file_path TEXT PRIMARY KEY,
+           refs INTEGER NOT NULL
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_photos_insert AFTER INSERT ON photos BEGIN
+           INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+               ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_photos_delete AFTER DELETE ON photos BEGIN
+           UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_photos_update AFTER UPDATE OF file_path ON photos WHEN old.file_path IS NOT new.file_path BEGIN
+           UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+           INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+               ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+           INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+               ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+           UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS blobs_limited_photos_update AFTER UPDATE OF file_path ON limited_photos WHEN old.file_path IS NOT new.file_path BEGIN
+           UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+           INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+               ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+       END""",
+    # bumped on every change to photos, limited_photos, bids and themes, see
+    # http_cache.py and catalogue_cache.py
+    """CREATE TABLE IF NOT EXISTS catalogue_version
+       (
+           id INTEGER PRIMARY KEY CHECK (id = 1),
+           version INTEGER NOT NULL,
+           changed_at INTEGER NOT NULL
+       )""",
+    """INSERT OR IGNORE INTO catalogue_version (id, version, changed_at)
+       VALUES (1, 0, CAST(strftime('%s', 'now') AS INTEGER))""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_photos_insert AFTER INSERT ON photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_photos_update AFTER UPDATE ON photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_photos_delete AFTER DELETE ON photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_limited_photos_update AFTER UPDATE ON limited_photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_bids_insert AFTER INSERT ON bids BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_themes_insert AFTER INSERT ON themes BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_themes_update AFTER UPDATE ON themes BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS catalogue_version_themes_delete AFTER DELETE ON themes BEGIN
+           UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+       END""",
+    # bumped on every change to photos, limited_photos and themes except a
+    # checkout taking prints out of stock, and never by bids, see
+    # catalogue_cache.py. Pages that show stock or bids use catalogue_version.
+    """CREATE TABLE IF NOT EXISTS photos_version
+       (
+           id INTEGER PRIMARY KEY CHECK (id = 1),
+           version INTEGER NOT NULL
+       )""",
+    """INSERT OR IGNORE INTO photos_version (id, version) VALUES (1, 0)""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_photos_insert AFTER INSERT ON photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_photos_update AFTER UPDATE OF title, description, theme, file_path, price_license, price_print, thumb_path, thumb_webp_path, detail_path, detail_webp_path, full_path, full_webp_path, width, height, camera, lens, taken_at, phash ON photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_photos_delete AFTER DELETE ON photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_limited_photos_update AFTER UPDATE ON limited_photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_themes_insert AFTER INSERT ON themes BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_themes_update AFTER UPDATE ON themes BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS photos_version_themes_delete AFTER DELETE ON themes BEGIN
+           UPDATE photos_version SET version = version + 1;
+       END""",
+    # 8-bit pieces, briefly used instead of image_hashes
+    """DROP TRIGGER IF EXISTS image_hash_chunks_photos_insert""",
+    """DROP TRIGGER IF EXISTS image_hash_chunks_photos_delete""",
+    """DROP TRIGGER IF EXISTS image_hash_chunks_photos_update""",
+    """DROP TRIGGER IF EXISTS image_hash_chunks_limited_photos_insert""",
+    """DROP TRIGGER IF EXISTS image_hash_chunks_limited_photos_delete""",
+    """DROP TRIGGER IF EXISTS image_hash_chunks_limited_photos_update""",
+    """DROP TABLE IF EXISTS image_hash_chunks""",
+    # every perceptual hash as 16-bit pieces, for near-duplicate lookups, see image_metadata.py
+    """CREATE TABLE IF NOT EXISTS image_hashes
+       (
+           chunk INTEGER NOT NULL,
+           bits INTEGER NOT NULL,
+           source TEXT NOT NULL,
+           photo_id INTEGER NOT NULL,
+           phash INTEGER NOT NULL,
+           PRIMARY KEY (chunk, bits, source, photo_id)
+       ) WITHOUT ROWID""",
+    # the pieces of one image, for the delete and update triggers
+    """CREATE INDEX IF NOT EXISTS idx_image_hashes_photo ON image_hashes (source, photo_id)""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_photos_insert AFTER INSERT ON photos BEGIN
+           INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+           SELECT column1, column2, 'photos', new.id, new.phash FROM
+           (VALUES (0, new.phash & 65535),
+                   (1, (new.phash >> 16) & 65535),
+                   (2, (new.phash >> 32) & 65535),
+                   (3, (new.phash >> 48) & 65535))
+           WHERE new.phash IS NOT NULL;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_photos_delete AFTER DELETE ON photos BEGIN
+           DELETE FROM image_hashes WHERE source = 'photos' AND photo_id = old.id AND (chunk, bits) IN
+           (VALUES (0, old.phash & 65535),
+                   (1, (old.phash >> 16) & 65535),
+                   (2, (old.phash >> 32) & 65535),
+                   (3, (old.phash >> 48) & 65535));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_photos_update AFTER UPDATE OF phash ON photos WHEN old.phash IS NOT new.phash BEGIN
+           DELETE FROM image_hashes WHERE source = 'photos' AND photo_id = old.id AND (chunk, bits) IN
+           (VALUES (0, old.phash & 65535),
+                   (1, (old.phash >> 16) & 65535),
+                   (2, (old.phash >> 32) & 65535),
+                   (3, (old.phash >> 48) & 65535));
+           INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+           SELECT column1, column2, 'photos', new.id, new.phash FROM
+           (VALUES (0, new.phash & 65535),
+                   (1, (new.phash >> 16) & 65535),
+                   (2, (new.phash >> 32) & 65535),
+                   (3, (new.phash >> 48) & 65535))
+           WHERE new.phash IS NOT NULL;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+           INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+           SELECT column1, column2, 'limited_photos', new.id, new.phash FROM
+           (VALUES (0, new.phash & 65535),
+                   (1, (new.phash >> 16) & 65535),
+                   (2, (new.phash >> 32) & 65535),
+                   (3, (new.phash >> 48) & 65535))
+           WHERE new.phash IS NOT NULL;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+           DELETE FROM image_hashes WHERE source = 'limited_photos' AND photo_id = old.id AND (chunk, bits) IN
+           (VALUES (0, old.phash & 65535),
+                   (1, (old.phash >> 16) & 65535),
+                   (2, (old.phash >> 32) & 65535),
+                   (3, (old.phash >> 48) & 65535));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS image_hashes_limited_photos_update AFTER UPDATE OF phash ON limited_photos WHEN old.phash IS NOT new.phash BEGIN
+           DELETE FROM image_hashes WHERE source = 'limited_photos' AND photo_id = old.id AND (chunk, bits) IN
+           (VALUES (0, old.phash & 65535),
+                   (1, (old.phash >> 16) & 65535),
+                   (2, (old.phash >> 32) & 65535),
+                   (3, (old.phash >> 48) & 65535));
+           INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+           SELECT column1, column2, 'limited_photos', new.id, new.phash FROM
+           (VALUES (0, new.phash & 65535),
+                   (1, (new.phash >> 16) & 65535),
+                   (2, (new.phash >> 32) & 65535),
+                   (3, (new.phash >> 48) & 65535))
+           WHERE new.phash IS NOT NULL;
+       END""",
+    # near-duplicate images, each pair once with the lower (source, id) first, see image_metadata.py
+    """CREATE TABLE IF NOT EXISTS duplicate_pairs
+       (
+           source_a TEXT NOT NULL,
+           id_a INTEGER NOT NULL,
+           source_b TEXT NOT NULL,
+           id_b INTEGER NOT NULL,
+           distance INTEGER NOT NULL,
+           PRIMARY KEY (source_a, id_a, source_b, id_b)
+       ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS idx_duplicate_pairs_b ON duplicate_pairs (source_b, id_b)""",
+    """CREATE TRIGGER IF NOT EXISTS duplicate_pairs_photos_delete AFTER DELETE ON photos BEGIN
+           DELETE FROM duplicate_pairs WHERE (source_a = 'photos' AND id_a = old.id) OR (source_b = 'photos' AND id_b = old.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS duplicate_pairs_photos_update AFTER UPDATE OF phash ON photos WHEN old.phash IS NOT new.phash BEGIN
+           DELETE FROM duplicate_pairs WHERE (source_a = 'photos' AND id_a = old.id) OR (source_b = 'photos' AND id_b = old.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS duplicate_pairs_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+           DELETE FROM duplicate_pairs WHERE (source_a = 'limited_photos' AND id_a = old.id) OR (source_b = 'limited_photos' AND id_b = old.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS duplicate_pairs_limited_photos_update AFTER UPDATE OF phash ON limited_photos WHEN old.phash IS NOT new.phash BEGIN
+           DELETE FROM duplicate_pairs WHERE (source_a = 'limited_photos' AND id_a = old.id) OR (source_b = 'limited_photos' AND id_b = old.id);
+       END""",
+    # "similar photos" vector rows, see similar.py
+    """CREATE TABLE IF NOT EXISTS photo_vectors
+       (
+           photo_id INTEGER PRIMARY KEY,
+           row INTEGER UNIQUE NOT NULL
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS photo_vectors_photos_delete AFTER DELETE ON photos BEGIN
+           DELETE FROM photo_vectors WHERE photo_id = old.id;
+       END""",
+    # sales rollups for /admin/analytics, see analytics.py
+    """CREATE TABLE IF NOT EXISTS sales_daily
+       (
+           day TEXT PRIMARY KEY,
+           orders INTEGER NOT NULL DEFAULT 0,
+           licenses INTEGER NOT NULL DEFAULT 0,
+           prints INTEGER NOT NULL DEFAULT 0,
+           auctions INTEGER NOT NULL DEFAULT 0,
+           license_revenue REAL NOT NULL DEFAULT 0,
+           print_revenue REAL NOT NULL DEFAULT 0,
+           auction_revenue REAL NOT NULL DEFAULT 0
+       )""",
+    """CREATE TABLE IF NOT EXISTS sales_by_theme
+       (
+           theme TEXT PRIMARY KEY,
+           licenses INTEGER NOT NULL DEFAULT 0,
+           prints INTEGER NOT NULL DEFAULT 0,
+           license_revenue REAL NOT NULL DEFAULT 0,
+           print_revenue REAL NOT NULL DEFAULT 0,
+           revenue REAL NOT NULL DEFAULT 0
+       )""",
+    """CREATE TABLE IF NOT EXISTS sales_by_photo
+       (
+           photo_id INTEGER PRIMARY KEY,
+           licenses INTEGER NOT NULL DEFAULT 0,
+           prints INTEGER NOT NULL DEFAULT 0,
+           license_revenue REAL NOT NULL DEFAULT 0,
+           print_revenue REAL NOT NULL DEFAULT 0,
+           revenue REAL NOT NULL DEFAULT 0
+       )""",
+    """CREATE INDEX IF NOT EXISTS idx_sales_by_photo_revenue ON sales_by_photo (revenue)""",
+    # the license check behind /download, see orders.has_license()
+    """CREATE INDEX IF NOT EXISTS idx_purchases_user_photo ON purchases (user_id, photo_id, license)""",
+]
+
+# Run once, right after the upgrade that creates the named table, to fill it
+# from the rows that already exist. An entry is SQL or a function taking the
+# connection.
+UPGRADE_BACKFILLS = {
+    "photos_fts": [
+        """INSERT INTO photos_fts (photos_fts) VALUES ('rebuild')""",
+        # title matches count the most, then theme, then description
+        """INSERT INTO photos_fts (photos_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0)')""",
+    ],
+    "blobs": [
+        """INSERT INTO blobs (file_path, refs)
+           SELECT file_path, COUNT(*) FROM
+           (SELECT file_path FROM photos UNION ALL SELECT file_path FROM limited_photos)
+           GROUP BY file_path""",
+    ],
+    "image_hashes": [
+        f"""INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+            SELECT column1, (phash >> (16 * column1)) & 65535, '{source}', id, phash
+            FROM {source}, (VALUES (0), (1), (2), (3))
+            WHERE phash IS NOT NULL"""
+        for source in ("photos", "limited_photos")
+    ],
+    "duplicate_pairs": [image_metadata.rebuild_duplicates],
+    "sales_daily": [analytics.rebuild],
+}
+
+stats = {
+    "connections_opened": 0,
+    "connections_reused": 0,
+    "write_locks": 0,
+    "write_lock_seconds": 0.0,
+    "lock_timeouts": 0,
+}
+_stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with _stats_lock:
+        stats[name] += amount
+
+def get_stats():
+    with _stats_lock:
+        return dict(stats)
+
+
+WRITE_LOCK_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN IMMEDIATE", "BEGIN EXCLUSIVE")
+
+class Connection(sqlite3.Connection):
+    # The first write of a transaction is where SQLite takes the write lock and
+    # where busy_timeout makes us wait behind other writers, so those
+    # statements are counted in stats["write_locks"] and timed into
+    # stats["write_lock_seconds"]. Most take the lock straight away: the time
+    # includes the statement itself, which is tiny next to any real wait.
+    #
+    # While profiling is on, get_db() sets profile to the request's
+    # RequestProfile and every statement is counted and timed into it (see
+    # profiling.py). Rows fetched afterwards are not included.
+    profile = None
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self._run(super().executemany, sql, parameters)
+
+    def _run(self, method, sql, parameters):
+        if self.profile is None:
+            return self._execute(method, sql, parameters)
+        start = time.perf_counter()
+        try:
+            return self._execute(method, sql, parameters)
+        finally:
+            self.profile.add_sql(time.perf_counter() - start)
+
+    def _execute(self, method, sql, parameters):
+        if self.in_transaction or not sql.lstrip().upper().startswith(WRITE_LOCK_STATEMENTS):
+            return method(sql, parameters)
+        return self._timed(method, sql, parameters)
+
+    def _timed(self, method, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                count("lock_timeouts")
+            raise
+        finally:
+            count("write_locks")
+            count("write_lock_seconds", time.perf_counter() - start)
+
+
+def connect(config=DEFAULT_CONFIG, database=None):
+    def setting(name):
+        return config.get(name, DEFAULT_CONFIG[name])
+
+    # DATABASE is looked up here rather than bound as the default, so a
+    # benchmark can point the app at its own file after importing this module
+    db = sqlite3.connect(database or DATABASE,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        factory=Connection,
+        cached_statements=setting("SQLITE_STATEMENT_CACHE"),
+        # pooled connections are handed to whichever thread serves the next request
+        check_same_thread=False,
+    )
+    db.row_factory = sqlite3.Row
+    # WAL lets readers carry on while checkout() or a bid is writing
+    db.execute(f"""PRAGMA journal_mode = {setting("SQLITE_JOURNAL_MODE")}""")
+    db.execute(f"""PRAGMA synchronous = {setting("SQLITE_SYNCHRONOUS")}""")
+    db.execute(f"""PRAGMA cache_size = {int(setting("SQLITE_CACHE_SIZE"))}""")
+    db.execute(f"""PRAGMA mmap_size = {int(setting("SQLITE_MMAP_SIZE"))}""")
+    db.execute(f"""PRAGMA busy_timeout = {int(setting("SQLITE_BUSY_TIMEOUT"))}""")
+    count("connections_opened")
+    return db
+
+
+# Idle connections of this process. Opening a connection and re-running the
+# pragmas on every request is wasted work, and a reused connection keeps its
+# page cache and prepared statements.
+_pool = []
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
 
 def get_db():
+    global _pool_pid
     if "db" not in g:
-        g.db = sqlite3.connect(DATABASE,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        db = None
+        with _pool_lock:
+            # a forked worker must not share the parent's connections
+            if _pool_pid != os.getpid():
+                _pool.clear()
+                _pool_pid = os.getpid()
+            if _pool:
+                db = _pool.pop()
+        if db is None:
+            db = connect(current_app.config)
+        else:
+            count("connections_reused")
+        db.profile = g.get("profile")
+        g.db = db
     return g.db
 
 def close_db(e=None):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
\ No newline at end of file
+        db.profile = None
+        # never hand an unfinished transaction to the next request
+        if db.in_transaction:
+            db.rollback()
+        with _pool_lock:
+            if _pool_pid == os.getpid() and len(_pool) < current_app.config.get("SQLITE_POOL_SIZE", DEFAULT_CONFIG["SQLITE_POOL_SIZE"]):
+                _pool.append(db)
+                return
+        db.close()
+
+def upgrade_db():
+    apply_upgrades(get_db())
+
+def apply_upgrades(db):
+    for table, columns in UPGRADE_COLUMNS.items():
+        existing = {row[1] for row in db.execute(f"""PRAGMA table_info({table})""")}
+        for column, column_type in columns:
+            if column not in existing:
+                db.execute(f"""ALTER TABLE {table} ADD COLUMN {column} {column_type}""")
+    existing = {row[0] for row in db.execute("""SELECT name FROM sqlite_master""")}
+    for statement in UPGRADE_STATEMENTS:
+        db.execute(statement)
+    for table, statements in UPGRADE_BACKFILLS.items():
+        if table not in existing:
+            for statement in statements:
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.execute(statement)
+    db.commit()
@@ -33,19 +33,30 @@ class UploadPhotoForm(FlaskForm):
     file = FileField("Upload Image", validators=[InputRequired()])
     submit = SubmitField("Submit")
 
-class DeletePhotoForm(FlaskForm):
-    delete_title = StringField("Photo Title", validators=[InputRequired()])
-    delete_submit = SubmitField("Delete")
+class BulkImportForm(FlaskForm):
+    archive = FileField("ZIP of Images", validators=[InputRequired()])
+    manifest = FileField("Manifest (CSV or JSON)", validators=[Optional()])
+    submit = SubmitField("Import")
 
-class UpdatePhotoForm(FlaskForm):
-    photo_id = HiddenField()
-    title = StringField("Title", validators=[Optional()])
-    description = StringField("Description", validators=[Optional()])
-    theme = SelectField("Theme", choices=[], validators=[Optional()])
-    price_license = DecimalField("License Price €", validators=[Optional(), NumberRange(min=0)])
-    price_print = DecimalField("Print Price €", validators=[Optional(), NumberRange(min=0)])
-    inventory = IntegerField("Update Inventory", validators=[Optional()])
-    update_submit = SubmitField("Update Photo")
+class PhotoGridForm(FlaskForm):
+    # The admin photo grid: carries the CSRF token and the ids of the photos
+    # on the page, each of which has its own PhotoRowForm
+    photo_ids = HiddenField()
+    submit = SubmitField("Save Changes")
+
+class PhotoRowForm(FlaskForm):
+    # One row of the admin photo grid, built with prefix="p<id>" so a whole
+    # page is edited in one POST
+    class Meta:
+        csrf = False
+
+    title = StringField("Title", validators=[InputRequired()])
+    description = StringField("Description", validators=[InputRequired()])
+    theme = SelectField("Theme", choices=[], validators=[InputRequired()])
+    price_license = FloatField("License Price €", validators=[Optional(), NumberRange(min=0)])
+    price_print = FloatField("Print Price €", validators=[Optional(), NumberRange(min=0)])
+    inventory = IntegerField("Inventory", validators=[InputRequired(), NumberRange(min=0)])
+    delete = BooleanField("Delete")
 
 class PurchaseForm(FlaskForm):
     buy_license = BooleanField("Buy License")
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from flask import g
+from markupsafe import Markup
+import threading
+import time
+
+from catalogue_cache import cache
+from database import get_db
+
+# Rendered HTML for the parts of a page that only change with the catalogue,
+# like the gallery grid for one set of filters. A view asks for a fragment
+# with cached_fragment(name, *key, render=...): on a hit neither the SQL nor
+# the template inside render() runs.
+#
+# Fragments belong to the photos version that was current when they were
+# rendered (see catalogue_cache.py), and the whole cache is dropped when it
+# moves, so a fragment mustn't show bids or stock. Anything that changes
+# without a write (an auction ending) is covered by the TTL. Memory is capped by the total length of the cached
+# HTML, least recently used fragments go first.
+
+
+class FragmentCache:
+    def __init__(self, max_size=8 * 1024 * 1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self.lock:
+            # versions only go up, a request that read an older one just misses
+            if self.version is None or version > self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+            entry = self.entries.get(key) if version == self.version else None
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, html):
+        if len(html) > self.max_size:
+            return
+        with self.lock:
+            # rendered for an older version, may be out of date already
+            if version != self.version:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (time.monotonic() + self.ttl, html)
+            self.size += len(html)
+            while self.size > self.max_size:
+                expires, evicted = self.entries.popitem(last=False)[1]
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+fragments = FragmentCache()
+
+
+def cached_fragment(name, *key, render):
+    # The HTML of render() (a function returning a string) for name and key,
+    # from the cache if it is there. key must cover everything the fragment
+    # depends on apart from the catalogue, e.g. the gallery filters.
+    cache.sync(get_db())
+    version = g.photos_version
+    key = (name, *key)
+    html = fragments.get(key, version)
+    if html is None:
+        html = Markup(render())
+        fragments.put(key, version, html)
+    return html
+
+
+def init_app(app):
+    fragments.max_size = app.config.get("FRAGMENT_CACHE_SIZE", fragments.max_size)
+    fragments.ttl = app.config.get("FRAGMENT_CACHE_TTL", fragments.ttl)
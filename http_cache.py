@@ -0,0 +1,114 @@
+from flask import g, request, session, make_response
+from functools import wraps
+import hashlib
+import os
+import re
+import threading
+import time
+
+from catalogue import catalogue_version
+from database import get_db
+
+# Static files are linked as /static/<file>?v=<fingerprint of its content>, so
+# browsers can keep them for a year without asking: a changed file gets a
+# new URL.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Uploads stored by content (see storage.py) are named after their SHA-256
+# already, so they don't need hashing again
+CONTENT_ADDRESSED = re.compile(r"^[0-9a-f]{64}\.\w+$")
+
+# path -> (mtime, fingerprint)
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def fingerprint(path):
+    name = os.path.basename(path)
+    if CONTENT_ADDRESSED.match(name):
+        return name[:12]
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _fingerprints_lock:
+        cached = _fingerprints.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    md5 = hashlib.md5(usedforsecurity=False)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            md5.update(chunk)
+    version = md5.hexdigest()[:12]
+    with _fingerprints_lock:
+        _fingerprints[path] = (mtime, version)
+    return version
+
+
+def init_app(app):
+    @app.url_defaults
+    def add_fingerprint(endpoint, values):
+        if endpoint == "static" and "v" not in values and values.get("filename"):
+            version = fingerprint(os.path.join(app.static_folder, values["filename"]))
+            if version:
+                values["v"] = version
+
+    @app.after_request
+    def cache_static(response):
+        if request.endpoint == "static" and "v" in request.args and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+
+# Pages built from the catalogue get validators that change whenever the
+# catalogue version does (the triggers on photos, limited_photos, bids and
+# themes bump it), so a browser revalidating a page it already has gets a
+# 304 and the view never runs.
+#
+# The ETag also covers the user, the URL and the gallery filters kept in the
+# session, plus a half hour time bucket: pages carry a CSRF token, and a page
+# re-used from the browser cache must not hold one older than Flask-WTF's
+# one hour limit.
+CSRF_BUCKET = 1800
+SESSION_KEYS = ("theme", "price_min", "price_max", "filter_type")
+
+
+def page_etag(version):
+    parts = [version, g.user, request.full_path, int(time.time() // CSRF_BUCKET)]
+    parts += [session.get(key) for key in SESSION_KEYS]
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def conditional_page(view):
+    @wraps(view)
+    def conditional_view(*args, **kwargs):
+        # pending flash messages would be lost in a 304
+        if request.method != "GET" or session.get("_flashes"):
+            return view(*args, **kwargs)
+
+        version, changed_at = catalogue_version(get_db())
+        etag = page_etag(version)
+        if request.if_none_match:
+            unchanged = request.if_none_match.contains(etag)
+        else:
+            unchanged = request.if_modified_since is not None and changed_at <= request.if_modified_since.timestamp()
+
+        if unchanged:
+            response = make_response("", 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.last_modified = changed_at
+        # always revalidate, and only in the user's own browser cache
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+        return response
+    return conditional_view
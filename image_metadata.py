@@ -0,0 +1,223 @@
+from datetime import datetime
+from PIL import Image, ExifTags
+
+# What upload() and the backfill store about each image, on photos and
+# limited_photos alike, plus a perceptual hash for finding near-duplicates.
+METADATA_COLUMNS = ["width", "height", "camera", "lens", "taken_at", "phash"]
+
+# The hash is a 64-bit difference hash (dHash): the image shrunk to 9x8 grey
+# pixels, one bit per pair of neighbours saying which is brighter. Resizing,
+# recompressing or small colour changes flip few bits, so near-duplicates are
+# hashes a small Hamming distance apart.
+#
+# The image_hashes table (kept up to date by triggers) indexes every hash as
+# HASH_CHUNKS pieces of CHUNK_BITS bits. Two hashes at most 2 * HASH_CHUNKS - 1
+# bits apart have at least one piece at most one bit apart, so looking up each
+# piece and its CHUNK_BITS one-bit neighbours finds every candidate with a few
+# index seeks. Pieces this wide keep about N / 65536 images per value, so the
+# candidates stay few however many images there are.
+#
+# Matches are stored in duplicate_pairs when a hash is saved, so listing every
+# group of near-duplicates reads only the pairs that matched.
+HASH_CHUNKS = 4
+CHUNK_BITS = 16
+MAX_DISTANCE = 2 * HASH_CHUNKS - 1
+
+EXIF_TIME = "%Y:%m:%d %H:%M:%S"
+
+
+class UnreadableImage(Exception):
+    pass
+
+
+def to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a, b):
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def dhash(image):
+    grey = image.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = grey.tobytes()
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            value = (value << 1) | (left > right)
+    return to_signed(value)
+
+
+def exif_text(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    value = str(value).strip("\x00 ") if value is not None else ""
+    return value or None
+
+
+def read_metadata(file_path):
+    # Returns {column: value} for METADATA_COLUMNS, raises UnreadableImage if
+    # Pillow can't read the file, whatever its name says it is
+    try:
+        return _read_metadata(file_path)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise UnreadableImage(str(e) or "not a readable image")
+
+
+def _read_metadata(file_path):
+    with Image.open(file_path) as image:
+        exif = image.getexif()
+        width, height = image.size
+        # rotated by the camera: report the size the image is shown at
+        if exif.get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+            width, height = height, width
+
+        details = exif.get_ifd(ExifTags.IFD.Exif)
+        make = exif_text(exif.get(ExifTags.Base.Make))
+        model = exif_text(exif.get(ExifTags.Base.Model))
+        camera = model if not make or (model and model.startswith(make)) else " ".join(filter(None, (make, model)))
+
+        taken_at = None
+        taken = exif_text(details.get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime))
+        if taken:
+            try:
+                taken_at = datetime.strptime(taken[:19], EXIF_TIME).strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+
+        # JPEGs can be decoded at 1/8 scale, plenty for a 9x8 hash
+        image.draft("L", (64, 64))
+        phash = dhash(image)
+
+    return {
+        "width": width,
+        "height": height,
+        "camera": camera,
+        "lens": exif_text(details.get(ExifTags.Base.LensModel)),
+        "taken_at": taken_at,
+        "phash": phash,
+    }
+
+
+def save_metadata(db, table, photo_id, metadata):
+    # table is always one of our own table names, never user input
+    columns = ", ".join(f"{column} = ?" for column in METADATA_COLUMNS)
+    db.execute(f"""UPDATE {table} SET {columns} WHERE id = ?""",
+               [metadata[column] for column in METADATA_COLUMNS] + [photo_id])
+    record_duplicates(db, table, photo_id, metadata["phash"])
+
+
+def hash_chunks(phash):
+    # [(chunk, bits)], the same pieces the image_hashes triggers store
+    return [(chunk, (phash >> (CHUNK_BITS * chunk)) & 0xFFFF) for chunk in range(HASH_CHUNKS)]
+
+
+def probe_chunks(phash):
+    # [(chunk, bits)] to look up for phash: each piece and every piece one bit
+    # away from it, CHUNK_BITS + 1 in a row for each chunk
+    flips = [0] + [1 << bit for bit in range(CHUNK_BITS)]
+    return [(chunk, bits ^ flip) for chunk, bits in hash_chunks(phash) for flip in flips]
+
+
+def hash_matches(db, phash, max_distance=MAX_DISTANCE, exclude=None):
+    # [(distance, source table, id)] of stored images within max_distance
+    # bits of phash, closest first. exclude is a (table, id) to leave out,
+    # e.g. the upload itself.
+    max_distance = min(max_distance, MAX_DISTANCE)
+    # one "chunk = ? AND bits IN (...)" per chunk: SQLite answers each with
+    # primary key seeks, where (chunk, bits) IN (VALUES ...) scans the table
+    probes = probe_chunks(phash)
+    placeholders = ", ".join("?" for _ in range(CHUNK_BITS + 1))
+    where = " OR ".join(f"(chunk = ? AND bits IN ({placeholders}))" for _ in range(HASH_CHUNKS))
+    parameters = []
+    for chunk in range(HASH_CHUNKS):
+        parameters += [chunk] + [bits for probe_chunk, bits in probes if probe_chunk == chunk]
+    candidates = db.execute(f"""SELECT DISTINCT source, photo_id, phash FROM image_hashes WHERE {where}""",
+                            parameters).fetchall()
+
+    matches = []
+    for row in candidates:
+        if (row["source"], row["photo_id"]) == exclude:
+            continue
+        apart = distance(phash, row["phash"])
+        if apart <= max_distance:
+            matches.append((apart, row["source"], row["photo_id"]))
+    return sorted(matches)
+
+
+def near_duplicates(db, phash, max_distance=MAX_DISTANCE, exclude=None):
+    # hash_matches() with each image's title, [(distance, source table, id, title)]
+    return [(apart, source, photo_id, title_of(db, source, photo_id))
+            for apart, source, photo_id in hash_matches(db, phash, max_distance, exclude)]
+
+
+def record_duplicates(db, table, photo_id, phash):
+    # Stores the near-duplicates of a newly saved hash in duplicate_pairs.
+    # Triggers drop a photo's pairs when it is deleted or its hash changes.
+    if phash is None:
+        return
+    item = (table, photo_id)
+    pairs = []
+    for apart, source, match_id in hash_matches(db, phash, exclude=item):
+        # each pair is stored once, the lower (table, id) first
+        match = (source, match_id)
+        pairs.append((*min(item, match), *max(item, match), apart))
+    db.executemany("""INSERT INTO duplicate_pairs (source_a, id_a, source_b, id_b, distance)
+                   VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING""", pairs)
+
+
+def rebuild_duplicates(db):
+    # Fills duplicate_pairs from every stored hash at once, with the pieces
+    # held in memory rather than looked up one image at a time. Images are
+    # numbered in (table, id) order and each is only compared with the ones
+    # before it, so every pair is found once.
+    images = [(table, row["id"]) for table in ("limited_photos", "photos")
+              for row in db.execute(f"""SELECT id FROM {table} WHERE phash IS NOT NULL ORDER BY id""")]
+    hashes = [row["phash"] for table in ("limited_photos", "photos")
+              for row in db.execute(f"""SELECT phash FROM {table} WHERE phash IS NOT NULL ORDER BY id""")]
+    pieces = {}
+    pairs = set()
+    for number, phash in enumerate(hashes):
+        for piece in probe_chunks(phash):
+            for other in pieces.get(piece, ()):
+                if ((phash ^ hashes[other]) & 0xFFFFFFFFFFFFFFFF).bit_count() <= MAX_DISTANCE:
+                    pairs.add((other, number))
+        for piece in hash_chunks(phash):
+            pieces.setdefault(piece, []).append(number)
+    db.execute("""DELETE FROM duplicate_pairs""")
+    db.executemany("""INSERT INTO duplicate_pairs (source_a, id_a, source_b, id_b, distance)
+                   VALUES (?, ?, ?, ?, ?)""",
+                   [(*images[a], *images[b], distance(hashes[a], hashes[b])) for a, b in sorted(pairs)])
+
+
+def title_of(db, table, photo_id):
+    row = db.execute(f"""SELECT title FROM {table} WHERE id = ?""", (photo_id,)).fetchone()
+    return row["title"] if row else None
+
+
+def duplicate_groups(db, max_distance=MAX_DISTANCE):
+    # Every set of near-duplicate images across photos and limited_photos, as
+    # lists of (source table, id) with the biggest sets first. Only the pairs
+    # stored in duplicate_pairs are read, then merged into groups.
+    pairs = db.execute("""SELECT source_a, id_a, source_b, id_b FROM duplicate_pairs
+                       WHERE distance <= ?""", (max_distance,))
+
+    parent = {}
+
+    def root(item):
+        parent.setdefault(item, item)
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    for row in pairs:
+        parent[root((row["source_a"], row["id_a"]))] = root((row["source_b"], row["id_b"]))
+
+    groups = {}
+    for item in parent:
+        groups.setdefault(root(item), []).append(item)
+    return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group))
@@ -0,0 +1,73 @@
+from PIL import Image, ImageOps
+import os
+
+from image_metadata import UnreadableImage
+
+# name -> target width in pixels. "thumb" is for gallery grid tiles, the only
+# size pages link to and /static serves. Anything bigger is only shown
+# watermarked, rendered from the original by /preview (see previews.py).
+DERIVATIVE_SIZES = {"thumb": 480}
+
+# sizes made before previews replaced them. Their columns stay on the tables
+# and their files are removed with the original, see storage.delete_unused().
+RETIRED_SIZES = ["detail", "full"]
+
+# Every derivative is saved as a JPEG and a WebP, these are the matching columns
+# on photos and limited_photos.
+DERIVATIVE_COLUMNS = [f"{name}{suffix}_path" for name in DERIVATIVE_SIZES for suffix in ("", "_webp")]
+
+
+def derivative_paths(file_path, folder, sizes=DERIVATIVE_SIZES):
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    paths = {}
+    for name in sizes:
+        paths[f"{name}_path"] = os.path.join(folder, f"{stem}-{name}.jpg").replace("\\", "/")
+        paths[f"{name}_webp_path"] = os.path.join(folder, f"{stem}-{name}.webp").replace("\\", "/")
+    return paths
+
+
+def make_derivatives(file_path, folder, reuse=False):
+    # Resizes the original once per size and writes a JPEG and a WebP of each.
+    # Returns {column: path} ready to be stored with save_derivatives().
+    # With reuse, derivatives that are all there already are kept; uploads are
+    # stored by content (see storage.py), so those are of the same image.
+    os.makedirs(folder, exist_ok=True)
+    paths = derivative_paths(file_path, folder)
+    if reuse and all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    with Image.open(file_path) as original:
+        # JPEGs can be decoded at a fraction of their size, no smaller than
+        # the biggest derivative whichever way round the photo is turned
+        largest = max(DERIVATIVE_SIZES.values())
+        original.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(original)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # largest size first so each smaller one is resized from the previous
+        for name, width in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+            image.thumbnail((width, image.height), Image.LANCZOS)
+            image.save(paths[f"{name}_path"], "JPEG", quality=82, optimize=True, progressive=True)
+            image.save(paths[f"{name}_webp_path"], "WEBP", quality=80, method=4)
+
+    return paths
+
+
+def save_derivatives(db, table, photo_id, paths):
+    # table is always one of our own table names, never user input
+    columns = ", ".join(f"{column} = ?" for column in DERIVATIVE_COLUMNS)
+    db.execute(f"""UPDATE {table} SET {columns} WHERE id = ?""",
+               [paths[column] for column in DERIVATIVE_COLUMNS] + [photo_id])
+
+
+def backfill_job(job):
+    # Runs inside a worker process, so it only takes and returns plain values.
+    # job is (table, photo_id, work, args) with work a module-level function
+    # like make_derivatives(); an image that can't be read gives an error
+    # message in place of the result.
+    table, photo_id, work, args = job
+    try:
+        return table, photo_id, work(*args), None
+    except (OSError, ValueError, UnreadableImage) as e:
+        return table, photo_id, None, str(e)
@@ -0,0 +1,57 @@
+from collections import deque
+from itertools import islice
+import json
+import threading
+
+
+class Broadcaster:
+    # In-process pub/sub for Server-Sent Events.
+    #
+    # Every event goes into one shared ring buffer with an increasing id and
+    # all listeners wake on one Condition, so a subscriber costs just the id
+    # of the last event it sent (plus its connection), not a queue of its own.
+    # A listener that falls further behind than the buffer gets a "reset"
+    # event telling the page to reload.
+
+    def __init__(self, history=256):
+        self.events = deque(maxlen=history)
+        self.last_id = 0
+        self.changed = threading.Condition()
+
+    def publish(self, event, data, photo_id=None):
+        payload = json.dumps(data)
+        with self.changed:
+            self.last_id += 1
+            self.events.append((self.last_id, event, photo_id, payload))
+            self.changed.notify_all()
+
+    def listen(self, last_id=None, keepalive=15):
+        # Yields lists of (id, event, photo_id, payload), or an empty list
+        # every keepalive seconds so proxies don't drop an idle connection.
+        with self.changed:
+            if last_id is None or last_id > self.last_id:
+                last_id = self.last_id
+
+        while True:
+            with self.changed:
+                if self.last_id == last_id:
+                    self.changed.wait(keepalive)
+                if self.last_id == last_id:
+                    pending = []
+                else:
+                    oldest = self.events[0][0]
+                    if last_id + 1 < oldest:
+                        pending = [(self.last_id, "reset", None, "{}")]
+                    else:
+                        # ids are consecutive, so the unsent events are the tail
+                        pending = list(islice(self.events, last_id + 1 - oldest, None))
+                    last_id = self.last_id
+            yield pending
+
+
+def format_event(event_id, event, payload):
+    return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n"
+
+
+# new bids and leaderboard changes for the limited edition pages
+bids = Broadcaster()
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+
+import analytics
+from pricing import price_cart
+
+
+class OutOfStock(Exception):
+    def __init__(self, title):
+        super().__init__(f"Not enough stock for {title}!")
+        self.title = title
+
+
+def place_order(db, user_id, cart):
+    # The whole order is one transaction. BEGIN IMMEDIATE takes the write lock
+    # up front, so prices and stock are read and changed without another
+    # checkout getting in between, and there is a single commit per order.
+    # Each print is reserved with a conditional UPDATE: if another buyer got
+    # the last copies first no row matches and the order is rolled back.
+    # Every row of the order gets the same purchase_date, which is how
+    # analytics.rebuild() tells orders apart, and the sales rollups are
+    # updated before the commit.
+    # Returns the order total, raises OutOfStock if a print ran out.
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        pricing = price_cart(db, cart)
+        total_prints = 0
+        lines = []
+
+        for photo_id, item in cart.items():
+            photo = pricing["photos"].get(photo_id)
+            if photo is None:
+                continue
+            license = item["license"]
+            print_qty = item["print_qty"]
+
+            if print_qty > 0:
+                reserved = db.execute("""UPDATE photos SET inventory = inventory - ?
+                                      WHERE id = ? AND inventory >= ?""", (print_qty, photo_id, print_qty))
+                if reserved.rowcount == 0:
+                    raise OutOfStock(photo["title"])
+                total_prints += print_qty
+
+            price_license = photo["price_license"] if license else 0
+            price_print = photo["price_print"] * print_qty
+            db.execute("""INSERT INTO purchases (user_id, photo_id, license, print_qty, price_license, price_print, purchase_date)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                       (user_id, photo_id, license, print_qty, price_license, price_print, now))
+            lines.append((photo, license, print_qty, price_license, price_print))
+
+        db.execute("""INSERT INTO admin_payment_logs (user_id, print_qty, total)
+                   VALUES (?, ?, ?)""", (user_id, total_prints, pricing["total_price"]))
+        analytics.record_order(db, now[:10], lines)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return pricing["total_price"]
+
+
+def has_license(db, user_id, photo_id):
+    # read through idx_purchases_user_photo, so it is one index seek however
+    # many purchases there are
+    return db.execute("""SELECT 1 FROM purchases WHERE user_id = ? AND photo_id = ? AND license = 1 LIMIT 1""",
+                      (user_id, photo_id)).fetchone() is not None
@@ -0,0 +1,206 @@
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+import io
+import os
+import threading
+import time
+import zlib
+
+# Watermarked previews for the photo pages, cart and profile, served by
+# /preview/<photo_id>/<size> instead of the unmarked originals.
+#
+# A preview is rendered the first time it is asked for and kept on disk in
+# PREVIEW_FOLDER, named after the original (which is named after its
+# content, see storage.py), so photos sharing a file share previews. The
+# folder is capped at PREVIEW_CACHE_SIZE bytes: a file's mtime is its last
+# use, and the least recently used go first when a new one takes it over.
+#
+# A burst of requests for a preview nobody has rendered yet renders it once.
+# Threads of one process wait on a lock, other processes on a .lock file
+# that only the process rendering it could create.
+
+# name -> width in pixels, the same names as the derivatives in images.py
+PREVIEW_SIZES = {"thumb": 480, "detail": 1280}
+# extension -> (Pillow format, mimetype). The extension is part of the size in
+# the URL, /preview/<photo_id>/detail.webp
+PREVIEW_FORMATS = {"jpg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+# a .lock file older than this was left by a process that died rendering
+RENDER_TIMEOUT = 30
+# a hit only moves a file's mtime if it is older than this, to spare a write
+# on every request
+TOUCH_INTERVAL = 60
+# eviction frees down to this fraction of the cap, so it doesn't run again on
+# the very next render
+EVICT_TO = 0.9
+LOCK_STRIPES = 64
+
+
+def render_preview(file_path, width, text, image_format="JPEG"):
+    # JPEG (or image_format) bytes of the image at file_path scaled down to width, with text
+    # repeated diagonally across it
+    with Image.open(file_path) as original:
+        # JPEGs can be decoded at a fraction of their size, no smaller than
+        # width whichever way round the photo is turned
+        original.draft("RGB", (width, width))
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGB")
+        image.thumbnail((width, image.height), Image.LANCZOS)
+
+    font = ImageFont.load_default(size=max(12, image.width // 20))
+    left, top, right, bottom = font.getbbox(text)
+    step_x, step_y = (right - left) * 3 // 2, (bottom - top) * 4
+
+    # drawn on a bigger square so the rotated rows still reach the corners
+    side = int((image.width ** 2 + image.height ** 2) ** 0.5)
+    overlay = Image.new("RGBA", (side, side), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(overlay)
+    for row, y in enumerate(range(0, side, step_y)):
+        for x in range(-(row % 2) * step_x // 2, side, step_x):
+            draw.text((x, y), text, font=font, fill=(255, 255, 255, 90))
+    overlay = overlay.rotate(30, resample=Image.BICUBIC)
+    offset = ((side - image.width) // 2, (side - image.height) // 2)
+    overlay = overlay.crop((*offset, offset[0] + image.width, offset[1] + image.height))
+
+    image = Image.alpha_composite(image.convert("RGBA"), overlay).convert("RGB")
+    output = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(output, "JPEG", quality=80, optimize=True, progressive=True)
+    else:
+        image.save(output, image_format, quality=80)
+    return output.getvalue()
+
+
+class PreviewCache:
+    def __init__(self, folder="previews", max_size=256 * 1024 * 1024, text="Photography Marketplace"):
+        self.folder = folder
+        self.max_size = max_size
+        self.text = text
+        self.size = None
+        self.lock = threading.Lock()
+        self.render_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.evictions = 0
+
+    def preview_path(self, file_path, size, extension):
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        return os.path.join(self.folder, f"{stem}-{size}.{extension}")
+
+    def hit(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted by another process just now
+                return False
+        return True
+
+    def get(self, file_path, size, extension="jpg"):
+        # The path of the preview of file_path at size (a PREVIEW_SIZES name)
+        # in the format of extension, rendered first if it isn't on disk
+        path = self.preview_path(file_path, size, extension)
+        if self.hit(path):
+            self.hits += 1
+            return path
+
+        with self.render_locks[zlib.crc32(path.encode()) % LOCK_STRIPES]:
+            if self.hit(path):
+                self.hits += 1
+                return path
+            self.misses += 1
+            os.makedirs(self.folder, exist_ok=True)
+            if not self.lock_file(path):
+                # another process rendered it while we waited
+                return path
+            try:
+                if not os.path.exists(path):
+                    data = render_preview(file_path, PREVIEW_SIZES[size], self.text, PREVIEW_FORMATS[extension][0])
+                    temp_path = f"{path}.{os.getpid()}.part"
+                    with open(temp_path, "wb") as stream:
+                        stream.write(data)
+                    os.replace(temp_path, path)
+                    self.renders += 1
+                    self.added(len(data))
+            finally:
+                try:
+                    os.remove(path + ".lock")
+                except FileNotFoundError:
+                    pass
+        return path
+
+    def lock_file(self, path):
+        # True once this process holds path's .lock file, False if the preview
+        # turned up while waiting for it
+        lock_path = path + ".lock"
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                pass
+            if os.path.exists(path):
+                return False
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > RENDER_TIMEOUT:
+                    os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+
+    def added(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = self.scan()[0]
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def scan(self):
+        # (total bytes, [(mtime, size, path)]) of the previews on disk. Other
+        # processes add files too, so this is the only exact total.
+        files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.rsplit(".", 1)[-1] in PREVIEW_FORMATS:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sum(size for mtime, size, path in files), files
+
+    def evict(self):
+        total, files = self.scan()
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self.size = total
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "renders": self.renders,
+            "evictions": self.evictions,
+        }
+
+
+previews = PreviewCache()
+
+
+def init_app(app):
+    previews.folder = app.config.get("PREVIEW_FOLDER", previews.folder)
+    previews.max_size = app.config.get("PREVIEW_CACHE_SIZE", previews.max_size)
+    previews.text = app.config.get("WATERMARK_TEXT", previews.text)
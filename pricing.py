@@ -0,0 +1,50 @@
+# SQLite versions before 3.32 only allow 999 ? placeholders per statement
+IN_CHUNK = 500
+
+
+def load_photos(db, photo_ids):
+    # One "WHERE id IN (...)" query per IN_CHUNK ids instead of one query per id
+    photo_ids = list(photo_ids)
+    photos = {}
+    for i in range(0, len(photo_ids), IN_CHUNK):
+        chunk = photo_ids[i:i + IN_CHUNK]
+        placeholders = ", ".join("?" * len(chunk))
+        for photo in db.execute(f"""SELECT * FROM photos WHERE id IN ({placeholders})""", chunk):
+            photos[photo["id"]] = photo
+    return photos
+
+
+def line_price(photo, license, print_qty):
+    price = 0.00
+    if license:
+        price += photo["price_license"]
+    if print_qty >= 1:
+        price += photo["price_print"] * print_qty
+    return round(price, 2)
+
+
+def price_cart(db, cart, load=load_photos):
+    # Prices every line of a session cart ({photo_id: {"license", "print_qty", ...}})
+    # for the cart and checkout pages. Photos deleted since they were added are
+    # listed in "missing" so the caller can drop them from the cart.
+    # load(db, photo_ids) returns {id: row}, the pages pass the catalogue cache.
+    photos = load(db, cart)
+
+    names = {}
+    price = {}
+    missing = []
+    for photo_id, item in cart.items():
+        photo = photos.get(photo_id)
+        if photo is None:
+            missing.append(photo_id)
+            continue
+        names[photo_id] = photo["title"]
+        price[photo_id] = line_price(photo, item["license"], item["print_qty"])
+
+    return {
+        "photos": photos,
+        "names": names,
+        "price": price,
+        "total_price": round(sum(price.values()), 2),
+        "missing": missing,
+    }
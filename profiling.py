@@ -0,0 +1,227 @@
+from flask import g, request, before_render_template, template_rendered
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+
+# Opt-in per-request instrumentation, turned on with app.config["PROFILING"].
+#
+# Every request gets a RequestProfile in g. The database connection counts
+# and times its statements into it, the session interface and the template
+# signals add their time, and at teardown it is folded into per-endpoint
+# totals that /admin/metrics shows as a table or in Prometheus' text format.
+# The numbers are per worker process.
+#
+# With PROFILING_SAMPLE_RATE above zero, that fraction of requests also runs
+# under cProfile, and the PROFILING_KEEP slowest of those are dumped to
+# PROFILING_DIR as <endpoint>-<milliseconds>ms-<time>.prof (open them with
+# snakeviz or pstats).
+
+# upper bounds of the request time histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.session_seconds = 0.0
+        self.render_started = None
+        self.profiler = None
+
+    def add_sql(self, seconds):
+        self.sql_statements += 1
+        self.sql_seconds += seconds
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.session_seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, profile, seconds):
+        self.requests += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.sql_statements += profile.sql_statements
+        self.sql_seconds += profile.sql_seconds
+        self.template_seconds += profile.template_seconds
+        self.session_seconds += profile.session_seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, profile, seconds):
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointStats()
+            self.endpoints[endpoint].add(profile, seconds)
+
+    def snapshot(self):
+        # [(endpoint, stats as a dict)], slowest in total first
+        with self.lock:
+            rows = [(endpoint, dict(vars(stats), buckets=list(stats.buckets)))
+                    for endpoint, stats in self.endpoints.items()]
+        return sorted(rows, key=lambda row: -row[1]["seconds"])
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+
+
+metrics = Metrics()
+
+
+class SlowestProfiles:
+    # Keeps the cProfile dumps of the keep slowest sampled requests, deleting
+    # a dump once it has been pushed out
+
+    def __init__(self, folder, keep):
+        self.folder = folder
+        self.keep = keep
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def offer(self, profiler, endpoint, seconds):
+        with self.lock:
+            if len(self.heap) >= self.keep and seconds <= self.heap[0][0]:
+                return None
+            os.makedirs(self.folder, exist_ok=True)
+            path = os.path.join(self.folder, f"{endpoint}-{seconds * 1000:.0f}ms-{int(time.time())}.prof")
+            profiler.dump_stats(path)
+            heapq.heappush(self.heap, (seconds, path))
+            if len(self.heap) > self.keep:
+                evicted = heapq.heappop(self.heap)[1]
+                if os.path.exists(evicted):
+                    os.remove(evicted)
+            return path
+
+
+# cProfile can only run one profiler at a time, so a sampled request that
+# finds it busy just isn't profiled
+_profiler_lock = threading.Lock()
+
+
+def current():
+    if "profile" not in g:
+        g.profile = RequestProfile()
+    return g.profile
+
+
+def time_session_interface(interface):
+    # Session loads happen before any before_request hook and saves after
+    # every after_request one, so the interface itself is wrapped
+    open_session = interface.open_session
+    save_session = interface.save_session
+
+    def timed_open_session(app, request):
+        profile = current()
+        start = time.perf_counter()
+        try:
+            return open_session(app, request)
+        finally:
+            profile.session_seconds += time.perf_counter() - start
+
+    def timed_save_session(app, session, response):
+        start = time.perf_counter()
+        try:
+            return save_session(app, session, response)
+        finally:
+            current().session_seconds += time.perf_counter() - start
+
+    interface.open_session = timed_open_session
+    interface.save_session = timed_save_session
+
+
+def init_app(app):
+    if not app.config.get("PROFILING"):
+        return
+
+    sample_rate = app.config.get("PROFILING_SAMPLE_RATE", 0)
+    slowest = SlowestProfiles(app.config.get("PROFILING_DIR", "profiles"), app.config.get("PROFILING_KEEP", 20))
+    time_session_interface(app.session_interface)
+
+    @app.before_request
+    def start_profile():
+        profile = current()
+        if sample_rate and random.random() < sample_rate and _profiler_lock.acquire(blocking=False):
+            profile.profiler = cProfile.Profile()
+            profile.profiler.enable()
+
+    def render_started(sender, template, context, **extra):
+        current().render_started = time.perf_counter()
+
+    def render_finished(sender, template, context, **extra):
+        profile = current()
+        if profile.render_started is not None:
+            profile.template_seconds += time.perf_counter() - profile.render_started
+            profile.render_started = None
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.teardown_request
+    def finish_profile(e=None):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        seconds = time.perf_counter() - profile.start
+        endpoint = request.endpoint or "unmatched"
+        if profile.profiler is not None:
+            profile.profiler.disable()
+            _profiler_lock.release()
+            slowest.offer(profile.profiler, endpoint, seconds)
+        metrics.record(endpoint, profile, seconds)
+
+
+def prometheus_text(counters=(), gauges=()):
+    # Text exposition format. counters and gauges are [(name, help, value)]
+    # for the process-wide running totals (database, sessions, caches) and
+    # for the levels right now (cache entries, vectors).
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    rows = metrics.snapshot()
+    family("photo_centre_request_seconds", "histogram", "Time spent serving requests, by endpoint")
+    for endpoint, stats in rows:
+        for bound, hits in zip(BUCKETS, stats["buckets"]):
+            lines.append(f'photo_centre_request_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {hits}')
+        lines.append(f'photo_centre_request_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats["requests"]}')
+        lines.append(f'photo_centre_request_seconds_sum{{endpoint="{endpoint}"}} {stats["seconds"]}')
+        lines.append(f'photo_centre_request_seconds_count{{endpoint="{endpoint}"}} {stats["requests"]}')
+
+    for key, kind, help_text in (("sql_statements", "counter", "SQL statements run"),
+                                 ("sql_seconds", "counter", "Time spent in SQL statements"),
+                                 ("template_seconds", "counter", "Time spent rendering templates"),
+                                 ("session_seconds", "counter", "Time spent loading and saving sessions")):
+        name = f"photo_centre_{key}_total"
+        family(name, kind, f"{help_text}, by endpoint")
+        for endpoint, stats in rows:
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {stats[key]}')
+
+    for name, help_text, value in counters:
+        family(f"photo_centre_{name}_total", "counter", help_text)
+        lines.append(f"photo_centre_{name}_total {value}")
+    for name, help_text, value in gauges:
+        family(f"photo_centre_{name}", "gauge", help_text)
+        lines.append(f"photo_centre_{name} {value}")
+    return "\n".join(lines) + "\n"
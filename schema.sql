@@ -19,6 +19,11 @@ CREATE TABLE admin_logs
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+-- the log views page through these newest first, see audit.py
+CREATE INDEX idx_admin_logs_timestamp ON admin_logs (timestamp);
+CREATE INDEX idx_admin_logs_user_timestamp ON admin_logs (user_id, timestamp);
+CREATE INDEX idx_admin_logs_action_timestamp ON admin_logs (action, timestamp);
+
 DROP TABLE IF EXISTS admin_payment_logs;
 
 CREATE TABLE admin_payment_logs
@@ -30,6 +35,9 @@ CREATE TABLE admin_payment_logs
     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX idx_admin_payment_logs_timestamp ON admin_payment_logs (timestamp);
+CREATE INDEX idx_admin_payment_logs_user_timestamp ON admin_payment_logs (user_id, timestamp);
+
 DROP TABLE IF EXISTS photos;
 
 CREATE TABLE photos 
@@ -41,9 +49,69 @@ CREATE TABLE photos
     file_path TEXT NOT NULL, 
     price_license REAL, 
     price_print REAL,
-    inventory INTEGER DEFAULT 30
+    inventory INTEGER DEFAULT 30,
+    thumb_path TEXT,
+    thumb_webp_path TEXT,
+    detail_path TEXT,
+    detail_webp_path TEXT,
+    full_path TEXT,
+    full_webp_path TEXT,
+    width INTEGER,
+    height INTEGER,
+    camera TEXT,
+    lens TEXT,
+    taken_at DATETIME,
+    phash INTEGER
+);
+
+CREATE INDEX idx_photos_theme_id_prices ON photos (theme, id, price_license, price_print);
+-- narrow price ranges, see catalogue.gallery_index()
+CREATE INDEX idx_photos_price_license ON photos (price_license, price_print, theme);
+CREATE INDEX idx_photos_price_print ON photos (price_print, price_license, theme);
+
+DROP TABLE IF EXISTS photos_fts;
+
+-- full-text search over the photo text, searched by /search
+CREATE VIRTUAL TABLE photos_fts USING fts5
+(
+    title, description, theme,
+    content='photos', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+
+-- title matches count the most, then theme, then description
+INSERT INTO photos_fts (photos_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 5.0)');
+
+CREATE TRIGGER photos_fts_insert AFTER INSERT ON photos BEGIN
+    INSERT INTO photos_fts (rowid, title, description, theme)
+    VALUES (new.id, new.title, new.description, new.theme);
+END;
+
+CREATE TRIGGER photos_fts_delete AFTER DELETE ON photos BEGIN
+    INSERT INTO photos_fts (photos_fts, rowid, title, description, theme)
+    VALUES ('delete', old.id, old.title, old.description, old.theme);
+END;
+
+CREATE TRIGGER photos_fts_update AFTER UPDATE OF title, description, theme ON photos BEGIN
+    INSERT INTO photos_fts (photos_fts, rowid, title, description, theme)
+    VALUES ('delete', old.id, old.title, old.description, old.theme);
+    INSERT INTO photos_fts (rowid, title, description, theme)
+    VALUES (new.id, new.title, new.description, new.theme);
+END;
+
+DROP TABLE IF EXISTS sessions;
+
+-- server-side sessions, see sessions.py
+CREATE TABLE sessions
+(
+    id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires_at REAL NOT NULL
 );
 
+CREATE INDEX idx_sessions_expires ON sessions (expires_at);
+
 DROP TABLE IF EXISTS themes;
 
 CREATE TABLE themes 
@@ -73,9 +141,200 @@ CREATE TABLE limited_photos
     file_path TEXT NOT NULL,
     base_price REAL NOT NULL, 
     start_date DATETIME DEFAULT CURRENT_TIMESTAMP,  
-    end_date DATETIME NOT NULL 
+    end_date DATETIME NOT NULL,
+    thumb_path TEXT,
+    thumb_webp_path TEXT,
+    detail_path TEXT,
+    detail_webp_path TEXT,
+    full_path TEXT,
+    full_webp_path TEXT,
+    width INTEGER,
+    height INTEGER,
+    camera TEXT,
+    lens TEXT,
+    taken_at DATETIME,
+    phash INTEGER,
+    settled_at DATETIME,
+    winner_id TEXT,
+    winning_bid REAL
 );
 
+CREATE INDEX idx_limited_photos_unsettled ON limited_photos (end_date) WHERE settled_at IS NULL;
+
+DROP TABLE IF EXISTS scheduler_leases;
+
+CREATE TABLE scheduler_leases
+(
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+
+DROP TABLE IF EXISTS blobs;
+
+-- how many photos and limited_photos rows use each stored file, see storage.py
+CREATE TABLE blobs
+(
+    file_path TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+);
+
+CREATE TRIGGER blobs_photos_insert AFTER INSERT ON photos BEGIN
+    INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+        ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+END;
+
+CREATE TRIGGER blobs_photos_delete AFTER DELETE ON photos BEGIN
+    UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+END;
+
+CREATE TRIGGER blobs_photos_update AFTER UPDATE OF file_path ON photos WHEN old.file_path IS NOT new.file_path BEGIN
+    UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+    INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+        ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+END;
+
+CREATE TRIGGER blobs_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+    INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+        ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+END;
+
+CREATE TRIGGER blobs_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+    UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+END;
+
+CREATE TRIGGER blobs_limited_photos_update AFTER UPDATE OF file_path ON limited_photos WHEN old.file_path IS NOT new.file_path BEGIN
+    UPDATE blobs SET refs = refs - 1 WHERE file_path = old.file_path;
+    INSERT INTO blobs (file_path, refs) VALUES (new.file_path, 1)
+        ON CONFLICT(file_path) DO UPDATE SET refs = refs + 1;
+END;
+
+DROP TABLE IF EXISTS image_hashes;
+
+-- every perceptual hash as 16-bit pieces, for near-duplicate lookups, see image_metadata.py
+CREATE TABLE image_hashes
+(
+    chunk INTEGER NOT NULL,
+    bits INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    photo_id INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    PRIMARY KEY (chunk, bits, source, photo_id)
+) WITHOUT ROWID;
+
+-- the pieces of one image, for the delete and update triggers
+CREATE INDEX idx_image_hashes_photo ON image_hashes (source, photo_id);
+
+CREATE TRIGGER image_hashes_photos_insert AFTER INSERT ON photos BEGIN
+    INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+    SELECT column1, column2, 'photos', new.id, new.phash FROM
+    (VALUES (0, new.phash & 65535),
+            (1, (new.phash >> 16) & 65535),
+            (2, (new.phash >> 32) & 65535),
+            (3, (new.phash >> 48) & 65535))
+    WHERE new.phash IS NOT NULL;
+END;
+
+CREATE TRIGGER image_hashes_photos_delete AFTER DELETE ON photos BEGIN
+    DELETE FROM image_hashes WHERE source = 'photos' AND photo_id = old.id AND (chunk, bits) IN
+    (VALUES (0, old.phash & 65535),
+            (1, (old.phash >> 16) & 65535),
+            (2, (old.phash >> 32) & 65535),
+            (3, (old.phash >> 48) & 65535));
+END;
+
+CREATE TRIGGER image_hashes_photos_update AFTER UPDATE OF phash ON photos WHEN old.phash IS NOT new.phash BEGIN
+    DELETE FROM image_hashes WHERE source = 'photos' AND photo_id = old.id AND (chunk, bits) IN
+    (VALUES (0, old.phash & 65535),
+            (1, (old.phash >> 16) & 65535),
+            (2, (old.phash >> 32) & 65535),
+            (3, (old.phash >> 48) & 65535));
+    INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+    SELECT column1, column2, 'photos', new.id, new.phash FROM
+    (VALUES (0, new.phash & 65535),
+            (1, (new.phash >> 16) & 65535),
+            (2, (new.phash >> 32) & 65535),
+            (3, (new.phash >> 48) & 65535))
+    WHERE new.phash IS NOT NULL;
+END;
+
+CREATE TRIGGER image_hashes_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+    INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+    SELECT column1, column2, 'limited_photos', new.id, new.phash FROM
+    (VALUES (0, new.phash & 65535),
+            (1, (new.phash >> 16) & 65535),
+            (2, (new.phash >> 32) & 65535),
+            (3, (new.phash >> 48) & 65535))
+    WHERE new.phash IS NOT NULL;
+END;
+
+CREATE TRIGGER image_hashes_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+    DELETE FROM image_hashes WHERE source = 'limited_photos' AND photo_id = old.id AND (chunk, bits) IN
+    (VALUES (0, old.phash & 65535),
+            (1, (old.phash >> 16) & 65535),
+            (2, (old.phash >> 32) & 65535),
+            (3, (old.phash >> 48) & 65535));
+END;
+
+CREATE TRIGGER image_hashes_limited_photos_update AFTER UPDATE OF phash ON limited_photos WHEN old.phash IS NOT new.phash BEGIN
+    DELETE FROM image_hashes WHERE source = 'limited_photos' AND photo_id = old.id AND (chunk, bits) IN
+    (VALUES (0, old.phash & 65535),
+            (1, (old.phash >> 16) & 65535),
+            (2, (old.phash >> 32) & 65535),
+            (3, (old.phash >> 48) & 65535));
+    INSERT INTO image_hashes (chunk, bits, source, photo_id, phash)
+    SELECT column1, column2, 'limited_photos', new.id, new.phash FROM
+    (VALUES (0, new.phash & 65535),
+            (1, (new.phash >> 16) & 65535),
+            (2, (new.phash >> 32) & 65535),
+            (3, (new.phash >> 48) & 65535))
+    WHERE new.phash IS NOT NULL;
+END;
+
+DROP TABLE IF EXISTS duplicate_pairs;
+
+-- near-duplicate images, each pair once with the lower (source, id) first, see image_metadata.py
+CREATE TABLE duplicate_pairs
+(
+    source_a TEXT NOT NULL,
+    id_a INTEGER NOT NULL,
+    source_b TEXT NOT NULL,
+    id_b INTEGER NOT NULL,
+    distance INTEGER NOT NULL,
+    PRIMARY KEY (source_a, id_a, source_b, id_b)
+) WITHOUT ROWID;
+
+CREATE INDEX idx_duplicate_pairs_b ON duplicate_pairs (source_b, id_b);
+
+CREATE TRIGGER duplicate_pairs_photos_delete AFTER DELETE ON photos BEGIN
+    DELETE FROM duplicate_pairs WHERE (source_a = 'photos' AND id_a = old.id) OR (source_b = 'photos' AND id_b = old.id);
+END;
+
+CREATE TRIGGER duplicate_pairs_photos_update AFTER UPDATE OF phash ON photos WHEN old.phash IS NOT new.phash BEGIN
+    DELETE FROM duplicate_pairs WHERE (source_a = 'photos' AND id_a = old.id) OR (source_b = 'photos' AND id_b = old.id);
+END;
+
+CREATE TRIGGER duplicate_pairs_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+    DELETE FROM duplicate_pairs WHERE (source_a = 'limited_photos' AND id_a = old.id) OR (source_b = 'limited_photos' AND id_b = old.id);
+END;
+
+CREATE TRIGGER duplicate_pairs_limited_photos_update AFTER UPDATE OF phash ON limited_photos WHEN old.phash IS NOT new.phash BEGIN
+    DELETE FROM duplicate_pairs WHERE (source_a = 'limited_photos' AND id_a = old.id) OR (source_b = 'limited_photos' AND id_b = old.id);
+END;
+
+DROP TABLE IF EXISTS photo_vectors;
+
+-- which row of the SIMILAR_VECTORS file holds each photo's colour vector, see similar.py
+CREATE TABLE photo_vectors
+(
+    photo_id INTEGER PRIMARY KEY,
+    row INTEGER UNIQUE NOT NULL
+);
+
+CREATE TRIGGER photo_vectors_photos_delete AFTER DELETE ON photos BEGIN
+    DELETE FROM photo_vectors WHERE photo_id = old.id;
+END;
+
 SELECT * FROM limited_photos;
 
 
@@ -92,6 +351,20 @@ CREATE TABLE bids
     FOREIGN KEY (user_id) REFERENCES users(user_id)
 );
 
+CREATE INDEX idx_bids_photo_amount ON bids (photo_id, bid_amount DESC);
+
+DROP TABLE IF EXISTS bid_leaderboard;
+
+-- top bids on open auctions, kept up to date by bidding.py
+CREATE TABLE bid_leaderboard
+(
+    bid_id INTEGER PRIMARY KEY,
+    photo_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    bid_amount REAL NOT NULL
+);
+
 
 DROP TABLE IF EXISTS purchases;
 
@@ -110,6 +383,9 @@ CREATE TABLE purchases
     FOREIGN KEY (photo_id) REFERENCES photos(id)
 );
 
+-- the license check behind /download, and a user's purchase history
+CREATE INDEX idx_purchases_user_photo ON purchases (user_id, photo_id, license);
+
 
 SELECT * FROM users;
 UPDATE users SET is_admin = TRUE WHERE user_id = "db";
@@ -119,4 +395,146 @@ SELECT * FROM purchases;
 DELETE FROM purchases;
 DELETE FROM sqlite_sequence WHERE name='purchases';
 
+DROP TABLE IF EXISTS sales_daily;
+DROP TABLE IF EXISTS sales_by_theme;
+DROP TABLE IF EXISTS sales_by_photo;
+
+-- sales rollups for /admin/analytics, see analytics.py
+CREATE TABLE sales_daily
+(
+    day TEXT PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    licenses INTEGER NOT NULL DEFAULT 0,
+    prints INTEGER NOT NULL DEFAULT 0,
+    auctions INTEGER NOT NULL DEFAULT 0,
+    license_revenue REAL NOT NULL DEFAULT 0,
+    print_revenue REAL NOT NULL DEFAULT 0,
+    auction_revenue REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE sales_by_theme
+(
+    theme TEXT PRIMARY KEY,
+    licenses INTEGER NOT NULL DEFAULT 0,
+    prints INTEGER NOT NULL DEFAULT 0,
+    license_revenue REAL NOT NULL DEFAULT 0,
+    print_revenue REAL NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE sales_by_photo
+(
+    photo_id INTEGER PRIMARY KEY,
+    licenses INTEGER NOT NULL DEFAULT 0,
+    prints INTEGER NOT NULL DEFAULT 0,
+    license_revenue REAL NOT NULL DEFAULT 0,
+    print_revenue REAL NOT NULL DEFAULT 0,
+    revenue REAL NOT NULL DEFAULT 0
+);
+
+CREATE INDEX idx_sales_by_photo_revenue ON sales_by_photo (revenue);
+
+DROP TABLE IF EXISTS catalogue_version;
+
+-- bumped on every change to photos, limited_photos, bids and themes, see
+-- http_cache.py and catalogue_cache.py
+CREATE TABLE catalogue_version
+(
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL,
+    changed_at INTEGER NOT NULL
+);
+
+INSERT INTO catalogue_version (id, version, changed_at)
+VALUES (1, 0, CAST(strftime('%s', 'now') AS INTEGER));
+
+CREATE TRIGGER catalogue_version_photos_insert AFTER INSERT ON photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_photos_update AFTER UPDATE ON photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_photos_delete AFTER DELETE ON photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_limited_photos_update AFTER UPDATE ON limited_photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_bids_insert AFTER INSERT ON bids BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_themes_insert AFTER INSERT ON themes BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_themes_update AFTER UPDATE ON themes BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+CREATE TRIGGER catalogue_version_themes_delete AFTER DELETE ON themes BEGIN
+    UPDATE catalogue_version SET version = version + 1, changed_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+DROP TABLE IF EXISTS photos_version;
+
+-- bumped on every change to photos, limited_photos and themes except a
+-- checkout taking prints out of stock, and never by bids, see
+-- catalogue_cache.py. Pages that show stock or bids use catalogue_version.
+CREATE TABLE photos_version
+(
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+
+INSERT INTO photos_version (id, version) VALUES (1, 0);
+
+CREATE TRIGGER photos_version_photos_insert AFTER INSERT ON photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_photos_update AFTER UPDATE OF title, description, theme, file_path, price_license, price_print, thumb_path, thumb_webp_path, detail_path, detail_webp_path, full_path, full_webp_path, width, height, camera, lens, taken_at, phash ON photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_photos_delete AFTER DELETE ON photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_limited_photos_insert AFTER INSERT ON limited_photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_limited_photos_update AFTER UPDATE ON limited_photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_limited_photos_delete AFTER DELETE ON limited_photos BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_themes_insert AFTER INSERT ON themes BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_themes_update AFTER UPDATE ON themes BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
+CREATE TRIGGER photos_version_themes_delete AFTER DELETE ON themes BEGIN
+    UPDATE photos_version SET version = version + 1;
+END;
+
 SELECT * FROM limited_photos;
\ No newline at end of file
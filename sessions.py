@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from datetime import timedelta
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+import hashlib
+import pickle
+import secrets
+import threading
+import time
+
+from database import get_db
+
+stats = {
+    "loads": 0,
+    "writes": 0,
+    "writes_skipped": 0,
+    "deletes": 0,
+    "expired_swept": 0,
+    "rolled_back": 0,
+}
+_stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with _stats_lock:
+        stats[name] += amount
+
+def get_stats():
+    with _stats_lock:
+        return dict(stats)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, digest=None, expires_at=0):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # what was stored, so an unchanged session isn't written back
+        self.digest = digest
+        self.expires_at = expires_at
+
+
+class ServerSessionInterface(SessionInterface):
+    # Keeps the session data on the server and only a random id in the cookie.
+    #
+    # A session is only written back when its pickled contents differ from
+    # what was loaded. That covers changes to the nested cart dict without
+    # relying on session.modified, and skips the write on requests that set
+    # modified without changing anything. An unchanged session has its expiry
+    # pushed back at most once per half lifetime, and expired sessions are
+    # swept every sweep_interval seconds.
+    #
+    # Subclasses store (blob, expires_at) pairs by session id.
+
+    def __init__(self, sweep_interval=300):
+        self.sweep_interval = sweep_interval
+        self.next_sweep = 0
+
+    def lifetime(self, app):
+        lifetime = app.permanent_session_lifetime
+        if isinstance(lifetime, timedelta):
+            lifetime = lifetime.total_seconds()
+        return lifetime
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.load(sid)
+            if stored is not None and stored[1] > time.time():
+                blob, expires_at = stored
+                count("loads")
+                return ServerSession(pickle.loads(blob), sid=sid,
+                                     digest=hashlib.blake2b(blob).digest(), expires_at=expires_at)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+
+        if now >= self.next_sweep:
+            self.next_sweep = now + self.sweep_interval
+            count("expired_swept", self.sweep(now))
+
+        if not session:
+            if not session.new:
+                self.delete(session.sid)
+                count("deletes")
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = self.lifetime(app)
+        blob = pickle.dumps(dict(session), protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.blake2b(blob).digest()
+        if digest == session.digest and session.expires_at - now > lifetime / 2:
+            count("writes_skipped")
+        else:
+            self.store(session.sid, blob, now + lifetime)
+            count("writes")
+
+        if session.new or session.permanent:
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+
+class SqliteSessionInterface(ServerSessionInterface):
+    # Sessions in the sessions table of app.db, shared by every worker
+
+    def writer(self):
+        # The request's connection, ready for a session write and its commit.
+        # Sessions are saved before close_db() runs, so a transaction still
+        # open here is whatever the view left unfinished, e.g. after an
+        # exception. close_db() would roll it back; the commit below must not
+        # write it instead.
+        db = get_db()
+        if db.in_transaction:
+            db.rollback()
+            count("rolled_back")
+        return db
+
+    def load(self, sid):
+        row = get_db().execute("""SELECT data, expires_at FROM sessions WHERE id = ?""", (sid,)).fetchone()
+        return (row["data"], row["expires_at"]) if row else None
+
+    def store(self, sid, blob, expires_at):
+        db = self.writer()
+        db.execute("""INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at""",
+                   (sid, blob, expires_at))
+        db.commit()
+
+    def delete(self, sid):
+        db = self.writer()
+        db.execute("""DELETE FROM sessions WHERE id = ?""", (sid,))
+        db.commit()
+
+    def sweep(self, now):
+        db = self.writer()
+        swept = db.execute("""DELETE FROM sessions WHERE expires_at < ?""", (now,)).rowcount
+        db.commit()
+        return swept
+
+
+class MemorySessionInterface(ServerSessionInterface):
+    # Sessions in a bounded LRU in this process. Fastest, but each worker
+    # process has its own sessions and they are lost on restart, so only use
+    # it with a single worker.
+
+    def __init__(self, max_sessions=10000, sweep_interval=300):
+        super().__init__(sweep_interval)
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        with self.lock:
+            stored = self.sessions.get(sid)
+            if stored is not None:
+                self.sessions.move_to_end(sid)
+            return stored
+
+    def store(self, sid, blob, expires_at):
+        with self.lock:
+            self.sessions[sid] = (blob, expires_at)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    def sweep(self, now):
+        with self.lock:
+            expired = [sid for sid, (blob, expires_at) in self.sessions.items() if expires_at < now]
+            for sid in expired:
+                del self.sessions[sid]
+        return len(expired)
+
+
+def init_app(app):
+    # SESSION_BACKEND is "sqlite", "memory" or "filesystem" (Flask-Session)
+    backend = app.config.get("SESSION_BACKEND", "sqlite")
+    sweep_interval = app.config.get("SESSION_SWEEP_INTERVAL", 300)
+    if backend == "sqlite":
+        app.session_interface = SqliteSessionInterface(sweep_interval)
+    elif backend == "memory":
+        app.session_interface = MemorySessionInterface(app.config.get("SESSION_MEMORY_SIZE", 10000), sweep_interval)
+    else:
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = backend
+        Session(app)
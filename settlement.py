@@ -0,0 +1,196 @@
+from datetime import datetime, timezone
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+
+import analytics
+import bidding
+import live
+from database import connect
+
+log = logging.getLogger(__name__)
+
+LEASE_NAME = "auction-settlement"
+
+# SQLite's DATETIME('now') format, always UTC
+SQL_TIME = "%Y-%m-%d %H:%M:%S"
+
+
+def sql_now():
+    return datetime.now(timezone.utc).strftime(SQL_TIME)
+
+
+def to_timestamp(end_date):
+    return datetime.strptime(str(end_date), SQL_TIME).replace(tzinfo=timezone.utc).timestamp()
+
+
+def acquire_lease(db, owner, ttl):
+    # Only one worker settles at a time. The lease row names the owner and
+    # when it expires; the owner renews it, anyone else can take it over once
+    # it has expired (e.g. the owner crashed).
+    now = time.time()
+    taken = db.execute("""INSERT INTO scheduler_leases (name, owner, expires_at) VALUES (?, ?, ?)
+                       ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                       WHERE scheduler_leases.owner = excluded.owner OR scheduler_leases.expires_at < ?""",
+                       (LEASE_NAME, owner, now + ttl, now))
+    db.commit()
+    return taken.rowcount == 1
+
+
+def release_lease(db, owner):
+    db.execute("""DELETE FROM scheduler_leases WHERE name = ? AND owner = ?""", (LEASE_NAME, owner))
+    db.commit()
+
+
+def settle_batch(db, now, batch_size):
+    # Settles up to batch_size ended auctions in one transaction: the highest
+    # bidder gets a payment log row, the sale goes into the analytics rollups
+    # and the auction is marked settled.
+    # settled_at is only set once, so running this again (after a crash, or
+    # from another worker) never bills anyone twice.
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        due = db.execute("""SELECT id FROM limited_photos
+                         WHERE settled_at IS NULL AND end_date <= ?
+                         ORDER BY end_date LIMIT ?""", (now, batch_size)).fetchall()
+
+        settled = []
+        for auction in due:
+            winner = db.execute("""SELECT user_id, bid_amount FROM bids WHERE photo_id = ?
+                                ORDER BY bid_amount DESC LIMIT 1""", (auction["id"],)).fetchone()
+            if winner:
+                db.execute("""INSERT INTO admin_payment_logs (user_id, print_qty, total)
+                           VALUES (?, ?, ?)""", (winner["user_id"], 1, winner["bid_amount"]))
+                analytics.record_auction(db, now[:10], winner["bid_amount"])
+
+            db.execute("""UPDATE limited_photos SET settled_at = ?, winner_id = ?, winning_bid = ?
+                       WHERE id = ? AND settled_at IS NULL""",
+                       (now, winner["user_id"] if winner else None, winner["bid_amount"] if winner else None, auction["id"]))
+            settled.append(auction["id"])
+
+        if settled:
+            bidding.rebuild_leaderboard(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for photo_id in settled:
+        bidding.forget(photo_id)
+        live.bids.publish("settled", {"photo_id": photo_id}, photo_id)
+    if settled:
+        live.bids.publish("leaderboard", [dict(row) for row in bidding.leaderboard(db)])
+    return settled
+
+
+def settle_due(db, batch_size=100):
+    now = sql_now()
+    settled = []
+    while True:
+        batch = settle_batch(db, now, batch_size)
+        settled += batch
+        if len(batch) < batch_size:
+            return settled
+
+
+class Scheduler(threading.Thread):
+    # Keeps a min-heap of (end time, auction id) for unsettled auctions and
+    # sleeps until the earliest one ends, rather than polling. upload_limited()
+    # calls add() so a new auction can wake it early, and the heap is reloaded
+    # every resync seconds to pick up auctions added by other workers.
+
+    def __init__(self, config, batch_size=100, lease_ttl=60, resync=300):
+        super().__init__(name="auction-settlement", daemon=True)
+        self.config = config
+        self.batch_size = batch_size
+        self.lease_ttl = lease_ttl
+        self.resync = resync
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.heap = []
+        self.wakeup = threading.Condition()
+        self.stopped = False
+
+    def add(self, photo_id, end_date):
+        with self.wakeup:
+            heapq.heappush(self.heap, (to_timestamp(end_date), photo_id))
+            self.wakeup.notify()
+
+    def stop(self):
+        with self.wakeup:
+            self.stopped = True
+            self.wakeup.notify()
+
+    def load(self, db):
+        rows = db.execute("""SELECT id, end_date FROM limited_photos
+                          WHERE settled_at IS NULL ORDER BY end_date""").fetchall()
+        with self.wakeup:
+            self.heap = [(to_timestamp(row["end_date"]), row["id"]) for row in rows]
+            heapq.heapify(self.heap)
+
+    def run(self):
+        db = connect(self.config)
+        try:
+            self.load(db)
+            next_resync = time.time() + self.resync
+            while True:
+                with self.wakeup:
+                    while not self.stopped:
+                        now = time.time()
+                        due_at = self.heap[0][0] if self.heap else float("inf")
+                        if due_at <= now or next_resync <= now:
+                            break
+                        self.wakeup.wait(min(due_at, next_resync) - now)
+                    if self.stopped:
+                        return
+                    due = []
+                    while self.heap and self.heap[0][0] <= time.time():
+                        due.append(heapq.heappop(self.heap))
+
+                if due:
+                    self.settle(db, due)
+                if next_resync <= time.time():
+                    self.load(db)
+                    next_resync = time.time() + self.resync
+        finally:
+            db.close()
+
+    def settle(self, db, due):
+        try:
+            if acquire_lease(db, self.owner, self.lease_ttl):
+                settled = settle_due(db, self.batch_size)
+                if settled:
+                    log.info("Settled auctions %s", settled)
+                return
+        except Exception:
+            log.exception("Auction settlement failed")
+        # another worker holds the lease (or we failed), try again once it
+        # could have expired; settling is idempotent if it already happened
+        with self.wakeup:
+            for end_time, photo_id in due:
+                heapq.heappush(self.heap, (time.time() + self.lease_ttl, photo_id))
+
+
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def start_scheduler(config):
+    global _scheduler, _scheduler_pid
+    with _scheduler_lock:
+        # a forked worker doesn't inherit the parent's thread, it starts its own
+        if _scheduler is None or _scheduler_pid != os.getpid():
+            _scheduler = Scheduler(config,
+                                   batch_size=config.get("SETTLEMENT_BATCH_SIZE", 100),
+                                   lease_ttl=config.get("SETTLEMENT_LEASE_TTL", 60),
+                                   resync=config.get("SETTLEMENT_RESYNC", 300))
+            _scheduler_pid = os.getpid()
+            _scheduler.start()
+    return _scheduler
+
+def schedule(photo_id, end_date):
+    # no-op in processes that don't run the scheduler
+    if _scheduler is not None and _scheduler_pid == os.getpid():
+        _scheduler.add(photo_id, end_date)
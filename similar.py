@@ -0,0 +1,192 @@
+from array import array
+from PIL import Image, ImageChops
+import os
+import threading
+
+from catalogue_cache import cache
+from image_metadata import UnreadableImage
+
+# numpy is only needed to answer queries. Without it vectors are still
+# extracted and stored, and the "similar photos" strip is just left out.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# "Similar photos" for the photo detail page, by colour.
+#
+# Every photo gets a vector at upload: a joint RGB histogram with BINS levels
+# per channel, square-rooted and scaled to length 1, so the dot product of two
+# vectors is 1 for the same colours and 0 for none in common. The vectors are
+# float32 rows appended to one flat file (SIMILAR_VECTORS), and the
+# photo_vectors table says which row belongs to which photo.
+#
+# Each worker process maps the file with numpy.memmap and scores every row
+# against a query with one matrix product, so the vectors live in the page
+# cache once however many workers there are. New rows are picked up by
+# reading only the photo_vectors rows past the last one it knows, the matrix
+# is never rebuilt. Rows of deleted photos stay in the file, unused.
+SHIFT = 6
+BINS = 256 >> SHIFT
+DIMENSIONS = BINS ** 3
+ROW_BYTES = DIMENSIONS * 4
+
+# how many photos the strip shows
+SIMILAR_SHOWN = 6
+
+
+def photo_vector(file_path):
+    # The vector for the image at file_path, as bytes ready for add_vector().
+    # Needs only Pillow, so it can run in worker processes.
+    try:
+        with Image.open(file_path) as image:
+            # JPEGs can be decoded at 1/8 scale, colours don't need more
+            image.draft("RGB", (64, 64))
+            image = image.convert("RGB").resize((32, 32), Image.BILINEAR)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise UnreadableImage(str(e) or "not a readable image")
+
+    # one grey image whose values are the bin numbers, then count them
+    red, green, blue = image.split()
+    bins = ImageChops.add(ImageChops.add(red.point(lambda v: (v >> SHIFT) * BINS * BINS),
+                                         green.point(lambda v: (v >> SHIFT) * BINS)),
+                          blue.point(lambda v: v >> SHIFT))
+    counts = bins.histogram()[:DIMENSIONS]
+    # the square roots of the counts already add up to length sqrt(pixels)
+    scale = sum(counts) ** 0.5
+    return array("f", (count ** 0.5 / scale for count in counts)).tobytes()
+
+
+class VectorIndex:
+    def __init__(self, path="photo_vectors.f32"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.matrix = None
+        self.ids = None
+        self.themes = None
+        self.rows = {}
+        self.theme_codes = {}
+        self.last_row = -1
+        self.queries = 0
+
+    def add(self, db, photo_id, vector):
+        # Appends vector to the file and points photo_id at its row. Call it
+        # inside a transaction that already holds the write lock (after an
+        # INSERT or UPDATE, or BEGIN IMMEDIATE): that is what stops two
+        # processes appending at once. If the transaction rolls back the row
+        # is just never used.
+        with open(self.path, "ab") as stream:
+            end = stream.tell()
+            # a write cut short by a crash, start on the next whole row
+            if end % ROW_BYTES:
+                stream.write(b"\0" * (ROW_BYTES - end % ROW_BYTES))
+            row = stream.tell() // ROW_BYTES
+            stream.write(vector)
+        db.execute("""INSERT INTO photo_vectors (photo_id, row) VALUES (?, ?)
+                   ON CONFLICT(photo_id) DO UPDATE SET row = excluded.row""", (photo_id, row))
+        return row
+
+    def refresh(self, db, photo_ids):
+        # Reads the photo_vectors rows added since the last call. Returns
+        # (matrix, ids, themes, rows of photo_ids) for one query to use, even
+        # if another thread refreshes meanwhile.
+        last_row = db.execute("""SELECT MAX(row) FROM photo_vectors""").fetchone()[0]
+        if last_row is None:
+            last_row = -1
+        with self.lock:
+            # the newest photo was deleted, or the database was recreated
+            if last_row < self.last_row:
+                self.matrix = self.ids = self.themes = None
+                self.rows = {}
+                self.last_row = -1
+            if last_row > self.last_row:
+                self.load(db, last_row)
+            return self.matrix, self.ids, self.themes, [self.rows.get(photo_id) for photo_id in photo_ids]
+
+    def load(self, db, last_row):
+        new = db.execute("""SELECT photo_vectors.row, photo_vectors.photo_id, photos.theme
+                         FROM photo_vectors JOIN photos ON photos.id = photo_vectors.photo_id
+                         WHERE photo_vectors.row > ? AND photo_vectors.row <= ?""", (self.last_row, last_row)).fetchall()
+        # new arrays rather than resized ones, queries may still hold the old
+        grow = last_row + 1 - (0 if self.ids is None else len(self.ids))
+        ids = np.full(grow, -1, dtype=np.int64)
+        themes = np.full(grow, -1, dtype=np.int32)
+        if self.ids is not None:
+            ids = np.concatenate((self.ids, ids))
+            themes = np.concatenate((self.themes, themes))
+        for row in new:
+            replaced = self.rows.get(row["photo_id"])
+            if replaced is not None:
+                ids[replaced] = -1
+            self.rows[row["photo_id"]] = row["row"]
+            ids[row["row"]] = row["photo_id"]
+            themes[row["row"]] = self.theme_codes.setdefault(row["theme"], len(self.theme_codes))
+        self.ids = ids
+        self.themes = themes
+        self.last_row = last_row
+
+        if self.matrix is None or len(self.matrix) <= last_row:
+            rows = os.path.getsize(self.path) // ROW_BYTES
+            self.matrix = np.memmap(self.path, dtype=np.float32, mode="r", shape=(rows, DIMENSIONS))
+
+    def nearest(self, db, photo_ids, count, theme=None):
+        # For each of photo_ids, [(score, photo id)] of the count best matches
+        # (the photo itself left out), best first. All the queries are scored
+        # in one matrix product. theme limits matches to that theme as it was
+        # when the vector was added; callers check the current row anyway.
+        matrix, ids, themes, queries = self.refresh(db, photo_ids)
+        found = [row for row in queries if row is not None]
+        if not found:
+            return [[] for _ in photo_ids]
+        self.queries += len(found)
+
+        # one row of scores per query, against every row of the file
+        scores = matrix[found] @ matrix[:len(ids)].T
+        unused = ids < 0
+        if theme is not None:
+            unused |= themes != self.theme_codes.get(theme, -2)
+        scores[:, unused] = -np.inf
+        scores[range(len(found)), found] = -np.inf
+
+        count = min(count, len(ids))
+        best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+        results = iter(zip(scores, best))
+        matches = []
+        for row in queries:
+            if row is None:
+                matches.append([])
+                continue
+            row_scores, top = next(results)
+            top = top[np.argsort(-row_scores[top], kind="stable")]
+            matches.append([(float(row_scores[r]), int(ids[r])) for r in top if row_scores[r] > -np.inf])
+        return matches
+
+    def stats(self):
+        return {"vectors": len(self.rows), "queries": self.queries}
+
+
+index = VectorIndex()
+
+
+def add_vector(db, photo_id, vector):
+    return index.add(db, photo_id, vector)
+
+
+def similar_photos(db, photo, count=SIMILAR_SHOWN, same_theme=True):
+    # Up to count photos rows that look most like photo, best first
+    if np is None:
+        return []
+    theme = photo["theme"] if same_theme else None
+    # a few spare in case some were deleted or moved theme since
+    matches = index.nearest(db, [photo["id"]], count + 4, theme)[0]
+    photos = cache.photos(db, [photo_id for score, photo_id in matches])
+    similar = []
+    for score, photo_id in matches:
+        match = photos.get(photo_id)
+        if match is not None and (theme is None or match["theme"] == theme):
+            similar.append(match)
+    return similar[:count]
+
+
+def init_app(app):
+    index.path = app.config.get("SIMILAR_VECTORS", index.path)
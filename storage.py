@@ -0,0 +1,94 @@
+import hashlib
+import os
+import tempfile
+
+from images import DERIVATIVE_SIZES, RETIRED_SIZES, derivative_paths
+
+# Uploads are read and hashed this many bytes at a time, so a 50 MB photo
+# never sits in memory whole
+CHUNK_SIZE = 1024 * 1024
+
+
+# Originals are stored once per distinct content, at
+# UPLOAD_FOLDER/<first two hex digits>/<sha256>.<extension>. Two uploads with
+# the same file name no longer overwrite each other, and the same image
+# uploaded twice (as a print and as a limited edition, say) shares one file.
+#
+# The blobs table counts how many photos and limited_photos rows use each
+# file; triggers keep it up to date, so every way a row is added or removed
+# is counted. A file is only deleted once its count drops to zero.
+#
+# Files are added inside the write transaction that inserts the rows. They
+# are removed only after the transaction that deleted the rows has committed,
+# so a rollback never leaves rows pointing at missing files, and under the
+# write lock again, so an upload of the same content can't slip in between
+# the count being checked and the file being deleted.
+
+class StagedUpload:
+    # An upload that has been streamed to a temporary file and hashed but is
+    # not in place yet, see stage_upload()
+
+    def __init__(self, temp_path, file_path):
+        self.temp_path = temp_path
+        self.file_path = file_path
+
+    def commit(self):
+        # Moves the file into place (a no-op if the content is already stored).
+        # Call it after inserting the row, before committing the transaction.
+        if os.path.exists(self.file_path):
+            os.remove(self.temp_path)
+        else:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            os.replace(self.temp_path, self.file_path)
+
+    def discard(self):
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def content_path(folder, digest, extension):
+    return os.path.join(folder, digest[:2], f"{digest}.{extension}").replace("\\", "/")
+
+
+def stage_upload(stream, folder, extension):
+    # stream is a FileStorage or any file object. The temporary file is in
+    # folder so the final os.replace() is a rename on the same filesystem.
+    os.makedirs(folder, exist_ok=True)
+    sha256 = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=folder, suffix=".part")
+    try:
+        with os.fdopen(handle, "wb") as temp:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                temp.write(chunk)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return StagedUpload(temp_path, content_path(folder, sha256.hexdigest(), extension.lower()))
+
+
+def remove_unused(db):
+    # Call inside the write transaction that deleted rows, before committing.
+    # Forgets the originals nothing refers to any more and returns their
+    # paths, for delete_unused() once the transaction has committed.
+    unused = [row["file_path"] for row in db.execute("""SELECT file_path FROM blobs WHERE refs <= 0""").fetchall()]
+    db.executemany("""DELETE FROM blobs WHERE file_path = ?""", [(file_path,) for file_path in unused])
+    return unused
+
+
+def delete_unused(db, unused, derivative_folder):
+    # Deletes the originals remove_unused() returned, with their derivatives,
+    # unless an upload of the same content has claimed one since
+    db.execute("""BEGIN IMMEDIATE""")
+    try:
+        for file_path in unused:
+            if db.execute("""SELECT 1 FROM blobs WHERE file_path = ?""", (file_path,)).fetchone():
+                continue
+            for path in [file_path, *derivative_paths(file_path, derivative_folder, [*DERIVATIVE_SIZES, *RETIRED_SIZES]).values()]:
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        db.rollback()
@@ -0,0 +1,81 @@
+import io
+import os
+
+from PIL import Image, ImageDraw
+
+from benchmarks.common import make_db
+import image_metadata
+
+
+def sample_image():
+    # a photo-like picture: a sky gradient with a few shapes on it
+    image = Image.linear_gradient("L").resize((800, 600)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((80, 60, 300, 280), fill=(240, 200, 60))
+    draw.rectangle((0, 420, 800, 600), fill=(40, 90, 50))
+    draw.polygon([(350, 420), (520, 150), (700, 420)], fill=(90, 90, 110))
+    return image
+
+
+def reencoded(image, crop=0.03, width=400, quality=50):
+    # image with crop trimmed off every edge, scaled to width and saved as a JPEG
+    left, top = int(image.width * crop), int(image.height * crop)
+    image = image.crop((left, top, image.width - left, image.height - top))
+    image = image.resize((width, width * image.height // image.width), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=quality)
+    output.seek(0)
+    return Image.open(output)
+
+
+def test_hashes_within_max_distance_are_probed():
+    phash = image_metadata.dhash(sample_image())
+    for start in range(64):
+        # MAX_DISTANCE bits flipped, spread over as many chunks as possible
+        flipped = sum(1 << ((start + bit * 9) % 64) for bit in range(image_metadata.MAX_DISTANCE))
+        other = image_metadata.to_signed((phash ^ flipped) & ((1 << 64) - 1))
+        assert image_metadata.distance(phash, other) == image_metadata.MAX_DISTANCE
+        assert set(image_metadata.probe_chunks(phash)) & set(image_metadata.hash_chunks(other))
+
+
+def test_cropped_and_reencoded_copy_is_found():
+    original = sample_image()
+    phash = image_metadata.dhash(original)
+    copy = image_metadata.dhash(reencoded(original))
+    # further apart than looking up equal 16-bit pieces alone could promise to find
+    assert 3 < image_metadata.distance(phash, copy) <= image_metadata.MAX_DISTANCE
+
+    db, path = make_db()
+    try:
+        db.execute("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, phash)
+                   VALUES ('Original', '', 'Landscapes', 'static/uploads/original.jpg', 10, 20, ?)""", (phash,))
+        # photos 16 bits away, sharing pieces with it: found by the lookup but
+        # too far apart to count
+        db.executemany("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, phash)
+                       VALUES (?, '', 'Landscapes', 'static/uploads/other.jpg', 10, 20, ?)""",
+                       [(f"Other {chunk}", image_metadata.to_signed((phash ^ (0xFFFF << (8 * chunk))) & ((1 << 64) - 1)))
+                        for chunk in range(7)])
+        image_metadata.rebuild_duplicates(db)
+        db.commit()
+
+        matches = image_metadata.near_duplicates(db, copy)
+        assert [(source, title) for apart, source, photo_id, title in matches] == [("photos", "Original")]
+        assert image_metadata.duplicate_groups(db) == []
+
+        # the copy uploaded too: the two now make one group
+        cursor = db.execute("""INSERT INTO photos (title, description, theme, file_path, price_license, price_print, phash)
+                            VALUES ('Copy', '', 'Landscapes', 'static/uploads/copy.jpg', 10, 20, ?)""", (copy,))
+        image_metadata.record_duplicates(db, "photos", cursor.lastrowid, copy)
+        groups = image_metadata.duplicate_groups(db)
+        assert groups == [[("photos", 1), ("photos", cursor.lastrowid)]]
+
+        # a rebuild finds the same pairs as recording them one upload at a time
+        stored = db.execute("""SELECT * FROM duplicate_pairs""").fetchall()
+        image_metadata.rebuild_duplicates(db)
+        assert db.execute("""SELECT * FROM duplicate_pairs""").fetchall() == stored
+
+        db.execute("""DELETE FROM photos WHERE id = ?""", (cursor.lastrowid,))
+        assert image_metadata.duplicate_groups(db) == []
+    finally:
+        db.close()
+        os.remove(path)